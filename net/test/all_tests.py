@@ -20,6 +20,7 @@ import sys
 import unittest
 
 import namespace
+import netlink
 
 test_modules = [
     'anycast_test',
@@ -29,6 +30,8 @@ test_modules = [
     'leak_test',
     'multinetwork_test',
     'neighbour_test',
+    'netlink_capture_test',
+    'netlink_monitor_test',
     'netlink_test',
     'nf_test',
     'parameterization_test',
@@ -51,6 +54,10 @@ test_modules = [
 if __name__ == '__main__':
   namespace.EnterNewNetworkNamespace()
 
+  # Print how much time and traffic each netlink command took.
+  if os.environ.get('NETLINK_STATS'):
+    netlink.EnableStats()
+
   # If one or more tests were passed in on the command line, only run those.
   if len(sys.argv) > 1:
     test_modules = sys.argv[1:]
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+#
+# Copyright 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asyncio support for netlink sockets."""
+
+import asyncio
+import errno
+import os
+
+import netlink
+
+
+class _Request(object):
+  """A request that is waiting for replies from the kernel."""
+
+  def __init__(self, loop, flags, msgtype):
+    self.flags = flags
+    self.msgtype = msgtype
+    # Decoded (msg, attrs) tuples, followed by None if the request succeeded
+    # or an exception if it failed.
+    self.replies = asyncio.Queue()
+    # If True, no one is reading the replies, so don't decode them.
+    self.discard = msgtype is None
+    self.finished = loop.create_future()
+
+  def Finish(self, error=None):
+    self.replies.put_nowait(error)
+    self.finished.set_result(None)
+
+  async def Replies(self):
+    while True:
+      reply = await self.replies.get()
+      if reply is None:
+        return
+      if isinstance(reply, Exception):
+        raise reply
+      yield reply
+
+
+class AsyncNetlink(object):
+  """Runs requests and dumps on a netlink socket from asyncio coroutines.
+
+  Wraps a NetlinkSocket, such as an IPRoute or a SockDiag, and uses its socket,
+  its request builders and its _Decode methods. Replies are matched to requests
+  by sequence number and port ID, so any number of requests can be outstanding
+  at once.
+
+  The kernel runs only one dump at a time on each socket, so dumps on the same
+  AsyncNetlink take turns. To run dumps in parallel, e.g., on several netlink
+  families, use one AsyncNetlink for each.
+
+  Must be created by a coroutine running in the event loop. After that, the
+  socket is non-blocking, and must only be used through this object. e.g.:
+
+    ipr = async_netlink.AsyncNetlink(iproute.IPRoute())
+    await ipr.Call(ipr.nl.AddAddress, "192.0.2.1", 24, ifindex)
+    links = await ipr.Dump(iproute.RTM_GETLINK, iproute.IfinfoMsg(),
+                           iproute.IfinfoMsg)
+  """
+
+  def __init__(self, nl):
+    self.nl = nl
+    self._loop = asyncio.get_running_loop()
+    # seq -> _Request.
+    self._pending = {}
+    self._dump_lock = asyncio.Lock()
+    # Replies are addressed to our port ID. Note that NetlinkSocket.pid is not
+    # the port ID, because getsockname returns (port ID, groups).
+    self._portid = nl.sock.getsockname()[0]
+    nl.sock.setblocking(False)
+    self._loop.add_reader(nl.sock.fileno(), self._OnReadable)
+
+  def close(self):
+    self._loop.remove_reader(self.nl.sock.fileno())
+    self._FailAll(IOError(errno.EBADF, "Socket closed"))
+    self.nl.close()
+
+  def _FailAll(self, error):
+    for request in self._pending.values():
+      request.Finish(error)
+    self._pending.clear()
+
+  def _OnReadable(self):
+    while True:
+      try:
+        data = self.nl._RecvInto()
+      except BlockingIOError:
+        return
+      except OSError as e:
+        # e.g., ENOBUFS. Replies have been lost, so nothing can complete.
+        self._FailAll(e)
+        return
+
+      try:
+        self._Dispatch(data)
+      except ValueError as e:
+        # A truncated or malformed datagram. Replies may have been lost, so
+        # nothing can be relied on to complete.
+        self._FailAll(e)
+        return
+
+  def _Dispatch(self, data):
+    for hdr, body_offset, body_len in self.nl._IndexNLMsgs(data):
+      # Skip anything that isn't a reply to us, e.g., multicast messages.
+      request = self._pending.get(hdr.seq)
+      if request is None or hdr.pid != self._portid:
+        continue
+
+      if hdr.type == netlink.NLMSG_DONE:
+        error = None
+      elif hdr.type == netlink.NLMSG_ERROR:
+        error = -netlink.NLMsgErr.ReadFrom(data, body_offset)[0].error
+        error = IOError(error, os.strerror(error)) if error else None
+      else:
+        if not request.discard:
+          try:
+            request.replies.put_nowait(self.nl._DecodeNLMsg(
+                data, hdr, body_offset, body_len, request.msgtype))
+          except (TypeError, ValueError) as e:
+            # Stop here, but don't finish until the kernel does.
+            request.replies.put_nowait(e)
+            request.discard = True
+        # A single reply to a request without NLM_F_ACK is the last one.
+        if (hdr.flags & netlink.NLM_F_MULTI or
+            request.flags & netlink.NLM_F_ACK):
+          continue
+        error = None
+
+      del self._pending[hdr.seq]
+      request.Finish(error)
+
+  def _Start(self, command, data, flags, msgtype):
+    """Sends a request and returns a _Request for its replies."""
+    nlmsg = self.nl._FinishNlRequest(command, data, flags)
+    self.nl.MaybeDebugCommand(command, flags, nlmsg)
+    return self._Register(self.nl.seq, nlmsg, flags, msgtype)
+
+  def _Register(self, seq, nlmsg, flags, msgtype):
+    request = _Request(self._loop, flags, msgtype)
+    self._pending[seq] = request
+    self.nl.seq = max(self.nl.seq, seq + 1)
+    try:
+      self.nl.sock.send(nlmsg)
+    except OSError:
+      del self._pending[seq]
+      raise
+    if self.nl.stats is not None:
+      self.nl._CountMessages(nlmsg, "requests", "bytes_sent")
+    return request
+
+  async def Request(self, command, data, flags=netlink.NLM_F_ACK,
+                    msgtype=None):
+    """Sends a request and waits until the kernel has answered it.
+
+    Args:
+      command: An integer, the netlink message type.
+      data: The request body, as for NetlinkSocket._SendNlRequest.
+      flags: An integer, the netlink message flags. NLM_F_REQUEST is implied.
+      msgtype: A cstruct.Struct, the type of the replies, if any.
+
+    Returns:
+      A list of the decoded (msg, attrs) replies. Empty if the kernel only
+      replied with an ACK.
+
+    Raises:
+      IOError: The kernel returned an error.
+    """
+    request = self._Start(command, data, flags | netlink.NLM_F_REQUEST,
+                          msgtype)
+    return [reply async for reply in request.Replies()]
+
+  async def Call(self, method, *args, **kwargs):
+    """Calls a request method of the wrapped socket without blocking.
+
+    method must only send requests that are answered by an ACK, e.g.,
+    IPRoute.AddRoute or Xfrm.AddSaInfo. The requests are all sent at once, and
+    then their ACKs are awaited.
+
+    Raises:
+      IOError: The request failed.
+      netlink.BatchError: method sent several requests, and some failed.
+    """
+    with self.nl._QueueRequests() as requests:
+      method(*args, **kwargs)
+    flags = netlink.NLM_F_REQUEST | netlink.NLM_F_ACK
+    started = [self._Register(seq, nlmsg, flags, None)
+               for seq, _, nlmsg in requests]
+    failures = []
+    for index, request in enumerate(started):
+      await request.finished
+      # An ACK has no replies, so the only thing queued is the result.
+      error = request.replies.get_nowait()
+      if error:
+        failures.append((index, requests[index][1], error))
+    if len(requests) == 1 and failures:
+      raise failures[0][2]
+    if failures:
+      raise netlink.BatchError([(i, c, e.errno) for i, c, e in failures])
+
+  async def IterDump(self, command, msg, msgtype, attrs=b""):
+    """Sends a dump request and yields the decoded messages as they arrive.
+
+    Takes the same arguments as NetlinkSocket.IterDump. If the caller stops
+    early, it should close the iterator with aclose(). This waits for the
+    kernel to finish the dump and discards the rest of it.
+    """
+    buf = self.nl._NlRequestBuffer()
+    if msg is not None:
+      buf.Append(msg)
+    buf.Append(attrs)
+    async with self._dump_lock:
+      request = self._Start(command, buf,
+                            netlink.NLM_F_DUMP | netlink.NLM_F_REQUEST,
+                            msgtype)
+      try:
+        async for reply in request.Replies():
+          yield reply
+      finally:
+        # Hold the lock until the kernel finishes the dump.
+        request.discard = True
+        await request.finished
+
+  async def Dump(self, command, msg, msgtype, attrs=b""):
+    """Sends a dump request and returns a list of decoded messages."""
+    return [reply async for reply in self.IterDump(command, msg, msgtype,
+                                                    attrs)]
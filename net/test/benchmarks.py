@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+#
+# Copyright 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the cstruct and netlink microbenchmarks and checks for regressions.
+
+The benchmarks run offline against byte fixtures built from the real struct
+definitions, so they don't need root or any particular kernel. They are not
+part of all_tests.py, because timings depend on the machine.
+
+  # Run all benchmarks, or only those whose names contain a string.
+  $ ./benchmarks.py
+  $ ./benchmarks.py --filter TcpInfo
+
+  # Record a baseline, then check later runs against it. Fails if anything is
+  # more than --margin (default 20%) slower than the baseline.
+  $ ./benchmarks.py --baseline /tmp/baseline.json --update-baseline
+  $ ./benchmarks.py --baseline /tmp/baseline.json --margin 0.1
+"""
+
+import argparse
+import collections
+import json
+import sys
+import timeit
+import tracemalloc
+
+
+# A benchmark.
+#   name: A string, unique among all benchmarks.
+#   func: A function that takes no arguments and performs one operation.
+#   number: An integer, the number of operations to time per repetition.
+#   nbytes: An integer, the number of bytes processed per operation, or 0.
+Benchmark = collections.namedtuple("Benchmark", ["name", "func", "number",
+                                                 "nbytes"])
+Benchmark.__new__.__defaults__ = (0,)
+
+# A benchmark result.
+#   ops: Operations per second, from the fastest repetition.
+#   bytes: Bytes processed per second, or None if nbytes was 0.
+#   peak: Peak memory allocated by one operation, in bytes.
+Result = collections.namedtuple("Result", ["ops", "bytes", "peak"])
+
+# Relative slowdown from the baseline beyond which a benchmark fails.
+DEFAULT_MARGIN = 0.2
+
+_REPEAT = 3
+
+
+def MeasurePeak(func):
+  """Returns the peak memory allocated while calling func once, in bytes.
+
+  Memory that was allocated before the call is not counted, so this shows
+  temporary allocations (e.g., receive buffers) as well as the result.
+  """
+  tracemalloc.start()
+  try:
+    func()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+def Measure(benchmark, repeat=_REPEAT):
+  """Times a benchmark and returns a Result."""
+  seconds = min(timeit.repeat(benchmark.func, number=benchmark.number,
+                              repeat=repeat))
+  ops = benchmark.number / seconds
+  # Traced separately, because tracing slows everything down.
+  peak = MeasurePeak(benchmark.func)
+  return Result(ops, ops * benchmark.nbytes if benchmark.nbytes else None,
+                peak)
+
+
+def FormatResult(name, result):
+  line = "%-40s %12.1f ops/sec" % (name, result.ops)
+  if result.bytes is not None:
+    line += " %10.1f MB/sec" % (result.bytes / 1e6)
+  else:
+    line += " %17s" % ""
+  line += " %10.1f KiB peak" % (result.peak / 1024)
+  return line
+
+
+def ReadBaseline(filename):
+  """Returns a dict mapping benchmark names to ops/sec."""
+  with open(filename) as f:
+    return json.load(f)["ops"]
+
+
+def WriteBaseline(filename, results):
+  with open(filename, "w") as f:
+    json.dump({"ops": {name: r.ops for name, r in results.items()}}, f,
+              indent=2, sort_keys=True)
+    f.write("\n")
+
+
+def FindRegressions(results, baseline, margin):
+  """Compares results with a baseline.
+
+  Args:
+    results: A dict mapping benchmark names to Results.
+    baseline: A dict mapping benchmark names to ops/sec.
+    margin: A float, the allowed relative slowdown, e.g., 0.2 for 20%.
+
+  Returns:
+    A list of (name, ops/sec, baseline ops/sec) tuples, one for each benchmark
+    that is slower than the baseline by more than the margin. Benchmarks that
+    are not in the baseline are ignored.
+  """
+  regressions = []
+  for name, result in results.items():
+    expected = baseline.get(name)
+    if expected and result.ops < expected * (1 - margin):
+      regressions.append((name, result.ops, expected))
+  return regressions
+
+
+def Run(benchmarks, name_filter=None, out=sys.stdout):
+  """Runs benchmarks, printing results as they complete.
+
+  Returns:
+    A dict mapping benchmark names to Results, in the order they were run.
+  """
+  results = collections.OrderedDict()
+  for benchmark in benchmarks:
+    if name_filter and name_filter not in benchmark.name:
+      continue
+    if benchmark.name in results:
+      raise ValueError("Duplicate benchmark %s" % benchmark.name)
+    results[benchmark.name] = Measure(benchmark)
+    out.write(FormatResult(benchmark.name, results[benchmark.name]) + "\n")
+    out.flush()
+  return results
+
+
+def AllBenchmarks():
+  # Imported here so that importing this module doesn't import everything.
+  import cstruct_benchmark  # pylint: disable=g-import-not-at-top
+  import netlink_benchmark  # pylint: disable=g-import-not-at-top
+  return (list(cstruct_benchmark.Benchmarks()) +
+          list(netlink_benchmark.Benchmarks()))
+
+
+def Main(argv, benchmarks=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--filter", help="only run benchmarks containing this")
+  parser.add_argument("--baseline", help="JSON file of baseline results")
+  parser.add_argument("--margin", type=float, default=DEFAULT_MARGIN,
+                      help="allowed slowdown, e.g., 0.2 for 20%%")
+  parser.add_argument("--update-baseline", action="store_true",
+                      help="write the results to --baseline")
+  args = parser.parse_args(argv)
+  if args.update_baseline and not args.baseline:
+    parser.error("--update-baseline requires --baseline")
+
+  if benchmarks is None:
+    benchmarks = AllBenchmarks()
+  results = Run(benchmarks, args.filter)
+
+  if args.update_baseline:
+    WriteBaseline(args.baseline, results)
+    return 0
+
+  if args.baseline:
+    regressions = FindRegressions(results, ReadBaseline(args.baseline),
+                                  args.margin)
+    for name, ops, expected in regressions:
+      print("REGRESSION: %s: %.0f ops/sec, baseline %.0f ops/sec (%.0f%%)" %
+            (name, ops, expected, 100 * (ops / expected - 1)))
+    if regressions:
+      return 1
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(Main(sys.argv[1:]))
@@ -147,7 +147,7 @@ def _MakeMsgControl(optlist):
   Raises:
     TypeError: Option data is neither an integer nor a string.
   """
-  msg_control = b""
+  msg_control = cstruct.PackBuffer()
 
   for i, opt in enumerate(optlist):
     msg_level, msg_type, data = opt
@@ -159,23 +159,24 @@ def _MakeMsgControl(optlist):
       raise TypeError("unknown data type for opt (%d, %d): %s" % (
           msg_level, msg_type, type(data)))
 
-    datalen = len(data)
-    msg_len = len(CMsgHdr) + datalen
-    padding = b"\x00" * util.GetPadLength(CMSG_ALIGNTO, datalen)
-    msg_control += CMsgHdr((msg_len, msg_level, msg_type)).Pack()
-    msg_control += data + padding
+    msg_len = len(CMsgHdr) + len(data)
+    start = msg_control.Append(CMsgHdr((msg_len, msg_level, msg_type)))
+    msg_control.Append(data)
+    msg_control.Pad(CMSG_ALIGNTO, start)
 
-  return msg_control
+  return msg_control.Pack()
 
 
 def _ParseMsgControl(buf):
   """Parse a raw control buffer into a list of tuples."""
   msglist = []
-  while len(buf) > 0:
-    cmsghdr, buf = cstruct.Read(buf, CMsgHdr)
+  offset = 0
+  while offset < len(buf):
+    cmsghdr, offset = CMsgHdr.ReadFrom(buf, offset)
     datalen = cmsghdr.len - len(CMsgHdr)
     padlen = util.GetPadLength(CMSG_ALIGNTO, datalen)
-    data, buf = buf[:datalen], buf[padlen + datalen:]
+    data = buf[offset:offset + datalen]
+    offset += datalen + padlen
 
     if cmsghdr.level == socket.IPPROTO_IP:
       if cmsghdr.type == IP_PKTINFO:
@@ -187,9 +188,10 @@ def _ParseMsgControl(buf):
       if cmsghdr.type == IPV6_PKTINFO:
         data = In6Pktinfo(data)
       elif cmsghdr.type == IPV6_RECVERR:
-        err, source = cstruct.Read(data, SockExtendedErr)
+        err, source_offset = SockExtendedErr.ReadFrom(data)
+        source = data[source_offset:]
         if err.origin == SO_ORIGIN_ICMP6:
-          source, pad = cstruct.Read(source, SockaddrIn6)
+          source = SockaddrIn6.ReadFrom(data, source_offset)[0]
         data = (err, source)
       elif cmsghdr.type == IPV6_HOPLIMIT:
         data = struct.unpack("@I", data)[0]
@@ -326,7 +328,8 @@ def Recvmsg(s, buflen, controllen, flags, addrlen=len(SockaddrStorage)):
   MaybeRaiseSocketError(ret)
 
   data = buf.raw[:ret]
-  msghdr = MsgHdr(msghdr._buffer.raw)
+  # recvmsg updated the lengths in the msghdr that VoidPointer passed to it.
+  msghdr.ReadCObject()
   addr = _ToSocketAddress(addr, msghdr.namelen)
   control = control.raw[:msghdr.msg_controllen]
   msglist = _ParseMsgControl(control)
@@ -56,15 +56,52 @@ NLMsgHdr(length=44, type=33, flags=0, seq=0, pid=0)
 >>> cstruct.Read(data, NLMsgHdr)
 (NLMsgHdr(length=44, type=33, flags=2, seq=0, pid=510), 'more data')
 >>>
+>>> # Parse a struct at an offset into a buffer without copying the rest of
+... # the buffer. Returns the struct and the offset just past it. The buffer
+... # can be a bytes, bytearray or memoryview object.
+... NLMsgHdr.ReadFrom(data, 0)
+(NLMsgHdr(length=44, type=33, flags=2, seq=0, pid=510), 16)
+>>>
 >>> # Structs can contain one or more nested structs. The nested struct types
 ... # are specified in a list as an optional last argument. Nested structs may
-... # contain nested structs.
+... # contain nested structs. When parsing, nested structs are only decoded
+... # when they are first accessed.
 ... S = cstruct.Struct("S", "=BI", "byte1 int2")
 >>> N = cstruct.Struct("N", "!BSiS", "byte1 s2 int3 s2", [S, S])
 >>> NN = cstruct.Struct("NN", "SHS", "s1 word2 n3", [S, N])
 >>> nn = NN((S((1, 25000)), -29876, N((55, S((5, 6)), 1111, S((7, 8))))))
 >>> nn.n3.s2.int2 = 5
 >>>
+>>> # Build a message in place instead of concatenating bytes objects.
+... buf = cstruct.PackBuffer()
+>>> buf.Append(n1)
+0
+>>> buf.Append(b"payload")
+16
+>>> buf.Pad(4)
+>>> len(buf)
+24
+>>>
+>>> # Packed arrays of one struct type can be decoded in a single pass.
+... # Struct objects are only created for the records that are accessed.
+... a = cstruct.StructArray(NLMsgHdr, n1.Pack() + n4.Pack())
+>>> len(a), a[1].type, a.column("length")
+(2, 33, [44, 44])
+>>>
+>>> # A StructView reads and writes fields directly in a writable buffer.
+... buf = bytearray(n1.Pack())
+>>> v = cstruct.StructView(NLMsgHdr, buf)
+>>> v.seq = 7
+>>> NLMsgHdr(buf).seq
+7
+>>> NN.offset("n3.s2.int2")
+19
+>>>
+>>> # Structs can be passed to C code. CPointer() returns a pointer to the
+... # struct's ctypes mirror, from which C code's results can then be read.
+... n1.CObject().pid
+491
+>>>
 """
 
 import binascii
@@ -92,6 +129,131 @@ def CalcNumElements(fmt):
   return len(elements) + numstructs
 
 
+def _FieldLayout(fmt):
+  """Computes the offset and format of each field of a struct module format.
+
+  Unlike calling CalcSize on every prefix of fmt, this takes a single pass.
+
+  Args:
+    fmt: A struct module format, i.e., with no S or A characters.
+
+  Returns:
+    A list with one (offset, format) tuple per field. The format is a struct
+    module format that can be used to pack or unpack just that field at that
+    offset, e.g., "!I".
+  """
+  order = "@"
+  if fmt and fmt[0] in "@=<>!":
+    order, fmt = fmt[0], fmt[1:]
+
+  layout = []
+  offset = 0
+  i = 0
+  while i < len(fmt):
+    start = i
+    while fmt[i].isdigit():
+      i += 1
+    count = int(fmt[start:i]) if i > start else 1
+    char = fmt[i]
+    i += 1
+    if char.isspace():
+      continue
+
+    if order == "@":
+      # Native alignment. calcsize pads the char to its alignment after a byte.
+      alignment = struct.calcsize("B" + char) - struct.calcsize(char)
+      offset += -offset % alignment
+
+    if char == "x":
+      offset += count
+    elif char in "sp":
+      # Strings are one field of count bytes.
+      layout.append((offset, "%s%d%s" % (order, count, char)))
+      offset += count
+    else:
+      fieldfmt = order + char
+      size = struct.calcsize(fieldfmt)
+      for _ in range(count):
+        layout.append((offset, fieldfmt))
+        offset += size
+
+  return layout
+
+
+# ctypes integer types by (size, signed).
+_CTYPES_INTS = {
+    (1, True): ctypes.c_int8, (1, False): ctypes.c_uint8,
+    (2, True): ctypes.c_int16, (2, False): ctypes.c_uint16,
+    (4, True): ctypes.c_int32, (4, False): ctypes.c_uint32,
+    (8, True): ctypes.c_int64, (8, False): ctypes.c_uint64,
+}
+
+# ctypes structure base classes by struct module byte order character.
+_CTYPES_BASES = {
+    "@": ctypes.Structure,
+    "=": ctypes.Structure,
+    "<": ctypes.LittleEndianStructure,
+    ">": ctypes.BigEndianStructure,
+    "!": ctypes.BigEndianStructure,
+}
+
+
+def _CTypeForField(fieldfmt):
+  """Returns the ctypes type for one field, given its format from _FieldLayout.
+
+  Strings, and anything that ctypes has no exact equivalent for, become byte
+  arrays of the same size.
+  """
+  size = struct.calcsize(fieldfmt)
+  char = fieldfmt[-1]
+  if char in "bhilqn":
+    return _CTYPES_INTS[(size, True)]
+  elif char in "BHILQNP":
+    return _CTYPES_INTS[(size, False)]
+  elif char == "?":
+    return ctypes.c_bool
+  elif char == "c":
+    return ctypes.c_char
+  elif char == "f":
+    return ctypes.c_float
+  elif char == "d":
+    return ctypes.c_double
+  return ctypes.c_ubyte * size
+
+
+def _FieldProperty(index):
+  """Returns a property that reads and writes one element of _values."""
+
+  def Get(self):
+    return self._values[index]
+
+  def Set(self, value):
+    self._values[index] = value
+
+  return property(Get, Set)
+
+
+def _NestedFieldProperty(index, nested_type):
+  """Returns a property for a nested struct field that is decoded lazily.
+
+  Parsing leaves the packed bytes of nested structs in _values. They are only
+  decoded the first time the field is read, and if that never happens, Pack()
+  writes them back unchanged.
+  """
+
+  def Get(self):
+    value = self._values[index]
+    if isinstance(value, bytes):
+      value = nested_type(value)
+      self._values[index] = value
+    return value
+
+  def Set(self, value):
+    self._values[index] = value
+
+  return property(Get, Set)
+
+
 class StructMetaclass(type):
 
   def __len__(cls):
@@ -102,8 +264,18 @@ class StructMetaclass(type):
     type.__init__(cls, namespace["_name"], unused_bases, namespace)
 
 
+# Struct classes that have already been created, keyed by Struct() arguments.
+_struct_cache = {}
+
+
 def Struct(name, fmt, fieldnames, substructs={}):
-  """Function that returns struct classes."""
+  """Function that returns struct classes.
+
+  Calling this again with the same arguments returns the same class.
+  """
+  key = (name, fmt, fieldnames, tuple(substructs))
+  if key in _struct_cache:
+    return _struct_cache[key]
 
   # Hack to make struct classes use the StructMetaclass class on both python2 and
   # python3. This is needed because in python2 the metaclass is assigned in the
@@ -113,11 +285,16 @@ def Struct(name, fmt, fieldnames, substructs={}):
   #
   # A better option would be to use six.with_metaclass, but the existing python2
   # VM image doesn't have the six module.
-  CStructSuperclass = type.__new__(StructMetaclass, 'unused', (), {})
+  CStructSuperclass = type.__new__(StructMetaclass, 'unused', (),
+                                   {"__slots__": ()})
 
   class CStruct(CStructSuperclass):
     """Class representing a C-like structure."""
 
+    # Field values live in _values and are accessed through the per-field
+    # properties added below, so instances don't need a __dict__.
+    __slots__ = ("_values", "_buffer", "_packed")
+
     # Name of the struct.
     _name = name
     # List of field names.
@@ -131,58 +308,64 @@ def Struct(name, fmt, fieldnames, substructs={}):
 
     # Parse fmt into _format, converting any S format characters to "XXs",
     # where XX is the length of the struct type's packed representation.
+    # fieldindex counts the fields seen so far.
     _format = ""
+    fieldindex = 0
     laststructindex = 0
-    for i in range(len(fmt)):
-      if fmt[i] == "S":
+    digits = ""
+    for char in fmt:
+      if char.isdigit():
+        digits += char
+        continue
+      if char == "S":
         # Nested struct. Record the index in our struct it should go into.
-        index = CalcNumElements(fmt[:i])
-        _nested[index] = substructs[laststructindex]
+        _nested[fieldindex] = substructs[laststructindex]
         laststructindex += 1
-        _format += "%ds" % len(_nested[index])
-      elif fmt[i] == "A":
-        # Null-terminated ASCII string. Remove digits before the A, so we don't
-        # call CalcNumElements on an (invalid) format that ends with a digit.
-        start = i
-        while start > 0 and fmt[start - 1].isdigit(): start -= 1
-        index = CalcNumElements(fmt[:start])
-        _asciiz.add(index)
-        _format += "s"
+        _format += "%ds" % len(_nested[fieldindex])
+        fieldindex += 1
+      elif char == "A":
+        # Null-terminated ASCII string.
+        _asciiz.add(fieldindex)
+        _format += digits + "s"
+        fieldindex += 1
       else:
         # Standard struct format character.
-        _format += fmt[i]
-
-    _length = CalcSize(_format)
-
-    offset_list = [0]
-    last_offset = 0
-    for i in range(len(_format)):
-      offset = CalcSize(_format[:i])
-      if offset > last_offset:
-        last_offset = offset
-        offset_list.append(offset)
-
+        _format += digits + char
+        if char in "sp":
+          fieldindex += 1
+        elif char not in "x@=<>!" and not char.isspace():
+          fieldindex += int(digits) if digits else 1
+      digits = ""
+
+    # Compiled codec for the whole struct. All parsing and packing goes through
+    # this, so the hot path never has to interpret the format string.
+    _struct = struct.Struct(_format)
+    _length = _struct.size
+    # (index, struct type) pairs for the nested struct fields, in field order.
+    _nested_fields = sorted(_nested.items())
+
+    # (offset, struct module format) pairs for each field, in field order.
+    _layout = _FieldLayout(_format)
     # A dictionary that maps field names to their offsets in the struct.
-    _offsets = dict(list(zip(_fieldnames, offset_list)))
+    _offsets = dict(zip(_fieldnames, [offset for offset, _ in _layout]))
 
     # Check that the number of field names matches the number of fields.
-    numfields = len(struct.unpack(_format, b"\x00" * _length))
+    numfields = len(_struct.unpack(b"\x00" * _length))
     if len(_fieldnames) != numfields:
       raise ValueError("Invalid cstruct: \"%s\" has %d elements, \"%s\" has %d."
                        % (fmt, numfields, fieldnames, len(_fieldnames)))
 
     def _SetValues(self, values):
-      # Replace self._values with the given list. We can't do direct assignment
-      # because of the __setattr__ overload on this class.
-      super(CStruct, self).__setattr__("_values", list(values))
-
-    def _Parse(self, data):
-      data = data[:self._length]
-      values = list(struct.unpack(self._format, data))
-      for index, value in enumerate(values):
-        if isinstance(value, bytes) and index in self._nested:
-          values[index] = self._nested[index](value)
-      self._SetValues(values)
+      # values may be as returned by unpacking _format. Nested structs are then
+      # bytes, and are decoded when they are first accessed.
+      self._values = list(values)
+
+    def _DecodeNested(self):
+      for index, _ in self._nested_fields:
+        getattr(self, self._fieldnames[index])
+
+    def _Parse(self, data, offset=0):
+      self._SetValues(self._struct.unpack_from(data, offset))
 
     def __init__(self, tuple_or_bytes=None, **kwargs):
       """Construct an instance of this Struct.
@@ -190,7 +373,8 @@ def Struct(name, fmt, fieldnames, substructs={}):
       1. With no args, the whole struct is zero-initialized.
       2. With keyword args, the matching fields are populated; rest are zeroed.
       3. With one tuple as the arg, the fields are assigned based on position.
-      4. With one bytes arg, the Struct is parsed from bytes.
+      4. With one bytes arg, the Struct is parsed from bytes. The arg may also
+         be a bytearray or memoryview.
       """
       if tuple_or_bytes and kwargs:
         raise TypeError(
@@ -202,11 +386,9 @@ def Struct(name, fmt, fieldnames, substructs={}):
         # If any keywords were supplied, set those fields.
         for k, v in kwargs.items():
           setattr(self, k, v)
-      elif isinstance(tuple_or_bytes, bytes):
+      elif isinstance(tuple_or_bytes, (bytes, bytearray, memoryview)):
         # Initializing from bytes.
-        if len(tuple_or_bytes) < self._length:
-          raise TypeError("%s requires a bytes object of length %d, got %d" %
-                          (self._name, self._length, len(tuple_or_bytes)))
+        self._CheckLength(tuple_or_bytes, 0)
         self._Parse(tuple_or_bytes)
       else:
         # Initializing from a tuple.
@@ -217,25 +399,45 @@ def Struct(name, fmt, fieldnames, substructs={}):
                            ", ".join(str(x) for x in tuple_or_bytes)))
         self._SetValues(tuple_or_bytes)
 
-    def _FieldIndex(self, attr):
-      try:
-        return self._fieldnames.index(attr)
-      except ValueError:
-        raise AttributeError("'%s' has no attribute '%s'" %
-                             (self._name, attr))
+    @classmethod
+    def _CheckLength(cls, data, offset):
+      if len(data) - offset < cls._length:
+        raise TypeError("%s requires a bytes object of length %d, got %d" %
+                        (cls._name, cls._length, len(data) - offset))
 
-    def __getattr__(self, name):
-      return self._values[self._FieldIndex(name)]
+    @classmethod
+    def ReadFrom(cls, data, offset=0):
+      """Parses an instance of this Struct at the given offset into data.
+
+      Unlike Read, this never copies the rest of the buffer, so it can be
+      called in a loop over a large buffer in linear time.
+
+      Args:
+        data: A bytes, bytearray or memoryview object.
+        offset: The offset into data at which the struct starts.
+
+      Returns:
+        A tuple of the parsed struct and the offset just past it.
+      """
+      cls._CheckLength(data, offset)
+      obj = cls.__new__(cls)
+      obj._Parse(data, offset)
+      return obj, offset + cls._length
 
-    def __setattr__(self, name, value):
-      # TODO: check value type against self._format and throw here, or else
-      # callers get an unhelpful exception when they call Pack().
-      self._values[self._FieldIndex(name)] = value
+    def __getattr__(self, name):
+      # Only called if name is not a field, since fields are properties.
+      raise AttributeError("'%s' has no attribute '%s'" % (self._name, name))
 
-    def offset(self, name):
+    @classmethod
+    def offset(cls, name):
+      """Returns the offset of a field, e.g., "nest1" or "nest1.int2"."""
       if "." in name:
-        raise NotImplementedError("offset() on nested field")
-      return self._offsets[name]
+        name, rest = name.split(".", 1)
+        index = cls._fieldnames.index(name) if name in cls._offsets else -1
+        if index not in cls._nested:
+          raise KeyError(name)
+        return cls._offsets[name] + cls._nested[index].offset(rest)
+      return cls._offsets[name]
 
     @classmethod
     def __len__(cls):
@@ -245,10 +447,14 @@ def Struct(name, fmt, fieldnames, substructs={}):
       return not self.__eq__(other)
 
     def __eq__(self, other):
-      return (isinstance(other, self.__class__) and
+      if not (isinstance(other, self.__class__) and
               self._name == other._name and
-              self._fieldnames == other._fieldnames and
-              self._values == other._values)
+              self._fieldnames == other._fieldnames):
+        return False
+      if self._nested_fields:
+        self._DecodeNested()
+        other._DecodeNested()
+      return self._values == other._values
 
     @staticmethod
     def _MaybePackStruct(value):
@@ -257,9 +463,41 @@ def Struct(name, fmt, fieldnames, substructs={}):
       else:
         return value
 
+    def _PackableValues(self):
+      # Returns _values with the nested structs replaced by their packed bytes.
+      values = self._values
+      if self._nested_fields:
+        values = list(values)
+        for index, _ in self._nested_fields:
+          values[index] = self._MaybePackStruct(values[index])
+      return values
+
     def Pack(self):
-      values = [self._MaybePackStruct(v) for v in self._values]
-      return struct.pack(self._format, *values)
+      values = self._PackableValues()
+      try:
+        return self._struct.pack(*values)
+      except struct.error:
+        # A struct was assigned to a field not declared as nested.
+        return self._struct.pack(*[self._MaybePackStruct(v) for v in values])
+
+    def PackInto(self, buf, offset=0):
+      """Packs this struct into a writable buffer, such as a bytearray.
+
+      Args:
+        buf: The buffer to write to. Must have room for the struct at offset.
+        offset: The offset into buf at which to write the struct.
+
+      Returns:
+        The offset just past the packed struct.
+      """
+      values = self._PackableValues()
+      try:
+        self._struct.pack_into(buf, offset, *values)
+      except struct.error:
+        # A struct was assigned to a field not declared as nested.
+        self._struct.pack_into(buf, offset,
+                               *[self._MaybePackStruct(v) for v in values])
+      return offset + self._length
 
     def __str__(self):
 
@@ -279,6 +517,7 @@ def Struct(name, fmt, fieldnames, substructs={}):
             value = binascii.hexlify(value).decode()
         return "%s=%s" % (name, str(value))
 
+      self._DecodeNested()
       descriptions = [
           FieldDesc(i, n, v) for i, (n, v) in
           enumerate(zip(self._fieldnames, self._values))]
@@ -288,16 +527,316 @@ def Struct(name, fmt, fieldnames, substructs={}):
     def __repr__(self):
       return str(self)
 
+    @classmethod
+    def CType(cls):
+      """Returns a ctypes structure type with the same layout as this struct.
+
+      Fields have the same names and offsets. Pad bytes become fields whose
+      names start with an underscore. String fields, and nested structs with a
+      different byte order, are byte arrays.
+      """
+      if cls._ctype is None:
+        order = cls._format[0] if cls._format[:1] in _CTYPES_BASES else "@"
+        base = _CTYPES_BASES[order]
+        fields = []
+        end = 0
+        for index, (fieldname, (offset, fieldfmt)) in enumerate(
+            zip(cls._fieldnames, cls._layout)):
+          if offset > end:
+            fields.append(("_pad%d" % end, ctypes.c_ubyte * (offset - end)))
+          nested_type = cls._nested.get(index)
+          if (nested_type is not None and
+              issubclass(nested_type.CType(), base)):
+            fields.append((fieldname, nested_type.CType()))
+          else:
+            fields.append((fieldname, _CTypeForField(fieldfmt)))
+          end = offset + struct.calcsize(fieldfmt)
+        if cls._length > end:
+          fields.append(("_pad%d" % end, ctypes.c_ubyte * (cls._length - end)))
+        # Offsets are explicit, so there is no need for ctypes to align fields.
+        cls._ctype = type(base)(cls._name, (base,),
+                                {"_pack_": 1, "_fields_": fields})
+      return cls._ctype
+
+    def CObject(self):
+      """Returns this struct's ctypes object, as returned by CType().
+
+      The object is created and filled in the first time this is called. After
+      that, it is only updated by CPointer(), and by any C code that writes to
+      it. So once a syscall has written a result to CPointer(), the result can
+      be read from here without copying or parsing, or copied into the fields
+      with ReadCObject().
+      """
+      try:
+        return self._buffer
+      except AttributeError:
+        self._buffer = self.CType()()
+        self._packed = self.Pack()
+        ctypes.memmove(ctypes.addressof(self._buffer), self._packed,
+                       len(self._packed))
+        return self._buffer
+
     def CPointer(self):
-      """Returns a C pointer to the serialized structure."""
-      buf = ctypes.create_string_buffer(self.Pack())
-      # Store the C buffer in the object so it doesn't get garbage collected.
-      super(CStruct, self).__setattr__("_buffer", buf)
-      return ctypes.addressof(self._buffer)
+      """Returns a C pointer to the serialized structure.
+
+      The pointer is to the object returned by CObject(), so it is the same
+      every time, and stays valid as long as this struct does. The fields are
+      only packed into it if they have changed since they were last packed or
+      read back, so anything C code wrote through an earlier pointer is kept.
+      If both sides have changed, the fields win.
+      """
+      obj = self.CObject()
+      data = self.Pack()
+      if data != self._packed:
+        ctypes.memmove(ctypes.addressof(obj), data, len(data))
+        self._packed = data
+      return ctypes.addressof(obj)
+
+    def ReadCObject(self):
+      """Updates the fields from CObject(), e.g., after a syscall wrote to it."""
+      data = bytes(self.CObject())
+      self._Parse(data)
+      self._packed = data
+
+  # Give each field a property so that attribute access is a constant-time
+  # index into _values. This also overrides any class attributes left over
+  # from parsing the format above that happen to share a name with a field.
+  # TODO: check value type against _format in the setter and throw there, or
+  # else callers get an unhelpful exception when they call Pack().
+  seen = set()
+  for index, fieldname in enumerate(CStruct._fieldnames):
+    # If a name is used more than once, it refers to the first such field.
+    if fieldname in seen:
+      continue
+    seen.add(fieldname)
+    if index in CStruct._nested:
+      prop = _NestedFieldProperty(index, CStruct._nested[index])
+    else:
+      prop = _FieldProperty(index)
+    setattr(CStruct, fieldname, prop)
+
+  # The ctypes mirror of this struct, created by CType() on first use.
+  CStruct._ctype = None
+
+  # Maps field names to (offset, codec, nested struct type or None) tuples.
+  # Used by StructView to read and write one field at a time. Like attribute
+  # access, a name that is used more than once refers to the first field.
+  CStruct._view_fields = {}
+  for index, (fieldname, (offset, fieldfmt)) in enumerate(
+      zip(CStruct._fieldnames, CStruct._layout)):
+    CStruct._view_fields.setdefault(
+        fieldname,
+        (offset, struct.Struct(fieldfmt), CStruct._nested.get(index)))
+
+  _struct_cache[key] = CStruct
 
   return CStruct
 
 
 def Read(data, struct_type):
-  length = len(struct_type)
-  return struct_type(data), data[length:]
+  """Parses a struct_type from the start of data.
+
+  Returns the struct and a copy of the remainder of data. Prefer ReadFrom when
+  reading many structs from one buffer.
+  """
+  obj, offset = struct_type.ReadFrom(data)
+  return obj, data[offset:]
+
+
+
+class PackBuffer(object):
+  """A growable buffer that messages are serialized into in place.
+
+  Building a message by concatenating bytes objects copies everything written
+  so far every time something is appended. A PackBuffer instead appends to one
+  bytearray, which grows in amortized constant time. It supports reserving
+  space and filling it in later, e.g., for a header whose length field is only
+  known once the whole message has been written.
+  """
+
+  def __init__(self):
+    self._buf = bytearray()
+
+  def __len__(self):
+    return len(self._buf)
+
+  def Reserve(self, length):
+    """Appends length zero bytes and returns the offset they start at."""
+    offset = len(self._buf)
+    self._buf += bytes(length)
+    return offset
+
+  def Append(self, value):
+    """Appends a struct or a bytes-like object.
+
+    Returns:
+      The offset at which the value was written.
+    """
+    offset = len(self._buf)
+    if isinstance(type(value), StructMetaclass):
+      value = value.Pack()
+    self._buf += value
+    return offset
+
+  def Pad(self, alignment, start=0):
+    """Zero-pads so that (len(self) - start) is a multiple of alignment."""
+    padlen = -(len(self._buf) - start) % alignment
+    if padlen:
+      self._buf += bytes(padlen)
+
+  def PackAt(self, offset, value):
+    """Overwrites part of the buffer with a struct, e.g., a header."""
+    value.PackInto(self._buf, offset)
+
+  def View(self):
+    """Returns a memoryview of the contents, without copying.
+
+    The buffer cannot grow while the view exists, so don't keep it around.
+    """
+    return memoryview(self._buf)
+
+  def Pack(self):
+    """Returns a copy of the contents as a bytes object."""
+    return bytes(self._buf)
+
+
+class StructView(object):
+  """A struct type overlaid on a writable buffer, such as a bytearray or mmap.
+
+  Field reads and writes go straight to the buffer, so changing one field of a
+  packet or message costs one pack_into, not a parse and a Pack. Nested struct
+  fields are returned as StructViews of the same buffer.
+
+  Example:
+
+  >>> packet = bytearray(esp_packet)
+  >>> esp = cstruct.StructView(xfrm.EspHdr, packet, ip_hdr_len)
+  >>> esp.seqnum += 1
+  """
+
+  __slots__ = ("_struct_type", "_buffer", "_offset")
+
+  def __init__(self, struct_type, buf, offset=0):
+    """Constructs a StructView.
+
+    Args:
+      struct_type: The struct class to overlay.
+      buf: The buffer. Must be writable if any fields are assigned to.
+      offset: The offset into buf at which the struct starts.
+    """
+    struct_type._CheckLength(buf, offset)
+    object.__setattr__(self, "_struct_type", struct_type)
+    object.__setattr__(self, "_buffer", buf)
+    object.__setattr__(self, "_offset", offset)
+
+  def _Field(self, name):
+    try:
+      return self._struct_type._view_fields[name]
+    except KeyError:
+      raise AttributeError("'%s' has no attribute '%s'" %
+                           (self._struct_type._name, name))
+
+  def __getattr__(self, name):
+    offset, codec, nested_type = self._Field(name)
+    if nested_type is not None:
+      return StructView(nested_type, self._buffer, self._offset + offset)
+    return codec.unpack_from(self._buffer, self._offset + offset)[0]
+
+  def __setattr__(self, name, value):
+    offset, codec, _ = self._Field(name)
+    if isinstance(type(value), StructMetaclass):
+      value.PackInto(self._buffer, self._offset + offset)
+    else:
+      codec.pack_into(self._buffer, self._offset + offset, value)
+
+  def __len__(self):
+    return len(self._struct_type)
+
+  def offset(self, name):
+    """Returns the offset of a field in the struct, not in the buffer."""
+    return self._struct_type.offset(name)
+
+  def Struct(self):
+    """Returns a copy of the struct, parsed from the buffer."""
+    return self._struct_type.ReadFrom(self._buffer, self._offset)[0]
+
+  def __str__(self):
+    return str(self.Struct())
+
+  def __repr__(self):
+    return str(self)
+
+
+class StructArray(object):
+  """A packed array of structs of one type.
+
+  All the records are unpacked in a single struct.iter_unpack pass. Struct
+  objects are only created for the records that are actually accessed. Those
+  objects are kept, so changes to them are reflected by Pack().
+
+  Example:
+
+  >>> stats = cstruct.StructArray(RtnlLinkStats64, data)
+  >>> total = sum(stats.column("rx_bytes"))
+  >>> stats[0].rx_packets
+  15
+  """
+
+  def __init__(self, struct_type, records=b""):
+    """Constructs a StructArray.
+
+    Args:
+      struct_type: The struct class of the records.
+      records: Either the raw packed records, as a bytes, bytearray or
+        memoryview object, or a sequence of struct_type objects or tuples.
+
+    Raises:
+      TypeError: The raw data is not a whole number of records.
+    """
+    self._struct_type = struct_type
+    if isinstance(records, (bytes, bytearray, memoryview)):
+      length = len(struct_type)
+      if len(records) % length:
+        raise TypeError("%s array requires a multiple of %d bytes, got %d" %
+                        (struct_type._name, length, len(records)))
+      self._raw = list(struct_type._struct.iter_unpack(records))
+      self._objects = [None] * len(self._raw)
+    else:
+      self._objects = [r if isinstance(r, struct_type) else struct_type(r)
+                       for r in records]
+      self._raw = [None] * len(self._objects)
+
+  def __len__(self):
+    return len(self._raw)
+
+  def __getitem__(self, i):
+    obj = self._objects[i]
+    if obj is None:
+      obj = self._struct_type.__new__(self._struct_type)
+      obj._SetValues(self._raw[i])
+      self._objects[i] = obj
+    return obj
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def column(self, name):
+    """Returns a list of the values of the named field in every record."""
+    index = self._struct_type._fieldnames.index(name)
+    if index in self._struct_type._nested:
+      return [getattr(obj, name) for obj in self]
+    return [raw[index] if obj is None else obj._values[index]
+            for raw, obj in zip(self._raw, self._objects)]
+
+  def Pack(self):
+    """Returns the packed representation of all the records."""
+    pack = self._struct_type._struct.pack
+    return b"".join(pack(*raw) if obj is None else obj.Pack()
+                    for raw, obj in zip(self._raw, self._objects))
+
+  def __str__(self):
+    return "[%s]" % ", ".join(str(obj) for obj in self)
+
+  def __repr__(self):
+    return str(self)
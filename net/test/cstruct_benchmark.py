@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+#
+# Copyright 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmarks for the cstruct parse and pack paths.
+
+Not part of all_tests.py. Run directly, or as part of benchmarks.py:
+
+  $ ./cstruct_benchmark.py
+"""
+
+import sys
+
+import benchmarks
+import cstruct
+import iproute
+import netlink
+import sock_diag
+import xfrm
+
+
+# These aren't constants, they're classes. So, pylint: disable=invalid-name
+NLMsgHdr = netlink.NLMsgHdr
+InetDiagMsg = sock_diag.InetDiagMsg
+TcpInfo = sock_diag.TcpInfo
+XfrmUsersaInfo = xfrm.XfrmUsersaInfo
+RtnlLinkStats64 = iproute.RtnlLinkStats64
+# Same definition as bpf.BpfInsn, so the same class. Importing bpf raises
+# RLIMIT_MEMLOCK, which needs root.
+BpfInsn = cstruct.Struct("bpf_insn", "=BBhi", "code dst_src_reg off imm")
+EspHdr = xfrm.EspHdr
+# pylint: enable=invalid-name
+
+_NUMBER = 100000
+
+
+def Fixture(struct_type, count=1):
+  """Returns deterministic, non-zero bytes for count packed struct_types."""
+  return bytes((i * 131 + 7) & 0xff for i in range(count * len(struct_type)))
+
+
+def _StructBenchmarks(struct_type, field):
+  """Parse, pack and field access benchmarks for one struct type."""
+  name = struct_type._name
+  data = Fixture(struct_type)
+  obj = struct_type(data)
+  size = len(struct_type)
+
+  def SetField():
+    setattr(obj, field, 1)
+
+  yield benchmarks.Benchmark("%s parse" % name,
+                             lambda: struct_type(data), _NUMBER, size)
+  yield benchmarks.Benchmark("%s pack" % name, obj.Pack, _NUMBER, size)
+  yield benchmarks.Benchmark("%s parse and pack" % name,
+                             lambda: struct_type(data).Pack(), _NUMBER, size)
+  yield benchmarks.Benchmark("%s getattr %s" % (name, field),
+                             lambda: getattr(obj, field), _NUMBER)
+  yield benchmarks.Benchmark("%s setattr %s" % (name, field), SetField,
+                             _NUMBER)
+
+
+def Benchmarks():
+  """Yields the cstruct benchmarks."""
+  for struct_type, field in [(NLMsgHdr, "seq"),
+                             (InetDiagMsg, "state"),
+                             (TcpInfo, "total_retrans"),
+                             (XfrmUsersaInfo, "reqid"),
+                             (RtnlLinkStats64, "rx_bytes"),
+                             (BpfInsn, "imm")]:
+    for benchmark in _StructBenchmarks(struct_type, field):
+      yield benchmark
+
+  yield benchmarks.Benchmark("NLMsgHdr zero-init", NLMsgHdr, _NUMBER)
+
+  # Nested structs are decoded lazily, so this costs more than reading state.
+  diag_bytes = Fixture(InetDiagMsg)
+  yield benchmarks.Benchmark("InetDiagMsg parse, read id.dport",
+                             lambda: InetDiagMsg(diag_bytes).id.dport,
+                             _NUMBER, len(diag_bytes))
+  sa_bytes = Fixture(XfrmUsersaInfo)
+  yield benchmarks.Benchmark("XfrmUsersaInfo parse, read id.spi",
+                             lambda: XfrmUsersaInfo(sa_bytes).id.spi,
+                             _NUMBER, len(sa_bytes))
+
+  # Walk a 64 KiB buffer of headers.
+  buf = Fixture(NLMsgHdr, 65536 // len(NLMsgHdr))
+
+  def ReadLoop():
+    data = buf
+    while data:
+      _, data = cstruct.Read(data, NLMsgHdr)
+
+  def ReadFromLoop():
+    offset = 0
+    while offset < len(buf):
+      _, offset = NLMsgHdr.ReadFrom(buf, offset)
+
+  yield benchmarks.Benchmark("64 KiB NLMsgHdrs, Read loop", ReadLoop, 20,
+                             len(buf))
+  yield benchmarks.Benchmark("64 KiB NLMsgHdrs, ReadFrom loop", ReadFromLoop,
+                             20, len(buf))
+
+  # Sum one field across 1000 records.
+  infos = Fixture(TcpInfo, 1000)
+
+  def ReadFromSum():
+    offset, total = 0, 0
+    while offset < len(infos):
+      info, offset = TcpInfo.ReadFrom(infos, offset)
+      total += info.rtt
+    return total
+
+  def StructArraySum():
+    return sum(cstruct.StructArray(TcpInfo, infos).column("rtt"))
+
+  yield benchmarks.Benchmark("1000 TcpInfo, ReadFrom sum", ReadFromSum, 100,
+                             len(infos))
+  yield benchmarks.Benchmark("1000 TcpInfo, StructArray sum", StructArraySum,
+                             100, len(infos))
+
+  # Change one field of a header at the start of a packet.
+  packet = bytearray(EspHdr((1234, 1)).Pack() + b"\x00" * 1400)
+
+  def ParseAndPack():
+    esp = EspHdr(packet[:len(EspHdr)])
+    esp.seqnum = 2
+    packet[:len(EspHdr)] = esp.Pack()
+
+  esp_view = cstruct.StructView(EspHdr, packet)
+
+  def SetViewField():
+    esp_view.seqnum = 2
+
+  yield benchmarks.Benchmark("EspHdr seqnum, parse and pack", ParseAndPack,
+                             _NUMBER)
+  yield benchmarks.Benchmark("EspHdr seqnum, StructView", SetViewField,
+                             _NUMBER)
+
+  # Use a different name, so as not to evict the real TcpInfo from the cache.
+  definition = ("TcpInfoCopy", TcpInfo._format, " ".join(TcpInfo._fieldnames))
+
+  def DefineTcpInfo():
+    cstruct._struct_cache.pop(definition + ((),), None)
+    cstruct.Struct(*definition)
+
+  yield benchmarks.Benchmark("TcpInfo definition", DefineTcpInfo, 1000)
+  yield benchmarks.Benchmark("TcpInfo definition, cached",
+                             lambda: cstruct.Struct(*definition), 1000)
+
+  yield benchmarks.Benchmark("NLMsgHdr CPointer", NLMsgHdr().CPointer,
+                             _NUMBER)
+
+
+if __name__ == "__main__":
+  sys.exit(benchmarks.Main(sys.argv[1:], Benchmarks()))
@@ -15,6 +15,8 @@
 # limitations under the License.
 
 import binascii
+import ctypes
+import struct
 import unittest
 
 import cstruct
@@ -151,15 +153,20 @@ class CstructTest(unittest.TestCase):
     t = TestStruct((2, nullstr, 12345, nullstr, 33210))
     self.assertEqual(0, t.offset("byte1"))
     self.assertEqual(1, t.offset("string2"))  # sizeof(byte)
-    self.assertEqual(17, t.offset("int3"))    # sizeof(byte) + 16*sizeof(char)
     # The integer is automatically padded by the struct module
     # to match native alignment.
+    # offset = sizeof(byte) + 16*sizeof(char) + padding
+    self.assertEqual(20, t.offset("int3"))
     # offset = sizeof(byte) + 16*sizeof(char) + padding + sizeof(int)
     self.assertEqual(24, t.offset("ascii4"))
     self.assertEqual(40, t.offset("word5"))
     self.assertRaises(KeyError, t.offset, "random")
 
-    # TODO: Add support for nested struct offset
+    # Pad bytes.
+    Padded = cstruct.Struct("Padded", "=BxxxiHBxB", "byte1 int2 word3 b4 b5")
+    self.assertEqual([0, 4, 8, 10, 12],
+                     [Padded.offset(n) for n in Padded._fieldnames])
+
     Nested = cstruct.Struct("Nested", "!HSSi", "word1 nest2 nest3 int4",
                             [TestStructA, TestStructB])
     DoubleNested = cstruct.Struct("DoubleNested", "SSB", "nest1 nest2 byte3",
@@ -171,6 +178,229 @@ class CstructTest(unittest.TestCase):
     self.assertEqual(len(TestStructA) + len(Nested), d.offset("byte3"))
     self.assertRaises(KeyError, t.offset, "word1")
 
+    # Nested fields.
+    self.assertEqual(len(TestStructA) + 2 + len(TestStructA) + 1,
+                     d.offset("nest2.nest3.int2"))
+    self.assertEqual(1, DoubleNested.offset("nest1.int2"))
+    self.assertRaises(KeyError, d.offset, "byte3.int2")
+    self.assertRaises(KeyError, d.offset, "nest2.random")
+
+  def testFieldLayout(self):
+    for fmt in ["=BIxH3B", "B16si16sH", "@bxq2?hd", "!4sHQ", "<f3xi2s"]:
+      values = struct.unpack(fmt, bytes(range(struct.calcsize(fmt))))
+      layout = cstruct._FieldLayout(fmt)
+      self.assertEqual(len(values), len(layout))
+      data = bytes(range(struct.calcsize(fmt)))
+      for value, (offset, fieldfmt) in zip(values, layout):
+        self.assertEqual(value, struct.unpack_from(fieldfmt, data, offset)[0])
+
+  def testStructView(self):
+    Nested = cstruct.Struct("Nested", "!HSi", "word1 nest2 int3", [TestStructA])
+    n = Nested((1, TestStructA((2, 3)), 4))
+    buf = bytearray(b"\xff" + n.Pack())
+
+    v = cstruct.StructView(Nested, buf, 1)
+    self.assertEqual(len(Nested), len(v))
+    self.assertEqual(1, v.word1)
+    self.assertEqual(4, v.int3)
+    self.assertEqual(3, v.nest2.int2)
+    self.assertEqual(n, v.Struct())
+    self.assertEqual(str(n), str(v))
+
+    # Writes go straight to the buffer.
+    v.int3 = -5
+    v.nest2.byte1 = 6
+    n.int3 = -5
+    n.nest2.byte1 = 6
+    self.assertEqual(b"\xff" + n.Pack(), buf)
+    v.nest2 = TestStructA((7, 8))
+    self.assertEqual(TestStructA((7, 8)), v.nest2.Struct())
+    self.assertEqual(8, Nested(buf[1:]).nest2.int2)
+
+    with self.assertRaises(AttributeError):
+      v.nonexistent  # pylint: disable=pointless-statement
+    with self.assertRaises(AttributeError):
+      v.nonexistent = 1
+    self.assertRaises(TypeError, cstruct.StructView, Nested, buf, 2)
+
+  def testFieldAccess(self):
+    Nested = cstruct.Struct("Nested", "=SII", "nest1 index int3", [TestStructA])
+    n = Nested((TestStructA((1, 2)), 3, 4))
+    # A field whose name clashes with a variable used while parsing the format.
+    self.assertEqual(3, n.index)
+    n.index = 5
+    self.assertEqual(5, n.index)
+    self.assertEqual(TestStructA((1, 2)), n.nest1)
+
+    with self.assertRaises(AttributeError):
+      n.nonexistent  # pylint: disable=pointless-statement
+    with self.assertRaises(AttributeError):
+      n.nonexistent = 1
+    self.assertFalse(hasattr(n, "__dict__"))
+
+    # If a field name is used twice, it refers to the first field.
+    Padded = cstruct.Struct("Padded", "=BHB", "pad value pad")
+    p = Padded((1, 2, 3))
+    self.assertEqual(1, p.pad)
+    p.pad = 4
+    self.assertEqual(Padded((4, 2, 3)), p)
+    self.assertEqual(4, cstruct.StructView(Padded, bytearray(p.Pack())).pad)
+
+  def testLazyNestedStructs(self):
+    Nested = cstruct.Struct("Nested", "=HSi", "word1 nest2 int3", [TestStructA])
+    data = Nested((1, TestStructA((2, 3)), 4)).Pack()
+
+    # Nested structs are kept as raw bytes until they are accessed.
+    n = Nested(data)
+    self.assertEqual(TestStructA((2, 3)).Pack(), n._values[1])
+    self.assertEqual(data, n.Pack())
+    self.assertEqual(1, n.word1)
+    self.assertEqual(TestStructA((2, 3)), n.nest2)
+    self.assertIsInstance(n._values[1], TestStructA)
+
+    # Changes to an accessed nested struct are packed.
+    n.nest2.byte1 = 7
+    self.assertEqual(Nested((1, TestStructA((7, 3)), 4)).Pack(), n.Pack())
+
+    # Comparison and printing don't depend on whether fields were accessed.
+    n1, n2 = Nested(data), Nested(data)
+    n2.nest2  # pylint: disable=pointless-statement
+    self.CheckEquals(n1, n2)
+    self.CheckEquals(Nested((1, TestStructA((2, 3)), 4)), Nested(data))
+    self.assertEqual(str(n2), str(Nested(data)))
+    self.CheckNotEquals(n, Nested(data))
+
+  def testReadFrom(self):
+    data = binascii.unhexlify("ff" "0102030405" "0607080900")
+    a1 = TestStructA((1, 0x05040302))
+    a2 = TestStructA((6, 0x00090807))
+    for buf in [data, bytearray(data), memoryview(data)]:
+      a, offset = TestStructA.ReadFrom(buf, 1)
+      self.assertEqual(a1, a)
+      self.assertEqual(6, offset)
+      self.assertEqual(a2, TestStructA.ReadFrom(buf, offset)[0])
+      self.assertEqual(a1, TestStructA(buf[1:]))
+      self.assertRaises(TypeError, TestStructA.ReadFrom, buf, 7)
+
+    self.assertEqual((a1, data[6:]), cstruct.Read(data[1:], TestStructA))
+
+  def testStructArray(self):
+    Nested = cstruct.Struct("Nested", "=HSi", "word1 nest2 int3", [TestStructA])
+    records = [Nested((i, TestStructA((i + 1, i + 2)), -i)) for i in range(5)]
+    data = b"".join(r.Pack() for r in records)
+
+    a = cstruct.StructArray(Nested, data)
+    self.assertEqual(5, len(a))
+    self.assertEqual([0, 1, 2, 3, 4], a.column("word1"))
+    self.assertEqual([0, -1, -2, -3, -4], a.column("int3"))
+    self.assertEqual([r.nest2 for r in records], a.column("nest2"))
+    self.assertEqual(records[3], a[3])
+    self.assertEqual(records[4], a[-1])
+    self.assertEqual(records, list(a))
+    self.assertEqual(data, a.Pack())
+
+    # Changes to records are reflected in columns and in the packed data.
+    a[2].int3 = 99
+    a[2].nest2.byte1 = 77
+    records[2].int3 = 99
+    records[2].nest2.byte1 = 77
+    self.assertEqual(99, a.column("int3")[2])
+    self.assertEqual(b"".join(r.Pack() for r in records), a.Pack())
+
+    # Construct from a sequence of structs or tuples.
+    tuples = [(1, TestStructA((2, 3)), 4), (5, TestStructA((6, 7)), 8)]
+    a = cstruct.StructArray(Nested, tuples)
+    self.assertEqual([1, 5], a.column("word1"))
+    self.assertEqual(b"".join(Nested(t).Pack() for t in tuples), a.Pack())
+    self.assertEqual(0, len(cstruct.StructArray(Nested)))
+
+    self.assertRaises(TypeError, cstruct.StructArray, Nested, data[:-1])
+
+  def testPackInto(self):
+    Nested = cstruct.Struct("Nested", "=HSi", "word1 nest2 int3", [TestStructA])
+    n = Nested((1, TestStructA((2, 3)), -4))
+    buf = bytearray(b"\xff" * (len(Nested) + 2))
+    self.assertEqual(1 + len(Nested), n.PackInto(buf, 1))
+    self.assertEqual(b"\xff" + n.Pack() + b"\xff", buf)
+
+    b = cstruct.PackBuffer()
+    self.assertEqual(0, b.Reserve(4))
+    self.assertEqual(4, b.Append(n))
+    self.assertEqual(4 + len(Nested), b.Append(b"abc"))
+    b.Pad(4)
+    self.assertEqual(0, len(b) % 4)
+    start = b.Append(b"x")
+    b.Pad(8, start)
+    self.assertEqual(start + 8, len(b))
+    Header = cstruct.Struct("Header", "=HH", "length type")
+    b.PackAt(0, Header((len(b), 6)))
+    expected = Header((len(b), 6)).Pack() + n.Pack() + b"abc" + b"\x00" * (-(len(Nested) + 3) % 4)
+    expected += b"x" + b"\x00" * 7
+    self.assertEqual(expected, b.Pack())
+    self.assertEqual(expected, bytes(b.View()))
+
+  def testStructCache(self):
+    A = cstruct.Struct("TestStructA", "=BI", "byte1 int2")
+    self.assertIs(TestStructA, A)
+    self.assertIsNot(TestStructA, TestStructB)
+    self.assertIsNot(A, cstruct.Struct("TestStructA", "=BI", "byte1 int3"))
+    Nested = cstruct.Struct("Nested", "=SB", "nest1 byte2", [TestStructA])
+    self.assertIs(Nested,
+                  cstruct.Struct("Nested", "=SB", "nest1 byte2", (TestStructA,)))
+    self.assertIsNot(Nested,
+                     cstruct.Struct("Nested", "=SB", "nest1 byte2", [TestStructB]))
+
+  def testCType(self):
+    Nested = cstruct.Struct("Nested", "BxxxiHSs", "byte1 int2 word3 nest4 s5",
+                            [TestStructA])
+    BigEndian = cstruct.Struct("BigEndian", "!HSxI", "word1 nest2 int3",
+                               [Nested])
+    for struct_type in [TestStructA, Nested, BigEndian]:
+      ctype = struct_type.CType()
+      self.assertIs(ctype, struct_type.CType())
+      self.assertEqual(len(struct_type), ctypes.sizeof(ctype))
+      for name in struct_type._fieldnames:
+        self.assertEqual(struct_type.offset(name), getattr(ctype, name).offset)
+
+    b = BigEndian((1, Nested((2, -3, 4, TestStructA((5, 6)), b"x")), 7))
+    obj = b.CObject()
+    self.assertIsInstance(obj, ctypes.BigEndianStructure)
+    self.assertEqual(b.Pack(), bytes(obj))
+    self.assertEqual(1, obj.word1)
+    self.assertEqual(7, obj.int3)
+    # Native nested structs in a big-endian struct are raw bytes.
+    self.assertEqual(b.nest2.Pack(), bytes(obj.nest2))
+
+    n = Nested((2, -3, 4, TestStructA((5, 6)), b"x"))
+    self.assertEqual(-3, n.CObject().int2)
+    self.assertEqual(6, n.CObject().nest4.int2)
+
+    # CPointer points to the same object every time, with updated values.
+    ptr = n.CPointer()
+    self.assertEqual(ctypes.addressof(n.CObject()), ptr)
+    n.int2 = 99
+    self.assertEqual(ptr, n.CPointer())
+    self.assertEqual(99, n.CObject().int2)
+
+    # Anything written to the pointer can be read back from CObject(), and is
+    # not overwritten by the next CPointer() if the fields haven't changed.
+    ctypes.c_int.from_address(ptr + Nested.offset("int2")).value = 1234
+    self.assertEqual(1234, n.CObject().int2)
+    self.assertEqual(ptr, n.CPointer())
+    self.assertEqual(1234, n.CObject().int2)
+    self.assertEqual(99, n.int2)
+
+    # ReadCObject copies it into the fields.
+    n.ReadCObject()
+    self.assertEqual(1234, n.int2)
+    self.assertEqual(6, n.nest4.int2)
+
+    # Fields changed in Python are packed again.
+    n.word3 = 7
+    n.CPointer()
+    self.assertEqual(7, n.CObject().word3)
+    self.assertEqual(1234, n.CObject().int2)
+
   def testDefinitionFieldMismatch(self):
     cstruct.Struct("TestA", "=BI", "byte1 int2")
     cstruct.Struct("TestA", "=BxxxxxIx", "byte1 int2")
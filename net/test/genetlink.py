@@ -58,8 +58,10 @@ class GenericNetlink(netlink.NetlinkSocket):
     super(GenericNetlink, self).__init__(netlink.NETLINK_GENERIC)
 
   def _SendCommand(self, family, command, version, data, flags):
-    genlmsghdr = Genlmsghdr((command, version))
-    self._SendNlRequest(family, genlmsghdr.Pack() + data, flags)
+    msg = self._NlRequestBuffer()
+    msg.Append(Genlmsghdr((command, version)))
+    msg.Append(data)
+    self._SendNlRequest(family, msg, flags)
 
   def _Dump(self, family, command, version):
     msg = Genlmsghdr((command, version))
@@ -72,20 +74,30 @@ class GenericNetlinkControl(GenericNetlink):
   This interface is used to manage other generic netlink families. We currently
   use it only to find the family ID for address families of interest."""
 
+  ATTRIBUTES = {
+      "CTRL_ATTR_FAMILY_ID": netlink.U16,
+      "CTRL_ATTR_FAMILY_NAME": netlink.String,
+      "CTRL_ATTR_VERSION": netlink.U32,
+      "CTRL_ATTR_HDRSIZE": netlink.U32,
+      "CTRL_ATTR_MAXATTR": netlink.U32,
+      "CTRL_ATTR_OPS": netlink.Method("_DecodeOps"),
+  }
+
   def _DecodeOps(self, data):
     ops = []
     Op = collections.namedtuple("Op", ["id", "flags"])
     # TODO: call _ParseAttributes on the nested data instead of manual parsing.
-    while data:
+    offset = 0
+    while offset < len(data):
       # Skip the nest marker.
-      datalen, index, data = data[:2], data[2:4], data[4:]
+      offset += len(netlink.NLAttr)
 
-      nla, nla_data, data = self._ReadNlAttr(data)
+      nla, nla_data, offset = self._ReadNlAttr(data, offset)
       if nla.nla_type != CTRL_ATTR_OP_ID:
         raise ValueError("Expected CTRL_ATTR_OP_ID, got %d" % nla.nla_type)
       op_id = struct.unpack("=I", nla_data)[0]
 
-      nla, nla_data, data = self._ReadNlAttr(data)
+      nla, nla_data, offset = self._ReadNlAttr(data, offset)
       if nla.nla_type != CTRL_ATTR_OP_FLAGS:
         raise ValueError("Expected CTRL_ATTR_OP_FLAGS, got %d" % nla.type)
       op_flags = struct.unpack("=I", nla_data)[0]
@@ -93,23 +105,8 @@ class GenericNetlinkControl(GenericNetlink):
       ops.append(Op(op_id, op_flags))
     return ops
 
-  def _Decode(self, command, msg, nla_type, nla_data, nested):
-    """Decodes generic netlink control attributes to human-readable format."""
-
-    name = self._GetConstantName(__name__, nla_type, "CTRL_ATTR_")
-
-    if name == "CTRL_ATTR_FAMILY_ID":
-      data = struct.unpack("=H", nla_data)[0]
-    elif name == "CTRL_ATTR_FAMILY_NAME":
-      data = nla_data.strip(b"\x00")
-    elif name in ["CTRL_ATTR_VERSION", "CTRL_ATTR_HDRSIZE", "CTRL_ATTR_MAXATTR"]:
-      data = struct.unpack("=I", nla_data)[0]
-    elif name == "CTRL_ATTR_OPS":
-      data = self._DecodeOps(nla_data)
-    else:
-      data = nla_data
-
-    return name, data
+  def _DecodeName(self, command, msg, nla_type, nested):
+    return self._GetConstantName(__name__, nla_type, "CTRL_ATTR_")
 
   def GetFamily(self, name):
     """Returns the family ID for the specified family name."""
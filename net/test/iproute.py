@@ -22,15 +22,17 @@ from socket import AF_INET
 from socket import AF_INET6
 
 import binascii
+import collections
+import concurrent.futures
 import errno
 import os
+import queue
 import socket
-import struct
 
-import net_test
 import csocket
 import cstruct
 import netlink
+import netlink_monitor
 
 ### rtnetlink constants. See include/uapi/linux/rtnetlink.h.
 # Message types.
@@ -86,7 +88,15 @@ RTA_PREF = 20
 RTA_UID = 25
 
 # Netlink groups.
+RTMGRP_LINK = 1
+RTMGRP_NEIGH = 4
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV4_RULE = 0x80
 RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+RTNLGRP_IPV6_RULE = 19
+RTMGRP_IPV6_RULE = (1 << (RTNLGRP_IPV6_RULE - 1))  # Not a kernel constant
 RTNLGRP_ND_USEROPT = 20
 RTMGRP_ND_USEROPT = (1 << (RTNLGRP_ND_USEROPT - 1))  # Not a kernel constant
 
@@ -248,6 +258,24 @@ def CommandSubject(command):
   return ["LINK", "ADDR", "ROUTE", "NEIGH", "RULE"][(command - 16) // 4]
 
 
+# The struct that follows the netlink header, for each command subject.
+_SUBJECT_STRUCTS = {
+    "ADDR": IfAddrMsg,
+    "LINK": IfinfoMsg,
+    "NEIGH": NdMsg,
+    "ROUTE": RTMsg,
+    "RULE": RTMsg,
+}
+
+
+def CommandStruct(command):
+  """Returns the struct that follows the netlink header, or None if unknown."""
+  try:
+    return _SUBJECT_STRUCTS.get(CommandSubject(command))
+  except IndexError:
+    return None
+
+
 def CommandName(command):
   try:
     return "RTM_%s%s" % (CommandVerb(command), CommandSubject(command))
@@ -255,6 +283,92 @@ def CommandName(command):
     return "RTM_%d" % command
 
 
+def _IgnoreErrno(iterator, error):
+  """Yields from iterator, and stops if it raises the specified errno."""
+  try:
+    yield from iterator
+  except IOError as e:
+    if e.errno != error:
+      raise
+
+
+class NetworkState(object):
+  """An indexed snapshot of the rtnetlink state. Returned by IPRoute.Snapshot.
+
+  Each entry is a (msg, attrs) tuple, as returned by the dump methods.
+
+  Attributes:
+    links: The links.
+    addresses: The IPv4 and IPv6 addresses.
+    routes: The IPv4 and IPv6 routes, in all tables.
+    rules: The IPv4 and IPv6 rules.
+    neighbours: The IPv4 and IPv6 neighbour cache entries.
+  """
+
+  def __init__(self, links, addresses, routes, rules, neighbours):
+    self.links = links
+    self.addresses = addresses
+    self.routes = routes
+    self.rules = rules
+    self.neighbours = neighbours
+
+    self._links = {msg.index: (msg, attrs) for msg, attrs in links}
+    self._addresses = collections.defaultdict(list)
+    for msg, attrs in addresses:
+      self._addresses[msg.index].append((msg, attrs))
+    self._neighbours = collections.defaultdict(list)
+    for msg, attrs in neighbours:
+      self._neighbours[msg.ifindex].append((msg, attrs))
+    self._tables = collections.defaultdict(list)
+    self._prefixes = collections.defaultdict(list)
+    for msg, attrs in routes:
+      self._tables[attrs.get("RTA_TABLE", msg.table)].append((msg, attrs))
+      self._prefixes[self._RouteKey(msg, attrs)].append((msg, attrs))
+
+  @staticmethod
+  def _RouteKey(msg, attrs):
+    dst = attrs.get("RTA_DST")
+    if dst is None:
+      dst = {AF_INET: "0.0.0.0", AF_INET6: "::"}.get(msg.family)
+    return (msg.family, dst, msg.dst_len)
+
+  def Link(self, ifindex):
+    """Returns the link with the specified ifindex, or None."""
+    return self._links.get(ifindex)
+
+  def Addresses(self, ifindex):
+    """Returns the addresses on the specified interface."""
+    return list(self._addresses.get(ifindex, []))
+
+  def Neighbours(self, ifindex):
+    """Returns the neighbour cache entries on the specified interface."""
+    return list(self._neighbours.get(ifindex, []))
+
+  def Routes(self, table):
+    """Returns the IPv4 and IPv6 routes in the specified table."""
+    return list(self._tables.get(table, []))
+
+  def RoutesTo(self, prefix):
+    """Returns the routes to a prefix, in all tables.
+
+    Args:
+      prefix: A string, e.g., "192.0.2.0/24", "2001:db8::/64" or "::/0".
+
+    Returns:
+      A list of (RTMsg, attrs) tuples.
+    """
+    address, prefixlen = prefix.split("/")
+    family = {4: AF_INET, 6: AF_INET6}[csocket.AddressVersion(address)]
+    # Normalize the address, e.g., "2001:db8:0::" to "2001:db8::".
+    address = socket.inet_ntop(family, socket.inet_pton(family, address))
+    return list(self._prefixes.get((family, address, int(prefixlen)), []))
+
+  def Rules(self, table):
+    """Returns the IPv4 and IPv6 rules that look up the specified table."""
+    return [(msg, attrs) for msg, attrs in self.rules
+            if attrs.get("FRA_TABLE", msg.table) == table]
+
+
 class IPRoute(netlink.NetlinkSocket):
   """Provides a tiny subset of iproute functionality."""
 
@@ -264,99 +378,132 @@ class IPRoute(netlink.NetlinkSocket):
   def _GetConstantName(self, value, prefix):
     return super(IPRoute, self)._GetConstantName(__name__, value, prefix)
 
-  def _Decode(self, command, msg, nla_type, nla_data, nested):
-    """Decodes netlink attributes to Python types.
+  def _CommandName(self, command):
+    if command < RTM_NEWLINK:
+      return super(IPRoute, self)._CommandName(command)
+    return CommandName(command)
+
+  # The prefix of the attribute names inside each nested attribute.
+  NESTED_PREFIXES = {
+      "RTA_METRICS": "RTAX_",
+      "IFLA_LINKINFO": "IFLA_INFO_",
+      "IFLA_INFO_DATA": "IFLA_VTI_",
+  }
+
+  # The prefix of the top-level attribute names of each command subject.
+  COMMAND_PREFIXES = {
+      "ADDR": "IFA_",
+      "LINK": "IFLA_",
+      "RULE": "FRA_",
+      "ROUTE": "RTA_",
+      "NEIGH": "NDA_",
+  }
+
+  ATTRIBUTES = {
+      "FRA_PRIORITY": netlink.U32,
+      "FRA_FWMARK": netlink.U32,
+      "FRA_TABLE": netlink.U32,
+      "FRA_FWMASK": netlink.U32,
+      "FRA_SUPPRESS_PREFIXLEN": netlink.S32,
+      "FRA_IIFNAME": netlink.String,
+      "FRA_OIFNAME": netlink.String,
+      "FRA_UID_RANGE": netlink.Struct(FibRuleUidRange),
+      "RTA_OIF": netlink.U32,
+      "RTA_PRIORITY": netlink.U32,
+      "RTA_TABLE": netlink.U32,
+      "RTA_MARK": netlink.U32,
+      "RTA_UID": netlink.U32,
+      "RTA_DST": netlink.Address,
+      "RTA_SRC": netlink.Address,
+      "RTA_GATEWAY": netlink.Address,
+      "RTA_PREFSRC": netlink.Address,
+      "RTA_METRICS": netlink.Nested,
+      "RTA_CACHEINFO": netlink.Struct(RTACacheinfo),
+      "RTAX_MTU": netlink.U32,
+      "RTAX_HOPLIMIT": netlink.U32,
+      "IFA_ADDRESS": netlink.Address,
+      "IFA_LOCAL": netlink.Address,
+      "IFA_LABEL": netlink.String,
+      "IFA_CACHEINFO": netlink.Struct(IFACacheinfo),
+      "IFLA_MTU": netlink.U32,
+      "IFLA_TXQLEN": netlink.U32,
+      "IFLA_GROUP": netlink.U32,
+      "IFLA_EXT_MASK": netlink.U32,
+      "IFLA_PROMISCUITY": netlink.U32,
+      "IFLA_NUM_RX_QUEUES": netlink.U32,
+      "IFLA_NUM_TX_QUEUES": netlink.U32,
+      "IFLA_CARRIER_CHANGES": netlink.U32,
+      "IFLA_GSO_MAX_SEGS": netlink.U32,
+      "IFLA_GSO_MAX_SIZE": netlink.U32,
+      "IFLA_LINKMODE": netlink.U8,
+      "IFLA_OPERSTATE": netlink.U8,
+      "IFLA_CARRIER": netlink.U8,
+      "IFLA_IFNAME": netlink.String,
+      "IFLA_QDISC": netlink.String,
+      "IFLA_ADDRESS": netlink.HwAddress,
+      "IFLA_BROADCAST": netlink.HwAddress,
+      "IFLA_STATS": netlink.Struct(RtnlLinkStats),
+      "IFLA_STATS64": netlink.Struct(RtnlLinkStats64),
+      "IFLA_LINKINFO": netlink.Nested,
+      "IFLA_INFO_KIND": netlink.String,
+      "IFLA_INFO_DATA": netlink.Nested,
+      "IFLA_VTI_IKEY": netlink.BE32,
+      "IFLA_VTI_OKEY": netlink.BE32,
+      "NDA_PROBES": netlink.U32,
+      "NDA_DST": netlink.Address,
+      "NDA_LLADDR": netlink.HwAddress,
+      "NDA_CACHEINFO": netlink.Struct(NDACacheinfo),
+  }
+
+  def _DecodeName(self, command, msg, nla_type, nested):
+    """Returns the name of an attribute, e.g., "RTA_TABLE".
+
+    Nested attributes are named by the attribute they are nested in, and
+    top-level attributes by the command, e.g., RTM_NEWROUTE attributes start
+    with "RTA_". Unknown attributes are left as integers.
+    """
+    prefix = self.NESTED_PREFIXES.get(nested[-1]) if nested else None
+    if prefix is None:
+      prefix = self.COMMAND_PREFIXES.get(CommandSubject(command))
+    if prefix is None:
+      # Don't know what this is. Leave it as an integer.
+      return nla_type
+    return self._GetConstantName(nla_type, prefix)
+
+  # Maps multicast groups to netlink_monitor.Monitor objects. See GetMonitor.
+  _monitors = None
+  # How long AddAddress waits for an IPv6 address to appear, in seconds.
+  ADDRESS_TIMEOUT = 5
+
+  def __init__(self, groups=None):
+    super(IPRoute, self).__init__(netlink.NETLINK_ROUTE, groups)
 
-    Values for which the code knows the type (e.g., the fwmark ID in a
-    RTM_NEWRULE command) are decoded to Python integers, strings, etc. Values
-    of unknown type are returned as raw byte strings.
+  def close(self):
+    for monitor in (self._monitors or {}).values():
+      monitor.close()
+    self._monitors = None
+    super(IPRoute, self).close()
+
+  def GetMonitor(self, groups):
+    """Returns a monitor for rtnetlink events in the specified groups.
+
+    The monitor is started on first use, and is shared by all the waits on
+    this object for the same groups, e.g., every AddAddress. It stops when
+    this object is closed, so test classes that open an IPRoute in setUpClass
+    and close it in tearDownClass get one monitor per class.
 
     Args:
-      command: An integer.
-        - If positive, the number of the rtnetlink command being carried out.
-          This is used to interpret the attributes. For example, for an
-          RTM_NEWROUTE command, attribute type 3 is the incoming interface and
-          is an integer, but for a RTM_NEWRULE command, attribute type 3 is the
-          incoming interface name and is a string.
-      family: The address family. Used to convert IP addresses into strings.
-      nla_type: An integer, then netlink attribute type.
-      nla_data: A byte string, the netlink attribute data.
-      nested: A list, outermost first, of each of the attributes the NLAttrs are
-              nested inside. Empty for non-nested attributes.
+      groups: A bitmask of RTMGRP_* values, e.g., RTMGRP_LINK | RTMGRP_NEIGH.
 
     Returns:
-      A tuple (name, data):
-       - name is a string (e.g., "FRA_PRIORITY") if we understood the attribute,
-         or an integer if we didn't.
-       - data can be an integer, a string, a nested dict of attributes as
-         returned by _ParseAttributes (e.g., for RTA_METRICS), a cstruct.Struct
-         (e.g., RTACacheinfo), etc. If we didn't understand the attribute, it
-         will be the raw byte string.
+      A netlink_monitor.Monitor.
     """
-    lastnested = nested[-1] if nested else None
-    if lastnested == "RTA_METRICS":
-      name = self._GetConstantName(nla_type, "RTAX_")
-    elif lastnested == "IFLA_LINKINFO":
-      name = self._GetConstantName(nla_type, "IFLA_INFO_")
-    elif lastnested == "IFLA_INFO_DATA":
-      name = self._GetConstantName(nla_type, "IFLA_VTI_")
-    elif CommandSubject(command) == "ADDR":
-      name = self._GetConstantName(nla_type, "IFA_")
-    elif CommandSubject(command) == "LINK":
-      name = self._GetConstantName(nla_type, "IFLA_")
-    elif CommandSubject(command) == "RULE":
-      name = self._GetConstantName(nla_type, "FRA_")
-    elif CommandSubject(command) == "ROUTE":
-      name = self._GetConstantName(nla_type, "RTA_")
-    elif CommandSubject(command) == "NEIGH":
-      name = self._GetConstantName(nla_type, "NDA_")
-    else:
-      # Don't know what this is. Leave it as an integer.
-      name = nla_type
-
-    if name in ["FRA_PRIORITY", "FRA_FWMARK", "FRA_TABLE", "FRA_FWMASK",
-                "RTA_OIF", "RTA_PRIORITY", "RTA_TABLE", "RTA_MARK",
-                "IFLA_MTU", "IFLA_TXQLEN", "IFLA_GROUP", "IFLA_EXT_MASK",
-                "IFLA_PROMISCUITY", "IFLA_NUM_RX_QUEUES",
-                "IFLA_NUM_TX_QUEUES", "NDA_PROBES", "RTAX_MTU",
-                "RTAX_HOPLIMIT", "IFLA_CARRIER_CHANGES", "IFLA_GSO_MAX_SEGS",
-                "IFLA_GSO_MAX_SIZE", "RTA_UID"]:
-      data = struct.unpack("=I", nla_data)[0]
-    elif name in ["IFLA_VTI_OKEY", "IFLA_VTI_IKEY"]:
-      data = struct.unpack("!I", nla_data)[0]
-    elif name == "FRA_SUPPRESS_PREFIXLEN":
-      data = struct.unpack("=i", nla_data)[0]
-    elif name in ["IFLA_LINKMODE", "IFLA_OPERSTATE", "IFLA_CARRIER"]:
-      data = ord(nla_data)
-    elif name in ["IFA_ADDRESS", "IFA_LOCAL", "RTA_DST", "RTA_SRC",
-                  "RTA_GATEWAY", "RTA_PREFSRC", "NDA_DST"]:
-      data = socket.inet_ntop(msg.family, nla_data)
-    elif name in ["FRA_IIFNAME", "FRA_OIFNAME", "IFLA_IFNAME", "IFLA_QDISC",
-                  "IFA_LABEL", "IFLA_INFO_KIND"]:
-      data = nla_data.strip(b"\x00")
-    elif name in ["RTA_METRICS", "IFLA_LINKINFO", "IFLA_INFO_DATA"]:
-      data = self._ParseAttributes(command, None, nla_data, nested + [name])
-    elif name == "RTA_CACHEINFO":
-      data = RTACacheinfo(nla_data)
-    elif name == "IFA_CACHEINFO":
-      data = IFACacheinfo(nla_data)
-    elif name == "NDA_CACHEINFO":
-      data = NDACacheinfo(nla_data)
-    elif name in ["NDA_LLADDR", "IFLA_ADDRESS", "IFLA_BROADCAST"]:
-      data = ":".join(net_test.ByteToHex(x) for x in nla_data)
-    elif name == "FRA_UID_RANGE":
-      data = FibRuleUidRange(nla_data)
-    elif name == "IFLA_STATS":
-      data = RtnlLinkStats(nla_data)
-    elif name == "IFLA_STATS64":
-      data = RtnlLinkStats64(nla_data)
-    else:
-      data = nla_data
-
-    return name, data
-
-  def __init__(self):
-    super(IPRoute, self).__init__(netlink.NETLINK_ROUTE)
+    if self._monitors is None:
+      self._monitors = {}
+    if groups not in self._monitors:
+      self._monitors[groups] = netlink_monitor.Monitor(IPRoute(groups),
+                                                       CommandStruct)
+    return self._monitors[groups]
 
   def _AddressFamily(self, version):
     return {4: AF_INET, 6: AF_INET6}[version]
@@ -391,13 +538,14 @@ class IPRoute(netlink.NetlinkSocket):
     """
     # Create a struct rtmsg specifying the table and the given match attributes.
     family = self._AddressFamily(version)
-    rtmsg = RTMsg((family, 0, 0, 0, RT_TABLE_UNSPEC,
-                   RTPROT_STATIC, RT_SCOPE_UNIVERSE, rule_type, 0)).Pack()
-    rtmsg += self._NlAttrU32(FRA_PRIORITY, priority)
+    rtmsg = self._NlRequestBuffer()
+    rtmsg.Append(RTMsg((family, 0, 0, 0, RT_TABLE_UNSPEC,
+                        RTPROT_STATIC, RT_SCOPE_UNIVERSE, rule_type, 0)))
+    self._AppendNlAttrU32(rtmsg, FRA_PRIORITY, priority)
     if match_nlattr:
-      rtmsg += match_nlattr
+      rtmsg.Append(match_nlattr)
     if table:
-      rtmsg += self._NlAttrU32(FRA_TABLE, table)
+      self._AppendNlAttrU32(rtmsg, FRA_TABLE, table)
 
     # Create a netlink request containing the rtmsg.
     command = RTM_NEWRULE if is_add else RTM_DELRULE
@@ -446,13 +594,7 @@ class IPRoute(netlink.NetlinkSocket):
     try:
       name = CommandName(command)
       subject = CommandSubject(command)
-      struct_type = {
-          "ADDR": IfAddrMsg,
-          "LINK": IfinfoMsg,
-          "NEIGH": NdMsg,
-          "ROUTE": RTMsg,
-          "RULE": RTMsg,
-      }[subject]
+      struct_type = _SUBJECT_STRUCTS[subject]
       parsed = self._ParseNLMsg(data, struct_type)
       return "%s %s" % (name, str(parsed))
     except IndexError:
@@ -483,37 +625,125 @@ class IPRoute(netlink.NetlinkSocket):
     ifinfomsg = IfinfoMsg((0, 0, 0, 0, 0, 0))
     return self._Dump(RTM_GETLINK, ifinfomsg, IfinfoMsg)
 
-  def DumpAddresses(self, version):
+  def DumpAddresses(self, version, ifindex=0):
+    """Returns the addresses for the specified IP version.
+
+    Args:
+      version: 4 or 6.
+      ifindex: If nonzero, only return the addresses on this interface.
+    """
     family = self._AddressFamily(version)
-    ifaddrmsg = IfAddrMsg((family, 0, 0, 0, 0))
-    return self._Dump(RTM_GETADDR, ifaddrmsg, IfAddrMsg)
+    ifaddrmsg = IfAddrMsg((family, 0, 0, 0, ifindex))
+    if not ifindex:
+      return self._Dump(RTM_GETADDR, ifaddrmsg, IfAddrMsg)
+    with self._StrictCheck():
+      addresses = self.IterDump(RTM_GETADDR, ifaddrmsg, IfAddrMsg)
+    # If the kernel filters by ifindex, it fails if there's no such interface.
+    return [(m, a) for m, a in _IgnoreErrno(addresses, errno.ENODEV)
+            if m.index == ifindex]
+
+  def DumpAllRoutes(self, version):
+    """Returns the routes for the specified IP version, in all tables."""
+    rtmsg = RTMsg(family=self._AddressFamily(version))
+    return self._Dump(RTM_GETROUTE, rtmsg, RTMsg)
+
+  def Snapshot(self, workers=4):
+    """Dumps links, addresses, routes, rules and neighbours concurrently.
+
+    The kernel runs only one dump at a time on each socket, so the dumps are
+    spread over this socket and workers - 1 temporary ones. Each dump is
+    consistent, but the kernel state may change between dumps.
+
+    Args:
+      workers: An integer, the number of dumps to run at once.
+
+    Returns:
+      A NetworkState.
+    """
+    dumps = collections.OrderedDict([
+        ("links", lambda ipr: ipr.DumpLinks()),
+        ("addresses4", lambda ipr: ipr.DumpAddresses(4)),
+        ("addresses6", lambda ipr: ipr.DumpAddresses(6)),
+        ("routes4", lambda ipr: ipr.DumpAllRoutes(4)),
+        ("routes6", lambda ipr: ipr.DumpAllRoutes(6)),
+        ("rules4", lambda ipr: ipr.DumpRules(4)),
+        ("rules6", lambda ipr: ipr.DumpRules(6)),
+        ("neighbours4", lambda ipr: ipr.DumpNeighbours(4, 0)),
+        ("neighbours6", lambda ipr: ipr.DumpNeighbours(6, 0)),
+    ])
+    workers = max(1, min(workers, len(dumps)))
+    sockets = [self] + [IPRoute() for _ in range(workers - 1)]
+    idle = queue.Queue()
+    for ipr in sockets:
+      idle.put(ipr)
+
+    def RunDump(dump):
+      ipr = idle.get()
+      try:
+        return dump(ipr)
+      finally:
+        idle.put(ipr)
+
+    try:
+      with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {name: executor.submit(RunDump, dump)
+                   for name, dump in dumps.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    finally:
+      for ipr in sockets[1:]:
+        ipr.close()
+
+    return NetworkState(
+        results["links"],
+        results["addresses4"] + results["addresses6"],
+        results["routes4"] + results["routes6"],
+        results["rules4"] + results["rules6"],
+        results["neighbours4"] + results["neighbours6"])
 
   def _Address(self, version, command, addr, prefixlen, flags, scope, ifindex):
     """Adds or deletes an IP address."""
     family = self._AddressFamily(version)
-    ifaddrmsg = IfAddrMsg((family, prefixlen, flags, scope, ifindex)).Pack()
-    ifaddrmsg += self._NlAttrIPAddress(IFA_ADDRESS, family, addr)
+    ifaddrmsg = self._NlRequestBuffer()
+    ifaddrmsg.Append(IfAddrMsg((family, prefixlen, flags, scope, ifindex)))
+    self._AppendNlAttrIPAddress(ifaddrmsg, IFA_ADDRESS, family, addr)
     if version == 4:
-      ifaddrmsg += self._NlAttrIPAddress(IFA_LOCAL, family, addr)
+      self._AppendNlAttrIPAddress(ifaddrmsg, IFA_LOCAL, family, addr)
     self._SendNlRequest(command, ifaddrmsg)
 
-  def _WaitForAddress(self, sock, address, ifindex):
+  def _ExpectAddress(self, address, ifindex):
     # IPv6 addresses aren't immediately usable when the netlink ACK comes back.
     # Even if DAD is disabled via IFA_F_NODAD or on the interface, when the ACK
     # arrives the input route has not yet been added to the local table. The
     # route is added in addrconf_dad_begin with a delayed timer of 0, but if
     # the system is under load, we could win the race against that timer and
     # cause the tests to be flaky. So, wait for RTM_NEWADDR to arrive
-    csocket.SetSocketTimeout(sock, 100)
-    while True:
+    def IsAddress(unused_command, msg, attrs):
+      return msg.index == ifindex and attrs.get("IFA_ADDRESS") == address
+
+    def Recheck():
+      # Uses a new socket, since this is called on the monitor thread.
+      ipr = IPRoute()
       try:
-        data = sock.recv(4096)
-      except EnvironmentError as e:
-        raise AssertionError("Address %s did not appear on ifindex %d: %s" %
-                             (address, ifindex, e.strerror))
-      msg, attrs = self._ParseNLMsg(data, IfAddrMsg)[0]
-      if msg.index == ifindex and attrs["IFA_ADDRESS"] == address:
-        return
+        for msg, attrs in ipr.DumpAddresses(6, ifindex):
+          if IsAddress(RTM_NEWADDR, msg, attrs):
+            return RTM_NEWADDR, msg, attrs
+      finally:
+        ipr.close()
+      return None
+
+    return self.GetMonitor(RTMGRP_IPV6_IFADDR).Expect(
+        IsAddress, [RTM_NEWADDR], timeout=self.ADDRESS_TIMEOUT,
+        recheck=Recheck)
+
+  def _WaitForAddress(self, waiter, address, ifindex):
+    try:
+      event = waiter.Wait()
+    except EnvironmentError as e:
+      raise AssertionError("Address %s did not appear on ifindex %d: %s" %
+                           (address, ifindex, e.strerror))
+    if event is None:
+      raise AssertionError("Address %s did not appear on ifindex %d" %
+                           (address, ifindex))
 
   def AddAddress(self, address, prefixlen, ifindex):
     """Adds a statically-configured IP address to an interface.
@@ -522,10 +752,11 @@ class IPRoute(netlink.NetlinkSocket):
     IFA_F_NODAD. The requested scope is RT_SCOPE_UNIVERSE, but at least for
     IPv6, is instead determined by the kernel.
 
-    In order to avoid races (see comments in _WaitForAddress above), when
+    In order to avoid races (see comments in _ExpectAddress above), when
     configuring IPv6 addresses, the method blocks until it receives an
     RTM_NEWADDR from the kernel confirming that the address has been added.
-    If the address does not appear within 100ms, AssertionError is thrown.
+    If the address does not appear within ADDRESS_TIMEOUT seconds,
+    AssertionError is thrown.
 
     Args:
       address: A string, the IP address to configure.
@@ -542,13 +773,18 @@ class IPRoute(netlink.NetlinkSocket):
     flags = IFA_F_PERMANENT
     if version == 6:
       flags |= IFA_F_NODAD
-      sock = self._OpenNetlinkSocket(netlink.NETLINK_ROUTE, RTMGRP_IPV6_IFADDR)
+      waiter = self._ExpectAddress(address, ifindex)
 
-    self._Address(version, RTM_NEWADDR, address, prefixlen, flags,
-                  RT_SCOPE_UNIVERSE, ifindex)
+    try:
+      self._Address(version, RTM_NEWADDR, address, prefixlen, flags,
+                    RT_SCOPE_UNIVERSE, ifindex)
+    except:
+      if version == 6:
+        waiter.Cancel()
+      raise
 
     if version == 6:
-      self._WaitForAddress(sock, address, ifindex)
+      self._WaitForAddress(waiter, address, ifindex)
 
   def DelAddress(self, address, prefixlen, ifindex):
     self._Address(csocket.AddressVersion(address),
@@ -569,28 +805,33 @@ class IPRoute(netlink.NetlinkSocket):
     """Adds, deletes, or queries a route."""
     family = self._AddressFamily(version)
     scope = RT_SCOPE_UNIVERSE if nexthop else RT_SCOPE_LINK
-    rtmsg = RTMsg((family, prefixlen, 0, 0, RT_TABLE_UNSPEC,
-                   proto, scope, route_type, 0)).Pack()
     if command == RTM_NEWROUTE and not table:
       # Don't allow setting routes in table 0, since its behaviour is confusing
       # and differs between IPv4 and IPv6.
       raise ValueError("Cowardly refusing to add a route to table 0")
-    if table:
-      rtmsg += self._NlAttrU32(FRA_TABLE, table)
+    if command == RTM_GETROUTE:
+      # Not used by route lookups, and rejected if the kernel checks strictly.
+      proto = scope = route_type = 0
+    rtmsg = self._NlRequestBuffer()
+    rtmsg.Append(RTMsg((family, prefixlen, 0, 0, RT_TABLE_UNSPEC,
+                        proto, scope, route_type, 0)))
+    # Route lookups that are checked strictly can't have a table.
+    if table and not (command == RTM_GETROUTE and self.strict_check):
+      self._AppendNlAttrU32(rtmsg, FRA_TABLE, table)
     if dest != "default":  # The default is the default route.
-      rtmsg += self._NlAttrIPAddress(RTA_DST, family, dest)
+      self._AppendNlAttrIPAddress(rtmsg, RTA_DST, family, dest)
     if nexthop:
-      rtmsg += self._NlAttrIPAddress(RTA_GATEWAY, family, nexthop)
+      self._AppendNlAttrIPAddress(rtmsg, RTA_GATEWAY, family, nexthop)
     if dev:
-      rtmsg += self._NlAttrU32(RTA_OIF, dev)
+      self._AppendNlAttrU32(rtmsg, RTA_OIF, dev)
     if mark is not None:
-      rtmsg += self._NlAttrU32(RTA_MARK, mark)
+      self._AppendNlAttrU32(rtmsg, RTA_MARK, mark)
     if uid is not None:
-      rtmsg += self._NlAttrU32(RTA_UID, uid)
+      self._AppendNlAttrU32(rtmsg, RTA_UID, uid)
     if priority is not None:
-      rtmsg += self._NlAttrU32(RTA_PRIORITY, priority)
+      self._AppendNlAttrU32(rtmsg, RTA_PRIORITY, priority)
     if iif is not None:
-      rtmsg += self._NlAttrU32(RTA_IIF, iif)
+      self._AppendNlAttrU32(rtmsg, RTA_IIF, iif)
     self._SendNlRequest(command, rtmsg)
 
   def AddRoute(self, version, table, dest, prefixlen, nexthop, dev):
@@ -613,10 +854,50 @@ class IPRoute(netlink.NetlinkSocket):
     routes = self._GetMsgList(RTMsg, data, False)
     return routes
 
-  def DumpRoutes(self, version, ifindex):
+  def IterRoutes(self, version, ifindex, oif=0, protocol=0, route_type=0):
+    """Returns an iterator over the routes in the specified table.
+
+    If the kernel supports strict checking, it only sends the matching routes.
+    The routes are also filtered here, so on other kernels, multipath routes
+    never match an oif.
+
+    Args:
+      version: 4 or 6.
+      ifindex: Despite the name, the routing table, e.g., RT_TABLE_MAIN. Only
+        routes in this table are returned. If None, routes in all tables are.
+      oif: If nonzero, only return routes through this interface.
+      protocol: If nonzero, only return routes with this protocol, e.g.,
+        RTPROT_STATIC.
+      route_type: If nonzero, only return routes of this type, e.g.,
+        RTN_UNICAST.
+    """
+    table = ifindex
     rtmsg = RTMsg(family=self._AddressFamily(version))
-    return [(m, r) for (m, r) in self._Dump(RTM_GETROUTE, rtmsg, RTMsg)
-            if r['RTA_TABLE'] == ifindex]
+    if not (table or oif or protocol or route_type):
+      routes = self.IterDump(RTM_GETROUTE, rtmsg, RTMsg)
+      if table is None:
+        return routes
+      return ((m, r) for (m, r) in routes if r["RTA_TABLE"] == table)
+
+    rtmsg.protocol = protocol
+    rtmsg.type = route_type
+    buf = self._NlRequestBuffer()
+    buf.Append(rtmsg)
+    if table:
+      self._AppendNlAttrU32(buf, RTA_TABLE, table)
+    if oif:
+      self._AppendNlAttrU32(buf, RTA_OIF, oif)
+    with self._StrictCheck():
+      routes = self.IterDump(RTM_GETROUTE, None, RTMsg, buf)
+    # If the kernel filters by table, it fails if the table doesn't exist.
+    return ((m, r) for (m, r) in _IgnoreErrno(routes, errno.ENOENT)
+            if ((table is None or r["RTA_TABLE"] == table) and
+                (not oif or r.get("RTA_OIF") == oif) and
+                (not protocol or m.protocol == protocol) and
+                (not route_type or m.type == route_type)))
+
+  def DumpRoutes(self, version, ifindex, oif=0, protocol=0, route_type=0):
+    return list(self.IterRoutes(version, ifindex, oif, protocol, route_type))
 
   def _Neighbour(self, version, is_add, addr, lladdr, dev, state, flags=0):
     """Adds or deletes a neighbour cache entry."""
@@ -629,10 +910,11 @@ class IPRoute(netlink.NetlinkSocket):
         raise ValueError("Invalid lladdr %s" % ":".join(lladdr))
       lladdr = binascii.unhexlify("".join(lladdr))
 
-    ndmsg = NdMsg((family, dev, state, 0, RTN_UNICAST)).Pack()
-    ndmsg += self._NlAttrIPAddress(NDA_DST, family, addr)
+    ndmsg = self._NlRequestBuffer()
+    ndmsg.Append(NdMsg((family, dev, state, 0, RTN_UNICAST)))
+    self._AppendNlAttrIPAddress(ndmsg, NDA_DST, family, addr)
     if is_add and lladdr:
-      ndmsg += self._NlAttr(NDA_LLADDR, lladdr)
+      self._AppendNlAttr(ndmsg, NDA_LLADDR, lladdr)
     command = RTM_NEWNEIGH if is_add else RTM_DELNEIGH
     self._SendNlRequest(command, ndmsg, flags)
 
@@ -649,7 +931,11 @@ class IPRoute(netlink.NetlinkSocket):
   def DumpNeighbours(self, version, ifindex):
     ndmsg = NdMsg((self._AddressFamily(version), 0, 0, 0, 0))
     attrs = self._NlAttrU32(NDA_IFINDEX, ifindex) if ifindex else b""
-    return self._Dump(RTM_GETNEIGH, ndmsg, NdMsg, attrs)
+    neighbours = self._Dump(RTM_GETNEIGH, ndmsg, NdMsg, attrs)
+    if ifindex:
+      # Kernels before 4.16 ignore NDA_IFINDEX.
+      neighbours = [(m, a) for m, a in neighbours if m.ifindex == ifindex]
+    return neighbours
 
   def ParseNeighbourMessage(self, msg):
     msg, _ = self._ParseNLMsg(msg, NdMsg)
@@ -672,11 +958,13 @@ class IPRoute(netlink.NetlinkSocket):
     ifinfo = IfinfoMsg().Pack()
     ifinfo += self._NlAttrStr(IFLA_IFNAME, dev_name)
     self._SendNlRequest(RTM_GETLINK, ifinfo)
-    hdr, data = cstruct.Read(self._Recv(), netlink.NLMsgHdr)
+    data = self._Recv()
+    hdr, offset = netlink.NLMsgHdr.ReadFrom(data)
     if hdr.type == RTM_NEWLINK:
-      return cstruct.Read(data, IfinfoMsg)
+      ifinfo, offset = IfinfoMsg.ReadFrom(data, offset)
+      return ifinfo, data[offset:hdr.length]
     elif hdr.type == netlink.NLMSG_ERROR:
-      error = -netlink.NLMsgErr(data).error
+      error = -netlink.NLMsgErr.ReadFrom(data, offset)[0].error
       raise IOError(error, os.strerror(error))
     else:
       raise ValueError("Unknown Netlink Message Type %d" % hdr.type)
@@ -731,22 +1019,24 @@ class IPRoute(netlink.NetlinkSocket):
     """
     family = AF_INET6 if ":" in remote_addr else AF_INET
 
-    ifinfo = IfinfoMsg().Pack()
-    ifinfo += self._NlAttrStr(IFLA_IFNAME, dev_name)
+    ifinfo = self._NlRequestBuffer()
+    ifinfo.Append(IfinfoMsg())
+    self._AppendNlAttrStr(ifinfo, IFLA_IFNAME, dev_name)
 
-    linkinfo = self._NlAttrStr(IFLA_INFO_KIND,
-        {AF_INET6: "vti6", AF_INET: "vti"}[family])
+    linkinfo = self._StartNlAttr(ifinfo, IFLA_LINKINFO)
+    self._AppendNlAttrStr(ifinfo, IFLA_INFO_KIND,
+                          {AF_INET6: "vti6", AF_INET: "vti"}[family])
 
-    ifdata = self._NlAttrIPAddress(IFLA_VTI_LOCAL, family, local_addr)
-    ifdata += self._NlAttrIPAddress(IFLA_VTI_REMOTE, family,
-                                    remote_addr)
+    ifdata = self._StartNlAttr(ifinfo, IFLA_INFO_DATA)
+    self._AppendNlAttrIPAddress(ifinfo, IFLA_VTI_LOCAL, family, local_addr)
+    self._AppendNlAttrIPAddress(ifinfo, IFLA_VTI_REMOTE, family, remote_addr)
     if i_key is not None:
-      ifdata += self._NlAttrU32(IFLA_VTI_IKEY, socket.htonl(i_key))
+      self._AppendNlAttrU32(ifinfo, IFLA_VTI_IKEY, socket.htonl(i_key))
     if o_key is not None:
-      ifdata += self._NlAttrU32(IFLA_VTI_OKEY, socket.htonl(o_key))
-    linkinfo += self._NlAttr(IFLA_INFO_DATA, ifdata)
+      self._AppendNlAttrU32(ifinfo, IFLA_VTI_OKEY, socket.htonl(o_key))
+    self._EndNlAttr(ifinfo, ifdata)
 
-    ifinfo += self._NlAttr(IFLA_LINKINFO, linkinfo)
+    self._EndNlAttr(ifinfo, linkinfo)
 
     # Always pass CREATE to prevent _SendNlRequest() from incorrectly
     # guessing the flags.
@@ -759,15 +1049,17 @@ class IPRoute(netlink.NetlinkSocket):
     """Creates an XFRM interface with the specified parameters."""
     # The netlink attribute structure is essentially identical to the one
     # for VTI above (q.v).
-    ifdata = self._NlAttrU32(IFLA_XFRM_LINK, underlying_ifindex)
-    ifdata += self._NlAttrU32(IFLA_XFRM_IF_ID, xfrm_if_id)
-
-    linkinfo = self._NlAttrStr(IFLA_INFO_KIND, "xfrm")
-    linkinfo += self._NlAttr(IFLA_INFO_DATA, ifdata)
-
-    msg = IfinfoMsg().Pack()
-    msg += self._NlAttrStr(IFLA_IFNAME, dev_name)
-    msg += self._NlAttr(IFLA_LINKINFO, linkinfo)
+    msg = self._NlRequestBuffer()
+    msg.Append(IfinfoMsg())
+    self._AppendNlAttrStr(msg, IFLA_IFNAME, dev_name)
+
+    linkinfo = self._StartNlAttr(msg, IFLA_LINKINFO)
+    self._AppendNlAttrStr(msg, IFLA_INFO_KIND, "xfrm")
+    ifdata = self._StartNlAttr(msg, IFLA_INFO_DATA)
+    self._AppendNlAttrU32(msg, IFLA_XFRM_LINK, underlying_ifindex)
+    self._AppendNlAttrU32(msg, IFLA_XFRM_IF_ID, xfrm_if_id)
+    self._EndNlAttr(msg, ifdata)
+    self._EndNlAttr(msg, linkinfo)
 
     return self._SendNlRequest(RTM_NEWLINK, msg)
 
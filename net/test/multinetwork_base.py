@@ -264,21 +264,26 @@ class MultiNetworkBaseTest(net_test.NetworkTest):
 
   @classmethod
   def _RunSetupCommands(cls, netid, is_add):
+    iface = cls.GetInterfaceName(netid)
+    table = cls._TableForNetid(netid)
+
+    # Set up routing rules. The rules don't depend on each other, or on the
+    # addresses and routes below, so send them all at once and check their ACKs
+    # together. If one fails, the others are still added or deleted.
+    start, end = cls.UidRangeForNetid(netid)
+    with cls.iproute.Batch():
+      for version in [4, 6]:
+        cls.iproute.UidRangeRule(version, is_add, start, end, table,
+                                 cls.PRIORITY_UID)
+        cls.iproute.OifRule(version, is_add, iface, table, cls.PRIORITY_OIF)
+        cls.iproute.FwmarkRule(version, is_add, netid, cls.NETID_FWMASK, table,
+                               cls.PRIORITY_FWMARK)
+
     for version in [4, 6]:
       # Find out how to configure things.
-      iface = cls.GetInterfaceName(netid)
       ifindex = cls.ifindices[netid]
       macaddr = cls.RouterMacAddress(netid)
       router = cls._RouterAddress(netid, version)
-      table = cls._TableForNetid(netid)
-
-      # Set up routing rules.
-      start, end = cls.UidRangeForNetid(netid)
-      cls.iproute.UidRangeRule(version, is_add, start, end, table,
-                               cls.PRIORITY_UID)
-      cls.iproute.OifRule(version, is_add, iface, table, cls.PRIORITY_OIF)
-      cls.iproute.FwmarkRule(version, is_add, netid, cls.NETID_FWMASK, table,
-                             cls.PRIORITY_FWMARK)
 
       # Configure routing and addressing.
       #
@@ -22,6 +22,7 @@ import errno
 import os
 import socket
 import sys
+import unittest
 
 import net_test
 import sock_diag
@@ -75,6 +76,7 @@ libc.mount.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p,
 libc.sethostname.argtypes = (ctypes.c_char_p, ctypes.c_size_t)
 libc.umount2.argtypes = (ctypes.c_char_p, ctypes.c_int)
 libc.unshare.argtypes = (ctypes.c_int,)
+libc.setns.argtypes = (ctypes.c_int, ctypes.c_int)
 
 
 def Mount(src, tgt, fs, flags=MS_NODEV|MS_NOEXEC|MS_NOSUID|MS_RELATIME):
@@ -120,6 +122,61 @@ def UnShare(flags):
     raise OSError(errno, '%s while unshare(0x%x)' % (os.strerror(errno), flags))
 
 
+def SetNs(fd, nstype):
+  ret = libc.setns(fd, nstype)
+  if ret < 0:
+    errno = ctypes.get_errno()
+    raise OSError(errno, '%s while setns(%d, 0x%x)'
+                  % (os.strerror(errno), fd, nstype))
+
+
+def EnterTemporaryNetworkNamespace():
+  """Moves the calling thread into a fresh network namespace.
+
+  Unlike EnterNewNetworkNamespace, this does not touch the mount or UTS
+  namespaces, and can be undone by calling ExitTemporaryNetworkNamespace.
+  Threads started afterwards by the calling thread inherit the namespace.
+  Sockets opened before the call stay in the original namespace.
+
+  Returns:
+    A file descriptor referring to the original network namespace.
+  """
+  fd = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+  try:
+    UnShare(CLONE_NEWNET)
+    net_test.SetInterfaceUp('lo')
+  except:
+    ExitTemporaryNetworkNamespace(fd)
+    raise
+  return fd
+
+
+def ExitTemporaryNetworkNamespace(fd):
+  """Returns to the namespace returned by EnterTemporaryNetworkNamespace."""
+  try:
+    SetNs(fd, CLONE_NEWNET)
+  finally:
+    os.close(fd)
+
+
+class NetworkNamespaceTest(unittest.TestCase):
+  """Runs the tests of a class in their own, temporary network namespace.
+
+  For tests that add routes, addresses, etc., so they don't change the state
+  of the host when not run by all_tests.py.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    super(NetworkNamespaceTest, cls).setUpClass()
+    cls._original_netns = EnterTemporaryNetworkNamespace()
+
+  @classmethod
+  def tearDownClass(cls):
+    ExitTemporaryNetworkNamespace(cls._original_netns)
+    super(NetworkNamespaceTest, cls).tearDownClass()
+
+
 def DumpMounts(hdr):
   print('')
   print(hdr)
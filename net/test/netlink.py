@@ -18,10 +18,18 @@
 
 # pylint: disable=g-bad-todo
 
+import atexit
+import binascii
+import collections.abc
+import contextlib
+import errno
 import os
+import select
 import socket
 import struct
 import sys
+import threading
+import time
 
 import cstruct
 import util
@@ -32,8 +40,15 @@ NETLINK_SOCK_DIAG = 4
 NETLINK_XFRM = 6
 NETLINK_GENERIC = 16
 
+# Socket options.
+SOL_NETLINK = 270
+NETLINK_NO_ENOBUFS = 5
+NETLINK_GET_STRICT_CHK = 12
+SO_RCVBUFFORCE = 33  # Not in the socket module.
+
 # Request constants.
 NLM_F_REQUEST = 1
+NLM_F_MULTI = 2
 NLM_F_ACK = 4
 NLM_F_REPLACE = 0x100
 NLM_F_EXCL = 0x200
@@ -41,6 +56,7 @@ NLM_F_CREATE = 0x400
 NLM_F_DUMP = 0x300
 
 # Message types.
+NLMSG_NOOP = 1
 NLMSG_ERROR = 2
 NLMSG_DONE = 3
 
@@ -52,23 +68,463 @@ NLAttr = cstruct.Struct("NLAttr", "=HH", "nla_len nla_type")
 
 # Alignment / padding.
 NLA_ALIGNTO = 4
+NLMSG_ALIGNTO = 4
+
+# A whole u32 attribute. Needs no padding.
+_NLATTR_U32 = struct.Struct("=HHI")
+# Just the header, for scanning attributes without creating NLAttr objects.
+_NLATTR_HEADER = struct.Struct("=HH")
+# The length field of the header, for filling in after the payload is written.
+_NLATTR_LEN = struct.Struct("=H")
 
 # List of attributes that can appear more than once in a given netlink message.
 # These can appear more than once but don't seem to contain any data.
 DUP_ATTRS_OK = ["INET_DIAG_NONE", "IFLA_PAD"]
 
 
+### Attribute decoders, for NetlinkSocket.ATTRIBUTES.
+# Each is a function that takes the arguments of NetlinkSocket._Decode, plus
+# the attribute name, and returns the decoded value.
+# pylint: disable=unused-argument
+
+
+def _Unpacker(fmt):
+  unpack = struct.Struct(fmt).unpack
+
+  def Decode(sock, command, msg, name, data, nested):
+    return unpack(data)[0]
+
+  return Decode
+
+
+U8 = _Unpacker("=B")
+U16 = _Unpacker("=H")
+U32 = _Unpacker("=I")
+S32 = _Unpacker("=i")
+U64 = _Unpacker("=Q")
+BE32 = _Unpacker("!I")
+
+
+def Raw(sock, command, msg, name, data, nested):
+  return data
+
+
+def Hex(sock, command, msg, name, data, nested):
+  return binascii.hexlify(data)
+
+
+def String(sock, command, msg, name, data, nested):
+  """A NUL-terminated string, returned as bytes."""
+  return data.strip(b"\x00")
+
+
+def Address(sock, command, msg, name, data, nested):
+  """An IP address in the address family of the message, e.g., RTA_DST."""
+  return socket.inet_ntop(msg.family, data)
+
+
+def AddressIn(family):
+  """An IP address in the given address family."""
+
+  def Decode(sock, command, msg, name, data, nested):
+    return socket.inet_ntop(family, data)
+
+  return Decode
+
+
+def HwAddress(sock, command, msg, name, data, nested):
+  """A link-layer address, e.g., "02:00:00:00:00:01"."""
+  return ":".join("%02x" % b for b in data)
+
+
+def Nested(sock, command, msg, name, data, nested):
+  """Attributes nested inside this one, parsed by _ParseAttributes."""
+  return sock._ParseAttributes(command, msg, data, nested + [name])
+
+
+def Struct(struct_type):
+  """A cstruct.Struct of the given type."""
+
+  def Decode(sock, command, msg, name, data, nested):
+    return struct_type.ReadFrom(data)[0]
+
+  return Decode
+
+
+def Method(method_name):
+  """Calls the named method of the socket on the attribute data."""
+
+  def Decode(sock, command, msg, name, data, nested):
+    return getattr(sock, method_name)(data)
+
+  return Decode
+
+# pylint: enable=unused-argument
+
+
 def MakeConstantPrefixes(prefixes):
   return sorted(prefixes, key=len, reverse=True)
 
 
+# Maps (module name, prefix) to a dict from constant values to names.
+_constant_name_indexes = {}
+
+
+def _MakeConstantNameIndex(module, prefix):
+  """Maps the values of the constants in module with prefix to their names.
+
+  If several constants have the same value, the name that comes first in
+  alphabetical order wins.
+
+  If the module explicitly specifies prefixes in CONSTANT_PREFIXES, a name is
+  only included if the passed-in prefix is the longest prefix that matches it.
+  This ensures, for example, that passing in a prefix of "IFA_" and a value of 1
+  returns "IFA_ADDRESS" instead of "IFA_F_SECONDARY". The longest matching
+  prefix is always the first matching prefix because CONSTANT_PREFIXES must be
+  sorted longest first.
+  """
+
+  def FirstMatching(name, prefixlist):
+    for prefix in prefixlist:
+      if name.startswith(prefix):
+        return prefix
+    return None
+
+  thismodule = sys.modules[module]
+  constant_prefixes = getattr(thismodule, "CONSTANT_PREFIXES", [])
+  index = {}
+  for name in dir(thismodule):
+    if not name.startswith(prefix) or not name.isupper():
+      continue
+    if constant_prefixes and prefix != FirstMatching(name, constant_prefixes):
+      continue
+    try:
+      index.setdefault(getattr(thismodule, name), name)
+    except TypeError:
+      # Not a hashable value, so not a constant.
+      pass
+  return index
+
+
+class AttributeMap(collections.abc.Mapping):
+  """A read-only dict of netlink attributes that decodes values when read.
+
+  Returned by NetlinkSocket._ParseAttributes. Parsing only finds the names and
+  offsets of the attributes. Each value is decoded by the socket's _Decode
+  method the first time it is read, and then cached. Compares equal to a dict
+  with the same decoded contents.
+
+  Keeps a copy of the attribute data, and a reference to the socket.
+  """
+
+  __slots__ = ("_sock", "_command", "_msg", "_data", "_nested", "_index",
+               "_values")
+
+  def __init__(self, sock, command, msg, data, nested, index):
+    self._sock = sock
+    self._command = command
+    self._msg = msg
+    self._data = data
+    self._nested = nested
+    # Maps names to (nla_type, offset, length) tuples.
+    self._index = index
+    # Maps names to decoded values.
+    self._values = {}
+
+  def __getitem__(self, name):
+    try:
+      return self._values[name]
+    except KeyError:
+      pass
+    nla_type, offset, length = self._index[name]
+    value = self._sock._Decode(self._command, self._msg, nla_type,
+                               self._data[offset:offset + length],
+                               self._nested)[1]
+    self._values[name] = value
+    return value
+
+  def __contains__(self, name):
+    return name in self._index
+
+  def __iter__(self):
+    return iter(self._index)
+
+  def __len__(self):
+    return len(self._index)
+
+  def __repr__(self):
+    return repr(dict(self))
+
+
+class BatchError(IOError):
+  """One or more requests in a batch failed.
+
+  errno and strerror describe the first failure, so callers that expect a
+  particular errno can treat this like any other IOError.
+
+  Attributes:
+    failures: A list of (index, command, errno) tuples, one for each failed
+      request, where index is the position of the request in the batch.
+  """
+
+  def __init__(self, failures):
+    error = failures[0][2]
+    super(BatchError, self).__init__(error, os.strerror(error))
+    self.failures = failures
+
+  def __str__(self):
+    return "%d batched requests failed: %s" % (
+        len(self.failures),
+        ", ".join("#%d (type %d): %s" % (i, c, os.strerror(e))
+                  for i, c, e in self.failures))
+
+
+class StatsSink(object):
+  """Receives statistics from all NetlinkSockets, if enabled by EnableStats.
+
+  Commands are identified by name, e.g., "RTM_GETROUTE" or "NLMSG_ERROR". The
+  counters are:
+
+    requests, bytes_sent: Requests sent, by command.
+    messages_received, bytes_received: Messages received, by message type.
+    messages_parsed: Messages decoded into a struct and attributes, by type.
+
+  The timers are:
+
+    ack_latency: From sending a request to receiving its ACK, by command.
+    dump_duration: From sending a dump request to reading its NLMSG_DONE, by
+      command. Includes any time the caller spends between messages.
+
+  Methods may be called from several threads at once. Subclasses can export
+  statistics elsewhere by overriding these methods.
+  """
+
+  def Count(self, command, counter, value=1):
+    pass
+
+  def Time(self, command, timer, seconds):
+    pass
+
+  def Summary(self):
+    """Returns a string to print at process exit, or an empty string."""
+    return ""
+
+
+class LatencyHistogram(object):
+  """A histogram of durations, in power-of-two buckets of microseconds."""
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    # Bucket n counts the durations of less than 2^n microseconds that are
+    # not in bucket n - 1.
+    self.buckets = collections.Counter()
+
+  def Add(self, seconds):
+    self.count += 1
+    self.total += seconds
+    self.max = max(self.max, seconds)
+    self.buckets[int(seconds * 1e6).bit_length()] += 1
+
+  def Percentile(self, fraction):
+    """Returns an upper bound for the given percentile, in seconds."""
+    target = fraction * self.count
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= target:
+        return min(self.max, (1 << bucket) / 1e6)
+    return self.max
+
+
+class Stats(StatsSink):
+  """Keeps counters and latency histograms in memory.
+
+  Attributes:
+    counters: A dict mapping (command, counter) to an integer.
+    timers: A dict mapping (command, timer) to a LatencyHistogram.
+  """
+
+  _COUNTERS = ["requests", "bytes_sent", "messages_received",
+               "bytes_received", "messages_parsed"]
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.counters = collections.Counter()
+    self.timers = collections.defaultdict(LatencyHistogram)
+
+  def Count(self, command, counter, value=1):
+    with self._lock:
+      self.counters[(command, counter)] += value
+
+  def Time(self, command, timer, seconds):
+    with self._lock:
+      self.timers[(command, timer)].Add(seconds)
+
+  def Summary(self):
+    with self._lock:
+      if not self.counters and not self.timers:
+        return ""
+      lines = ["Netlink statistics:"]
+      lines.append("  %-24s" % "command" +
+                   "".join(" %17s" % c for c in self._COUNTERS))
+      for command in sorted(set(c for c, _ in self.counters)):
+        lines.append("  %-24s" % command + "".join(
+            " %17d" % self.counters[(command, c)] for c in self._COUNTERS))
+      lines.append("  %-24s %-13s %8s %10s %10s %10s %10s" % (
+          "command", "timer", "count", "mean ms", "p50 ms", "p99 ms",
+          "max ms"))
+      for (command, timer), histogram in sorted(self.timers.items()):
+        lines.append("  %-24s %-13s %8d %10.3f %10.3f %10.3f %10.3f" % (
+            command, timer, histogram.count,
+            histogram.total / histogram.count * 1000,
+            histogram.Percentile(0.5) * 1000,
+            histogram.Percentile(0.99) * 1000, histogram.max * 1000))
+      return "\n".join(lines)
+
+
+def _PrintStatsSummary():
+  if NetlinkSocket.stats is not None:
+    summary = NetlinkSocket.stats.Summary()
+    if summary:
+      sys.stderr.write(summary + "\n")
+
+
+def EnableStats(sink=None):
+  """Starts sending statistics from all NetlinkSockets to a sink.
+
+  The sink's summary, if any, is printed to stderr when the process exits.
+
+  Args:
+    sink: A StatsSink. If None, a new Stats object.
+
+  Returns:
+    The sink.
+  """
+  if sink is None:
+    sink = Stats()
+  NetlinkSocket.stats = sink
+  atexit.unregister(_PrintStatsSummary)
+  atexit.register(_PrintStatsSummary)
+  return sink
+
+
+def DisableStats():
+  NetlinkSocket.stats = None
+  atexit.unregister(_PrintStatsSummary)
+
+
+class _Dispatcher(object):
+  """Routes received datagrams to the threads that are waiting for them.
+
+  Each thread waits for replies to the requests it sent last. Whichever
+  waiting thread gets here first reads the socket, and queues each datagram
+  for the thread that sent the request with the same sequence number. Replies
+  to requests that no one is waiting for, and messages that aren't addressed
+  to us (e.g., multicast), are dropped.
+  """
+
+  # How long Recv waits for a reply, in seconds.
+  TIMEOUT = 30
+
+  def __init__(self, nl):
+    self._nl = nl
+    self._portid = nl.sock.getsockname()[0]
+    self._cond = threading.Condition()
+    self._reading = False
+    # seq -> collections.deque of received datagrams.
+    self._mailboxes = {}
+    self._local = threading.local()
+
+  def Expect(self, msg):
+    """Makes the calling thread wait for replies to the requests in msg."""
+    seqs = [hdr.seq for hdr, _, _ in NetlinkSocket._IndexNLMsgs(msg)]
+    with self._cond:
+      # The thread has given up on its previous requests.
+      for seq in getattr(self._local, "seqs", []):
+        self._mailboxes.pop(seq, None)
+      for seq in seqs:
+        self._mailboxes[seq] = collections.deque()
+    self._local.seqs = seqs
+
+  def Recv(self):
+    """Returns the next datagram for the calling thread.
+
+    Raises:
+      IOError: No datagram arrived within TIMEOUT seconds.
+    """
+    seqs = getattr(self._local, "seqs", [])
+    deadline = time.monotonic() + self.TIMEOUT
+    while True:
+      with self._cond:
+        while True:
+          for seq in seqs:
+            mailbox = self._mailboxes.get(seq)
+            if mailbox:
+              return mailbox.popleft()
+          if not self._reading:
+            self._reading = True
+            break
+          if not self._cond.wait(deadline - time.monotonic()):
+            raise IOError(errno.ETIMEDOUT, "Timed out waiting for a reply")
+
+      # Read without holding the lock, so other threads can pick up what they
+      # are waiting for. Only one thread reads at a time.
+      try:
+        timeout = max(0, deadline - time.monotonic())
+        if not select.select([self._nl.sock], [], [], timeout)[0]:
+          raise IOError(errno.ETIMEDOUT, "Timed out waiting for a reply")
+        data = bytes(self._nl._RecvDatagram())
+      finally:
+        with self._cond:
+          self._reading = False
+          self._cond.notify_all()
+
+      if len(data) < len(NLMsgHdr):
+        continue
+      hdr = NLMsgHdr.ReadFrom(data)[0]
+      if hdr.pid != self._portid:
+        continue
+      with self._cond:
+        mailbox = self._mailboxes.get(hdr.seq)
+        if mailbox is not None:
+          mailbox.append(data)
+          self._cond.notify_all()
+
+
 class NetlinkSocket(object):
   """A basic netlink socket object."""
 
+  # The initial size of the receive buffer. It grows if a datagram is larger.
   BUFSIZE = 65536
+  # The receive buffer size for SetBulkReceiveOptions.
+  BULK_RCVBUF = 4 * 1024 * 1024
   DEBUG = False
+  # A bytearray, allocated on first receive and reused after that.
+  _recvbuf = None
+  # The most requests that a batch sends before waiting for their ACKs. Keeps
+  # the ACKs from overflowing the receive buffer.
+  BATCH_SIZE = 64
+  # While batching, a list of (seq, command, message) tuples to send.
+  _batch = None
+  # Held while assigning sequence numbers and sending. See MakeThreadSafe.
+  _lock = contextlib.nullcontext()
+  # Held while a dump is sent and received. See MakeThreadSafe.
+  _dump_lock = contextlib.nullcontext()
+  _dispatcher = None
   # List of netlink messages to print, e.g., [], ["NEIGH", "ROUTE"], or ["ALL"]
   NL_DEBUG = []
+  # If True, ask the kernel to check all requests strictly. See _SetStrictCheck.
+  STRICT_CHECK = False
+  # True if the kernel checks this socket's requests strictly.
+  strict_check = False
+  # A StatsSink, or None if statistics are disabled. See EnableStats.
+  stats = None
+  # Maps attribute names, as returned by _DecodeName, to the decoders above.
+  # Attributes that are not in the table are decoded by DEFAULT_DECODER.
+  ATTRIBUTES = {}
+  DEFAULT_DECODER = staticmethod(Raw)
 
   def _Debug(self, s):
     if self.DEBUG:
@@ -82,6 +538,49 @@ class NetlinkSocket(object):
     nla_len = datalen + len(NLAttr)
     return NLAttr((nla_len, nla_type)).Pack() + data + padding
 
+  def _AppendNlAttr(self, buf, nla_type, data):
+    """Appends a netlink attribute to a cstruct.PackBuffer."""
+    buf.Append(_NLATTR_HEADER.pack(len(data) + _NLATTR_HEADER.size, nla_type))
+    buf.Append(data)
+    buf.Pad(NLA_ALIGNTO)
+
+  def _StartNlAttr(self, buf, nla_type):
+    """Starts an attribute whose payload is written in place.
+
+    Like the kernel's nla_nest_start. Everything appended to buf until the
+    matching _EndNlAttr call is the payload, e.g., nested attributes, or a
+    struct followed by a key. Nested attributes are built from the inside out
+    in one pass, without copying the inner ones.
+
+    Args:
+      buf: A cstruct.PackBuffer, e.g., from _NlRequestBuffer.
+      nla_type: An integer, the attribute type.
+
+    Returns:
+      The offset of the attribute, to pass to _EndNlAttr.
+    """
+    return buf.Append(_NLATTR_HEADER.pack(0, nla_type))
+
+  def _EndNlAttr(self, buf, start):
+    """Fills in the length of an attribute started by _StartNlAttr, and pads it.
+
+    Like the kernel's nla_nest_end.
+    """
+    nla_len = len(buf) - start
+    if nla_len > 0xffff:
+      raise ValueError("Attribute too long: %d bytes" % nla_len)
+    _NLATTR_LEN.pack_into(buf.View(), start, nla_len)
+    buf.Pad(NLA_ALIGNTO)
+
+  def _AppendNlAttrIPAddress(self, buf, nla_type, family, address):
+    self._AppendNlAttr(buf, nla_type, socket.inet_pton(family, address))
+
+  def _AppendNlAttrU32(self, buf, nla_type, value):
+    buf.Append(_NLATTR_U32.pack(_NLATTR_U32.size, nla_type, value))
+
+  def _AppendNlAttrStr(self, buf, nla_type, value):
+    self._AppendNlAttr(buf, nla_type, value.encode("UTF-8") + b"\x00")
+
   def _NlAttrIPAddress(self, nla_type, family, address):
     return self._NlAttr(nla_type, socket.inet_pton(family, address))
 
@@ -94,50 +593,103 @@ class NetlinkSocket(object):
 
   @staticmethod
   def _GetConstantName(module, value, prefix):
+    """Returns the name of the constant in module with the given value.
 
-    def FirstMatching(name, prefixlist):
-      for prefix in prefixlist:
-        if name.startswith(prefix):
-         return prefix
-      return None
+    Args:
+      module: A string, the name of the module to look in.
+      value: The value of the constant, usually an integer.
+      prefix: A string, the prefix of the constant name, e.g., "IFA_".
 
-    thismodule = sys.modules[module]
-    constant_prefixes = getattr(thismodule, "CONSTANT_PREFIXES", [])
-    for name in dir(thismodule):
-      if value != getattr(thismodule, name) or not name.isupper():
-        continue
-      # If the module explicitly specifies prefixes, only return this name if
-      # the passed-in prefix is the longest prefix that matches the name.
-      # This ensures, for example, that passing in a prefix of "IFA_" and a
-      # value of 1 returns "IFA_ADDRESS" instead of "IFA_F_SECONDARY".
-      # The longest matching prefix is always the first matching prefix because
-      # CONSTANT_PREFIXES must be sorted longest first.
-      if constant_prefixes and prefix != FirstMatching(name, constant_prefixes):
-        continue
-      if name.startswith(prefix):
-        return name
-    return value
+    Returns:
+      The name, or value itself if there is no such constant.
+    """
+    try:
+      index = _constant_name_indexes[(module, prefix)]
+    except KeyError:
+      index = _MakeConstantNameIndex(module, prefix)
+      _constant_name_indexes[(module, prefix)] = index
+    try:
+      return index.get(value, value)
+    except TypeError:
+      # Unhashable, so not equal to any constant in the index.
+      return value
+
+  def _DecodeName(self, command, msg, nla_type, nested):
+    """Returns the name that _Decode would return for an attribute.
+
+    Subclasses that override this get lazily-decoded attributes from
+    _ParseAttributes. Otherwise, attributes are decoded as soon as they are
+    parsed.
+    """
+    return nla_type
+
+  def _CommandName(self, command):
+    """Returns the name of a netlink message type, for statistics."""
+    if command == NLMSG_NOOP:
+      return "NLMSG_NOOP"
+    if command == NLMSG_ERROR:
+      return "NLMSG_ERROR"
+    if command == NLMSG_DONE:
+      return "NLMSG_DONE"
+    return "%s_%d" % (type(self).__name__, command)
 
   def _Decode(self, command, msg, nla_type, nla_data, nested):
-    """No-op, nonspecific version of decode."""
-    return nla_type, nla_data
+    """Decodes a netlink attribute to a Python type.
+
+    Finds the name of the attribute using _DecodeName, and decodes the data
+    using the decoder for that name in ATTRIBUTES.
+
+    Args:
+      command: An integer, the netlink message type. Used to interpret the
+        attributes. For example, for an RTM_NEWROUTE command, attribute type 3
+        is the incoming interface and is an integer, but for an RTM_NEWRULE
+        command, attribute type 3 is the incoming interface name and is a
+        string.
+      msg: A Struct, the message the attributes belong to, e.g., an RTMsg. Used
+        to convert IP addresses into strings.
+      nla_type: An integer, then netlink attribute type.
+      nla_data: A byte string, the netlink attribute data.
+      nested: A list, outermost first, of each of the attributes the NLAttrs are
+              nested inside. Empty for non-nested attributes.
 
-  def _ReadNlAttr(self, data):
+    Returns:
+      A tuple (name, data):
+       - name is a string (e.g., "FRA_PRIORITY") if we understood the attribute,
+         or an integer if we didn't.
+       - data can be an integer, a string, a dict of nested attributes as
+         returned by _ParseAttributes (e.g., for RTA_METRICS), a cstruct.Struct
+         (e.g., RTACacheinfo), etc. If we didn't understand the attribute, it
+         is decoded by DEFAULT_DECODER, which returns the raw byte string.
+    """
+    name = self._DecodeName(command, msg, nla_type, nested)
+    decoder = self.ATTRIBUTES.get(name, self.DEFAULT_DECODER)
+    return name, decoder(self, command, msg, name, nla_data, nested)
+
+  def _ReadNlAttr(self, data, offset):
+    """Reads the netlink attribute at the given offset into data.
+
+    Returns:
+      A tuple (nla, nla_data, offset), where nla is the NLAttr header, nla_data
+      is a bytes object containing the attribute payload, and offset is the
+      offset of the next attribute.
+    """
     # Read the nlattr header.
-    nla, data = cstruct.Read(data, NLAttr)
+    nla, offset = NLAttr.ReadFrom(data, offset)
 
     # Read the data.
     datalen = nla.nla_len - len(nla)
     padded_len = util.GetPadLength(NLA_ALIGNTO, datalen) + datalen
-    nla_data, data = data[:datalen], data[padded_len:]
+    nla_data = bytes(data[offset:offset + datalen])
 
-    return nla, nla_data, data
+    return nla, nla_data, offset + padded_len
 
-  def _ParseAttributes(self, command, msg, data, nested):
+  def _ParseAttributes(self, command, msg, data, nested, offset=0, end=None):
     """Parses and decodes netlink attributes.
 
     Takes a block of NLAttr data structures, decodes them using Decode, and
-    returns the result in a dict keyed by attribute number.
+    returns the result in a dict keyed by attribute name. If the class
+    implements _DecodeName, the result is an AttributeMap, which only decodes
+    the values that are read.
 
     Args:
       command: An integer, the rtnetlink command being carried out.
@@ -145,16 +697,26 @@ class NetlinkSocket(object):
       data: A byte string containing a sequence of NLAttr data structures.
       nested: A list, outermost first, of each of the attributes the NLAttrs are
               nested inside. Empty for non-nested attributes.
+      offset: The offset in data of the first attribute.
+      end: The offset in data just past the last attribute. Defaults to the end
+           of data.
 
     Returns:
-      A dictionary mapping attribute types (integers) to decoded values.
+      A dict or AttributeMap mapping attribute names (or types, if unknown) to
+      decoded values.
 
     Raises:
       ValueError: There was a duplicate attribute type.
     """
+    if end is None:
+      end = len(data)
+    if (type(self)._DecodeName is not NetlinkSocket._DecodeName and
+        not self.DEBUG):
+      return self._IndexAttributes(command, msg, data, nested, offset, end)
+
     attributes = {}
-    while data:
-      nla, nla_data, data = self._ReadNlAttr(data)
+    while offset < end:
+      nla, nla_data, offset = self._ReadNlAttr(data, offset)
 
       # If it's an attribute we know about, try to decode it.
       nla_name, nla_data = self._Decode(command, msg, nla.nla_type, nla_data, nested)
@@ -168,6 +730,25 @@ class NetlinkSocket(object):
 
     return attributes
 
+  def _IndexAttributes(self, command, msg, data, nested, offset, end):
+    """Finds the attribute names and offsets, and returns an AttributeMap."""
+    # Copy the data, because it might be a view of the receive buffer.
+    data = bytes(data[offset:end])
+    end = len(data)
+    offset = 0
+    index = {}
+    while offset < end:
+      nla_len, nla_type = _NLATTR_HEADER.unpack_from(data, offset)
+      if nla_len < _NLATTR_HEADER.size:
+        raise ValueError("Invalid attribute length %d" % nla_len)
+      name = self._DecodeName(command, msg, nla_type, nested)
+      if name in index and name not in DUP_ATTRS_OK:
+        raise ValueError("Duplicate attribute %s" % name)
+      datalen = nla_len - _NLATTR_HEADER.size
+      index[name] = (nla_type, offset + _NLATTR_HEADER.size, datalen)
+      offset += nla_len + util.GetPadLength(NLA_ALIGNTO, nla_len)
+    return AttributeMap(self, command, msg, data, nested, index)
+
   def _OpenNetlinkSocket(self, family, groups):
     sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, family)
     if groups:
@@ -180,11 +761,76 @@ class NetlinkSocket(object):
     self.seq = 0
     self.sock = self._OpenNetlinkSocket(family, groups)
     self.pid = self.sock.getsockname()[1]
+    if self.STRICT_CHECK:
+      self.strict_check = self._SetStrictCheck(True)
+
+  def _SetStrictCheck(self, enable):
+    """Sets or clears NETLINK_GET_STRICT_CHK, if the kernel supports it (4.20+).
+
+    With strict checking, the kernel rejects get and dump requests that have
+    unexpected values in their headers or attributes, and dumps only return
+    the entries that match the filters in the request. Older kernels ignore the
+    filters, so callers must filter the results themselves.
+
+    Returns:
+      True if the kernel supports strict checking. False if it doesn't, or if
+      the socket isn't a netlink socket, e.g., in benchmarks that replay
+      datagrams over a Unix socket.
+    """
+    try:
+      self.sock.setsockopt(SOL_NETLINK, NETLINK_GET_STRICT_CHK, int(enable))
+    except OSError as e:
+      if e.errno not in (errno.ENOPROTOOPT, errno.EOPNOTSUPP, errno.ENOTSOCK):
+        raise
+      return False
+    return True
+
+  @contextlib.contextmanager
+  def _StrictCheck(self):
+    """Checks the requests sent in the block strictly, if the kernel can.
+
+    Used for dumps that the kernel can filter. The kernel decides whether to
+    filter when the dump starts, so the rest of the dump can be read outside
+    the block. In thread-safe mode, other threads may send requests while the
+    block runs, and may turn strict checking off, so callers must still filter
+    the results themselves.
+
+    Yields:
+      True if the kernel supports strict checking.
+    """
+    if self.strict_check:
+      yield True
+      return
+    supported = self._SetStrictCheck(True)
+    try:
+      yield supported
+    finally:
+      if supported:
+        self._SetStrictCheck(False)
 
   def close(self):
     self.sock.close()
     self.sock = None
 
+  def SetBulkReceiveOptions(self, rcvbuf=None, no_enobufs=False):
+    """Configures the socket for large dumps or busy multicast groups.
+
+    Args:
+      rcvbuf: The kernel receive buffer size in bytes, by default BULK_RCVBUF.
+        If we have CAP_NET_ADMIN, this can exceed net.core.rmem_max.
+      no_enobufs: If True, set NETLINK_NO_ENOBUFS, so that if the receive
+        buffer overflows, messages are dropped without returning ENOBUFS. Only
+        useful for monitors that can tolerate missing some events.
+    """
+    if rcvbuf is None:
+      rcvbuf = self.BULK_RCVBUF
+    try:
+      self.sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, rcvbuf)
+    except PermissionError:
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if no_enobufs:
+      self.sock.setsockopt(SOL_NETLINK, NETLINK_NO_ENOBUFS, 1)
+
   def __del__(self):
     if self.sock:
       self.close()
@@ -193,13 +839,70 @@ class NetlinkSocket(object):
     # Default no-op implementation to be overridden by subclasses.
     pass
 
+  def MakeThreadSafe(self):
+    """Lets several threads send requests and receive replies at once.
+
+    Sequence numbers are assigned under a lock, and each thread receives only
+    the replies to its own requests. A thread waits for the replies to the
+    last request (or batch) it sent. The kernel only runs one dump at a time
+    on each socket, so dumps from different threads take turns, and each dump
+    is received whole before IterDump returns. Other threads can't send
+    requests while a thread is inside a Batch block.
+
+    The socket must not be subscribed to multicast groups, and must not be
+    used by async_netlink.
+    """
+    self._lock = threading.RLock()
+    self._dump_lock = threading.RLock()
+    self._dispatcher = _Dispatcher(self)
+
   def _Send(self, msg):
     # self._Debug(msg.encode("hex"))
-    self.seq += 1
-    self.sock.send(msg)
+    with self._lock:
+      if self._dispatcher is not None:
+        self._dispatcher.Expect(msg)
+      self.seq += 1
+      self.sock.send(msg)
+    if self.stats is not None:
+      self._CountMessages(msg, "requests", "bytes_sent")
+
+  def _CountMessages(self, data, messages_counter, bytes_counter):
+    for hdr, _, _ in self._IndexNLMsgs(data):
+      name = self._CommandName(hdr.type)
+      self.stats.Count(name, messages_counter)
+      self.stats.Count(name, bytes_counter, hdr.length)
+
+  def _RecvInto(self):
+    """Receives a datagram into a receive buffer that is reused across calls.
+
+    Peeks at the length of the datagram first, and grows the buffer if it is
+    too small, so the datagram is never truncated.
+
+    Returns:
+      A memoryview of the datagram. Only valid until the next call.
+    """
+    if self._dispatcher is not None:
+      return memoryview(self._dispatcher.Recv())
+    return self._RecvDatagram()
+
+  def _RecvDatagram(self):
+    buf = self._recvbuf
+    if buf is None:
+      buf = self._recvbuf = bytearray(self.BUFSIZE)
+    # With MSG_TRUNC, returns the full length even though it copies one byte.
+    datalen = self.sock.recv_into(buf, 1, socket.MSG_PEEK | socket.MSG_TRUNC)
+    if datalen > len(buf):
+      # Round up to a whole number of pages. Don't resize in place, in case a
+      # caller still holds a view of the old buffer.
+      buf = self._recvbuf = bytearray(-(-datalen // 4096) * 4096)
+    datalen = self.sock.recv_into(buf)
+    data = memoryview(buf)[:datalen]
+    if self.stats is not None:
+      self._CountMessages(data, "messages_received", "bytes_received")
+    return data
 
   def _Recv(self):
-    data = self.sock.recv(self.BUFSIZE)
+    data = bytes(self._RecvInto())
     # self._Debug(data.encode("hex"))
     return data
 
@@ -211,9 +914,9 @@ class NetlinkSocket(object):
 
   def _ParseAck(self, response):
     # Find the error code.
-    hdr, data = cstruct.Read(response, NLMsgHdr)
+    hdr, offset = NLMsgHdr.ReadFrom(response)
     if hdr.type == NLMSG_ERROR:
-      error = -NLMsgErr(data).error
+      error = -NLMsgErr.ReadFrom(response, offset)[0].error
       if error:
         raise IOError(error, os.strerror(error))
     else:
@@ -223,89 +926,364 @@ class NetlinkSocket(object):
     response = self._Recv()
     self._ParseAck(response)
 
+  def _NlRequestBuffer(self):
+    """Returns a cstruct.PackBuffer with room for a netlink header.
+
+    A request body built in this buffer can be passed to _SendNlRequest or
+    _Dump, which fill in the header and send it without copying.
+    """
+    buf = cstruct.PackBuffer()
+    buf.Reserve(len(NLMsgHdr))
+    return buf
+
+  def _FinishNlRequest(self, command, data, flags):
+    """Fills in the netlink header and returns the message to send.
+
+    Args:
+      command: An integer, the netlink message type.
+      data: The request body. Either a bytes object or a buffer returned by
+        _NlRequestBuffer.
+      flags: An integer, the netlink message flags.
+
+    Returns:
+      A memoryview of the whole message.
+    """
+    if isinstance(data, cstruct.PackBuffer):
+      buf = data
+    else:
+      buf = self._NlRequestBuffer()
+      buf.Append(data)
+    buf.PackAt(0, NLMsgHdr((len(buf), command, flags, self.seq, self.pid)))
+    return buf.View()
+
   def _SendNlRequest(self, command, data, flags):
-    """Sends a netlink request and expects an ack."""
-    length = len(NLMsgHdr) + len(data)
-    nlmsg = NLMsgHdr((length, command, flags, self.seq, self.pid)).Pack()
+    """Sends a netlink request and expects an ack.
 
-    self.MaybeDebugCommand(command, flags, nlmsg + data)
+    data is either a bytes object or a buffer returned by _NlRequestBuffer.
+    Inside a Batch, the request is queued instead, and always gets an ack.
+    """
+    with self._lock:
+      if self._batch is not None:
+        flags |= NLM_F_ACK
+      nlmsg = self._FinishNlRequest(command, data, flags)
 
-    # Send the message.
-    self._Send(nlmsg + data)
+      self.MaybeDebugCommand(command, flags, nlmsg)
+
+      if self._batch is not None:
+        self._batch.append((self.seq, command, bytes(nlmsg)))
+        self.seq += 1
+        return
+
+      # Send the message.
+      self._Send(nlmsg)
 
     if flags & NLM_F_ACK:
-      self._ExpectAck()
+      if self.stats is None:
+        self._ExpectAck()
+        return
+      start = time.monotonic()
+      try:
+        self._ExpectAck()
+      finally:
+        self.stats.Time(self._CommandName(command), "ack_latency",
+                        time.monotonic() - start)
 
-  def _ParseNLMsg(self, data, msgtype):
-    """Parses a Netlink message into a header and a dictionary of attributes."""
-    nlmsghdr, data = cstruct.Read(data, NLMsgHdr)
-    self._Debug("  %s" % nlmsghdr)
+  @contextlib.contextmanager
+  def Batch(self):
+    """Context manager that pipelines requests and checks all their ACKs.
+
+    Requests sent inside the with block by methods that call _SendNlRequest
+    (e.g., AddRoute, DelAddress) are queued and not sent until the block
+    exits. Then they are sent, BATCH_SIZE messages per datagram, each with its
+    own sequence number. Their ACKs are matched to them by sequence number.
+    This takes one round trip per datagram instead of one per request.
+
+    The kernel processes all the requests in a datagram even if some of them
+    fail, but no more datagrams are sent after a failure. If the with block
+    raises an exception, nothing is sent.
+
+    Only requests that are answered by an ACK can be batched. Don't dump or
+    get anything inside the block.
+
+    Raises:
+      BatchError: One or more requests failed.
+    """
+    with self._QueueRequests() as batch:
+      yield
+    self._SendBatch(batch)
+
+  @contextlib.contextmanager
+  def _QueueRequests(self):
+    """Context manager that queues requests instead of sending them.
+
+    Yields:
+      The list that _SendNlRequest appends (seq, command, message) tuples to.
+    """
+    with self._lock:
+      if self._batch is not None:
+        raise ValueError("Batches cannot be nested")
+      self._batch = []
+      try:
+        yield self._batch
+      finally:
+        self._batch = None
+
+  def _SendBatch(self, batch):
+    """Sends a list of (seq, command, message) tuples and checks the ACKs."""
+    failures = []
+    for start in range(0, len(batch), self.BATCH_SIZE):
+      chunk = batch[start:start + self.BATCH_SIZE]
+      buf = cstruct.PackBuffer()
+      # seq -> (index, command)
+      pending = {}
+      for index, (seq, command, nlmsg) in enumerate(chunk, start):
+        buf.Append(nlmsg)
+        buf.Pad(NLMSG_ALIGNTO)
+        pending[seq] = (index, command)
+      self._Send(buf.View())
+      stats = self.stats
+      sent_at = time.monotonic() if stats is not None else None
+
+      while pending:
+        data = self._RecvInto()
+        for hdr, body_offset, _ in self._IndexNLMsgs(data):
+          # Skip anything that isn't an ACK for this batch, e.g., multicast
+          # notifications or stale ACKs.
+          if hdr.type != NLMSG_ERROR or hdr.seq not in pending:
+            continue
+          index, command = pending.pop(hdr.seq)
+          if stats is not None:
+            stats.Time(self._CommandName(command), "ack_latency",
+                       time.monotonic() - sent_at)
+          error = -NLMsgErr.ReadFrom(data, body_offset)[0].error
+          if error:
+            failures.append((index, command, error))
+
+      if failures:
+        raise BatchError(failures)
+
+  @staticmethod
+  def _IndexNLMsgs(data):
+    """Finds the netlink messages in a buffer, without parsing their bodies.
+
+    Makes one pass over data and never copies it, so data can be a memoryview
+    of a large recv buffer.
+
+    Args:
+      data: A bytes, bytearray or memoryview object containing netlink
+        messages, e.g., one datagram of a dump.
+
+    Returns:
+      A list of (hdr, body_offset, body_len) tuples, one for each message, where
+      hdr is an NLMsgHdr and the message body is body_len bytes at body_offset.
+      The list ends with the first NLMSG_DONE or NLMSG_ERROR, if any.
+
+    Raises:
+      ValueError: A message header has an invalid length.
+    """
+    index = []
+    offset = 0
+    end = len(data)
+    hdrlen = len(NLMsgHdr)
+    while offset < end:
+      hdr, body_offset = NLMsgHdr.ReadFrom(data, offset)
+      if hdr.length < hdrlen or offset + hdr.length > end:
+        raise ValueError("Invalid netlink message length %d at offset %d" %
+                         (hdr.length, offset))
+      index.append((hdr, body_offset, hdr.length - hdrlen))
+      if hdr.type == NLMSG_DONE or hdr.type == NLMSG_ERROR:
+        break
+      offset += hdr.length + util.GetPadLength(NLMSG_ALIGNTO, hdr.length)
+    return index
+
+  def _DecodeNLMsg(self, data, hdr, body_offset, body_len, msgtype):
+    """Decodes a message body found by _IndexNLMsgs.
+
+    Returns:
+      A tuple (msg, attributes), where msg is of type msgtype and attributes
+      is a dict of the decoded attributes that follow it.
+    """
+    nlmsg, offset = msgtype.ReadFrom(data, body_offset)
+    if self.stats is not None:
+      self.stats.Count(self._CommandName(hdr.type), "messages_parsed")
+    if self.DEBUG:
+      self._Debug("  %s" % hdr)
+      self._Debug("    %s" % nlmsg)
+
+    # Parse the attributes in place, without copying them out of data.
+    attributes = self._ParseAttributes(hdr.type, nlmsg, data, [], offset,
+                                       body_offset + body_len)
+    return nlmsg, attributes
+
+  def _ReadNLMsg(self, data, offset, msgtype):
+    """Parses the Netlink message at the given offset into data.
+
+    Returns:
+      A tuple ((msg, attributes), offset), where offset is the offset of the
+      next message. For NLMSG_ERROR and NLMSG_DONE, msg and attributes are None.
+    """
+    nlmsghdr, body_offset = NLMsgHdr.ReadFrom(data, offset)
 
     if nlmsghdr.type == NLMSG_ERROR or nlmsghdr.type == NLMSG_DONE:
+      self._Debug("  %s" % nlmsghdr)
       print("done")
-      return (None, None), data
+      return (None, None), body_offset
 
-    nlmsg, data = cstruct.Read(data, msgtype)
-    self._Debug("    %s" % nlmsg)
+    body_len = nlmsghdr.length - len(nlmsghdr)
+    msg = self._DecodeNLMsg(data, nlmsghdr, body_offset, body_len, msgtype)
+    return msg, body_offset + body_len
 
-    # Parse the attributes in the nlmsg.
-    attrlen = nlmsghdr.length - len(nlmsghdr) - len(nlmsg)
-    attributes = self._ParseAttributes(nlmsghdr.type, nlmsg, data[:attrlen], [])
-    data = data[attrlen:]
-    return (nlmsg, attributes), data
+  def _ParseNLMsg(self, data, msgtype):
+    """Parses a Netlink message into a header and a dictionary of attributes."""
+    msg, offset = self._ReadNLMsg(data, 0, msgtype)
+    return msg, data[offset:]
 
   def _GetMsg(self, msgtype):
     data = self._Recv()
     if NLMsgHdr(data).type == NLMSG_ERROR:
       self._ParseAck(data)
-    return self._ParseNLMsg(data, msgtype)[0]
+    return self._ReadNLMsg(data, 0, msgtype)[0]
 
   def _GetMsgList(self, msgtype, data, expect_done):
     out = []
-    while data:
-      msg, data = self._ParseNLMsg(data, msgtype)
-      if msg is None:
+    data = memoryview(data)
+    for hdr, body_offset, body_len in self._IndexNLMsgs(data):
+      if hdr.type == NLMSG_ERROR or hdr.type == NLMSG_DONE:
         break
-      out.append(msg)
+      out.append(self._DecodeNLMsg(data, hdr, body_offset, body_len, msgtype))
     if expect_done:
       self._ExpectDone()
     return out
 
-  def _Dump(self, command, msg, msgtype, attrs=b""):
-    """Sends a dump request and returns a list of decoded messages.
+  def IterDump(self, command, msg, msgtype, attrs=b""):
+    """Sends a dump request and returns an iterator over the decoded messages.
+
+    Messages are decoded as each datagram is received, so the dump is never
+    held in memory all at once, except in thread-safe mode (see
+    MakeThreadSafe). If the caller stops early, it must close the iterator (or
+    drop all references to it) before using the socket again. This reads and
+    discards the rest of the dump.
 
     Args:
       command: An integer, the command to run (e.g., RTM_NEWADDR).
       msg: A struct, the request (e.g., a RTMsg). May be None.
       msgtype: A cstruct.Struct, the data type to parse the dump results as.
       attrs: A string, the raw bytes of any request attributes to include.
+        May also be a buffer returned by _NlRequestBuffer that already
+        contains msg and the attributes, in which case msg must be None.
 
     Returns:
-      A list of (msg, attrs) tuples where msg is of type msgtype and attrs is
-      a dict of attributes.
+      An iterator of (msg, attrs) tuples where msg is of type msgtype and attrs
+      is a dict of attributes.
     """
     # Create a netlink dump request containing the msg.
     flags = NLM_F_DUMP | NLM_F_REQUEST
-    msg = b"" if msg is None else msg.Pack()
-    length = len(NLMsgHdr) + len(msg) + len(attrs)
-    nlmsghdr = NLMsgHdr((length, command, flags, self.seq, self.pid))
+    if isinstance(attrs, cstruct.PackBuffer):
+      buf = attrs
+    else:
+      buf = self._NlRequestBuffer()
+      if msg is not None:
+        buf.Append(msg)
+      buf.Append(attrs)
 
-    # Send the request.
-    request = nlmsghdr.Pack() + msg + attrs
-    self.MaybeDebugCommand(command, flags, request)
-    self._Send(request)
+    replies = self._IterDumpReplies(command, buf, flags, msgtype)
+    # Runs up to the first yield, which sends the request now rather than when
+    # iteration starts.
+    next(replies)
+    return replies
 
-    # Keep reading netlink messages until we get a NLMSG_DONE.
-    out = []
+  def _IterDumpReplies(self, command, buf, flags, msgtype):
+    stats = self.stats
+    start = time.monotonic() if stats is not None else None
+    if self._dispatcher is None:
+      self._SendDumpRequest(command, buf, flags)
+      recv = self._RecvInto
+    else:
+      # The kernel only runs one dump at a time on each socket, so in
+      # thread-safe mode, other threads wait until this dump is received.
+      # Receive all of it now, so that the lock isn't held while the caller
+      # is suspended at a yield.
+      with self._dump_lock:
+        self._SendDumpRequest(command, buf, flags)
+        recv = collections.deque(self._RecvDump()).popleft
+
+    # Keep reading netlink messages until we get a NLMSG_DONE. The kernel
+    # may put the NLMSG_DONE in the same datagram as the last few messages.
+    done = False
+    data, offset = b"", 0
+    try:
+      yield  # See IterDump.
+      while True:
+        data, offset = None, 0
+        data = recv()
+        for hdr, body_offset, body_len in self._IndexNLMsgs(data):
+          # If we stop at this message, _DrainDump starts here.
+          offset = body_offset - len(hdr)
+          if hdr.type == NLMSG_DONE:
+            done = True
+            return
+          elif hdr.type == NLMSG_ERROR:
+            # Likely means that the kernel didn't like our dump request.
+            # Parse the error and throw an exception.
+            done = True
+            self._ParseAck(data[offset:])
+            return
+          yield self._DecodeNLMsg(data, hdr, body_offset, body_len, msgtype)
+    finally:
+      # If the caller stopped early or a message failed to parse, read the
+      # rest of the dump so the next request doesn't see it. Don't try if the
+      # socket itself failed, or if the dump has already been received.
+      if not done and data is not None and self._dispatcher is None:
+        self._DrainDump(data, offset)
+      if stats is not None:
+        stats.Time(self._CommandName(command), "dump_duration",
+                   time.monotonic() - start)
+
+  def _SendDumpRequest(self, command, buf, flags):
+    with self._lock:
+      request = self._FinishNlRequest(command, buf, flags)
+      self.MaybeDebugCommand(command, flags, request)
+      self._Send(request)
+
+  def _RecvDump(self):
+    """Receives a whole dump. Returns a list of its datagrams."""
+    datagrams = []
     while True:
-      data = self._Recv()
-      response_type = NLMsgHdr(data).type
-      if response_type == NLMSG_DONE:
-        break
-      elif response_type == NLMSG_ERROR:
-        # Likely means that the kernel didn't like our dump request.
-        # Parse the error and throw an exception.
-        self._ParseAck(data)
-      out.extend(self._GetMsgList(msgtype, data, False))
+      data = self._RecvInto()
+      datagrams.append(data)
+      for hdr, _, _ in self._IndexNLMsgs(data):
+        if hdr.type == NLMSG_DONE or hdr.type == NLMSG_ERROR:
+          return datagrams
 
-    return out
+  def _DrainDump(self, data=b"", offset=0):
+    """Discards dump messages up to and including the NLMSG_DONE.
+
+    Args:
+      data: The last datagram received, if any.
+      offset: The offset in data of the first message not yet consumed.
+    """
+    while True:
+      while offset < len(data):
+        if offset + len(NLMsgHdr) > len(data):
+          # Garbage. Give up rather than wait for a DONE we may have skipped.
+          return
+        hdr = NLMsgHdr.ReadFrom(data, offset)[0]
+        if hdr.type == NLMSG_DONE or hdr.type == NLMSG_ERROR:
+          return
+        if hdr.length < len(hdr) or offset + hdr.length > len(data):
+          # Garbage. Give up rather than loop forever, or wait for a DONE we
+          # may have skipped.
+          return
+        offset += hdr.length + util.GetPadLength(NLMSG_ALIGNTO, hdr.length)
+      data, offset = self._RecvInto(), 0
+
+  def _Dump(self, command, msg, msgtype, attrs=b""):
+    """Sends a dump request and returns a list of decoded messages.
+
+    Takes the same arguments as IterDump.
+
+    Returns:
+      A list of (msg, attrs) tuples where msg is of type msgtype and attrs is
+      a dict of attributes.
+    """
+    return list(self.IterDump(command, msg, msgtype, attrs))
@@ -0,0 +1,420 @@
+#!/usr/bin/python3
+#
+# Copyright 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmarks for building and parsing netlink messages.
+
+Requests are built by the real message builders but never sent, and dumps are
+parsed from synthetic byte fixtures. So this does not need root or a kernel
+that supports the families involved.
+
+Not part of all_tests.py. Run directly, or as part of benchmarks.py:
+
+  $ ./netlink_benchmark.py
+
+To benchmark parsing real dumps instead, replay a capture recorded by
+netlink_capture.py:
+
+  $ ./netlink_benchmark.py --capture /tmp/state.nlcap
+"""
+
+import argparse
+from socket import *  # pylint: disable=wildcard-import
+import struct
+import sys
+
+import benchmarks
+import cstruct_benchmark
+import iproute
+import netlink
+import netlink_capture
+import sock_diag
+import xfrm
+
+
+# Messages (or attributes) built or parsed per operation.
+_BATCH = 1000
+
+
+class _NullSendMixin(object):
+  """Counts the bytes of each request instead of sending it."""
+
+  def __init__(self):
+    # Don't call the superclass constructor: we don't need a socket.
+    self.sock = None
+    self.seq = 0
+    self.pid = 0
+    self.bytes_sent = 0
+
+  def _Send(self, msg):
+    self.bytes_sent += len(msg)
+    self.seq += 1
+
+  def _ExpectAck(self):
+    pass
+
+
+class _NullNetlink(_NullSendMixin, netlink.NetlinkSocket):
+  pass
+
+
+class _NullIPRoute(_NullSendMixin, iproute.IPRoute):
+  pass
+
+
+class _NullXfrm(_NullSendMixin, xfrm.Xfrm):
+  pass
+
+
+class _NullSockDiag(_NullSendMixin, sock_diag.SockDiag):
+  pass
+
+
+class _ReplayIPRoute(iproute.IPRoute):
+  """Answers every request with the same datagrams, over a Unix socket pair.
+
+  This runs the real receive code, with a real socket, without needing the
+  kernel to generate a large dump.
+  """
+
+  def __init__(self, datagrams):
+    # Don't call the superclass constructor: we don't need a netlink socket.
+    self.sock, self.peer = socketpair(AF_UNIX, SOCK_DGRAM)
+    self.seq = 0
+    self.pid = 0
+    self.datagrams = datagrams
+
+  def close(self):
+    self.peer.close()
+    super(_ReplayIPRoute, self).close()
+
+  def _Send(self, msg):
+    self.seq += 1
+    for datagram in self.datagrams:
+      self.peer.send(datagram)
+
+
+class _ReplayIPRouteRecv(_ReplayIPRoute):
+  """Allocates a new buffer for every datagram, like sock.recv does."""
+
+  def _RecvInto(self):
+    return memoryview(self.sock.recv(self.BUFSIZE))
+
+
+class _CaptureIPRoute(netlink_capture.ReplayMixin, iproute.IPRoute):
+  pass
+
+
+class _CaptureSockDiag(netlink_capture.ReplayMixin, sock_diag.SockDiag):
+  pass
+
+
+class _CaptureXfrm(netlink_capture.ReplayMixin, xfrm.Xfrm):
+  pass
+
+
+# Netlink family -> (replay class, function that returns the reply struct for
+# a message type).
+_CAPTURE_FAMILIES = {
+    netlink.NETLINK_ROUTE: (_CaptureIPRoute, iproute.CommandStruct),
+    netlink.NETLINK_SOCK_DIAG: (_CaptureSockDiag,
+                                lambda unused_type: sock_diag.InetDiagMsg),
+    netlink.NETLINK_XFRM: (_CaptureXfrm, {
+        xfrm.XFRM_MSG_NEWSA: xfrm.XfrmUsersaInfo,
+        xfrm.XFRM_MSG_NEWPOLICY: xfrm.XfrmUserpolicyInfo}.get),
+}
+
+
+def _AddRoutes(ipr):
+  for i in range(_BATCH // 2):
+    ipr.AddRoute(6, 100 + i % 10, "2001:db8:%x::" % i, 64,
+                 "fe80::1", 2)
+    ipr.AddRoute(4, 100 + i % 10, "10.%d.%d.0" % (i // 256, i % 256), 24,
+                 "192.0.2.1", 2)
+
+
+_CRYPT = (xfrm.XfrmAlgo((xfrm.XFRM_EALG_CBC_AES, 128)), b"\x01" * 16)
+_AUTH = (xfrm.XfrmAlgoAuth((xfrm.XFRM_AALG_HMAC_SHA1, 160, 96)),
+         b"\x02" * 20)
+
+
+def _AddSaInfos(x):
+  for i in range(_BATCH):
+    x.AddSaInfo("2001:db8::1", "2001:db8::2", 0x1234 + i, xfrm.XFRM_MODE_TUNNEL,
+                i, _CRYPT, _AUTH, None, None, xfrm.ExactMatchMark(i), 0x10)
+
+
+def _ConcatAttrs(sock):
+  data = b""
+  for i in range(_BATCH):
+    data += sock._NlAttrU32(iproute.RTA_PRIORITY, i)
+  sock._SendNlRequest(iproute.RTM_NEWROUTE, data, 0)
+
+
+def _AppendAttrs(sock):
+  buf = sock._NlRequestBuffer()
+  for i in range(_BATCH):
+    sock._AppendNlAttrU32(buf, iproute.RTA_PRIORITY, i)
+  sock._SendNlRequest(iproute.RTM_NEWROUTE, buf, 0)
+
+
+def _CreateTunnels(ipr):
+  for i in range(_BATCH):
+    ipr.CreateVirtualTunnelInterface("vti%d" % i, "2001:db8::1", "2001:db8::2",
+                                     i, i)
+
+
+# How deeply the nested attribute benchmarks nest.
+_DEPTH = 100
+
+
+def _ConcatNested(sock):
+  data = b""
+  for i in range(_DEPTH):
+    data = sock._NlAttr(iproute.RTA_METRICS,
+                        sock._NlAttrU32(iproute.RTAX_MTU, i) + data)
+  sock._SendNlRequest(iproute.RTM_NEWROUTE, data, 0)
+
+
+def _StartEndNested(sock):
+  buf = sock._NlRequestBuffer()
+  starts = []
+  for i in range(_DEPTH):
+    starts.append(sock._StartNlAttr(buf, iproute.RTA_METRICS))
+    sock._AppendNlAttrU32(buf, iproute.RTAX_MTU, i)
+  for start in reversed(starts):
+    sock._EndNlAttr(buf, start)
+  sock._SendNlRequest(iproute.RTM_NEWROUTE, buf, 0)
+
+
+def _BuildBenchmark(name, sock, build):
+  # Build once to find out how many bytes each operation produces.
+  build(sock)
+  nbytes = sock.bytes_sent
+  return benchmarks.Benchmark(name, lambda: build(sock), 5, nbytes)
+
+
+def DumpFixture(sock, command, msg, attrs, count=_BATCH):
+  """Returns a synthetic dump of count identical messages.
+
+  Args:
+    sock: A NetlinkSocket, used to build the attributes.
+    command: An integer, the netlink message type.
+    msg: A struct, e.g., an RTMsg.
+    attrs: A list of (nla_type, bytes) tuples.
+    count: The number of messages.
+
+  Returns:
+    A bytes object containing the messages. There is no NLMSG_DONE.
+  """
+  body = msg.Pack() + b"".join(sock._NlAttr(t, d) for t, d in attrs)
+  messages = []
+  for seq in range(count):
+    hdr = netlink.NLMsgHdr((len(netlink.NLMsgHdr) + len(body), command,
+                            netlink.NLM_F_MULTI, seq, 0))
+    messages.append(hdr.Pack() + body)
+  return b"".join(messages)
+
+
+def SplitDump(data, size=32768):
+  """Splits a dump fixture into datagrams and appends an NLMSG_DONE.
+
+  Args:
+    data: A dump fixture, as returned by DumpFixture.
+    size: The maximum size of each datagram. The kernel uses up to 32 KiB.
+
+  Returns:
+    A list of bytes objects, one for each datagram.
+  """
+  datagrams = []
+  start = end = 0
+  while end < len(data):
+    msglen = netlink.NLMsgHdr.ReadFrom(data, end)[0].length
+    if end + msglen - start > size:
+      datagrams.append(data[start:end])
+      start = end
+    end += msglen
+  done = netlink.NLMsgHdr((len(netlink.NLMsgHdr) + 4, netlink.NLMSG_DONE,
+                           netlink.NLM_F_MULTI, 0, 0))
+  datagrams.append(data[start:] + done.Pack() + b"\x00" * 4)
+  return datagrams
+
+
+def _Drain(iterator):
+  for _ in iterator:
+    pass
+
+
+def _U32(value):
+  return struct.pack("=I", value)
+
+
+def _DumpBenchmarks():
+  """Benchmarks that parse large synthetic dumps."""
+  fixture = cstruct_benchmark.Fixture
+  ipr = _NullIPRoute()
+  links = DumpFixture(
+      ipr, iproute.RTM_NEWLINK,
+      iproute.IfinfoMsg((AF_UNSPEC, 0, 1, 2, 0x11043, 0)),
+      [(iproute.IFLA_IFNAME, b"wlan0\x00"),
+       (iproute.IFLA_MTU, _U32(1500)),
+       (iproute.IFLA_STATS64, fixture(iproute.RtnlLinkStats64))])
+  routes = DumpFixture(
+      ipr, iproute.RTM_NEWROUTE,
+      iproute.RTMsg((AF_INET6, 64, 0, 0, 254, iproute.RTPROT_STATIC,
+                     iproute.RT_SCOPE_UNIVERSE, iproute.RTN_UNICAST, 0)),
+      [(iproute.RTA_TABLE, _U32(254)),
+       (iproute.RTA_DST, inet_pton(AF_INET6, "2001:db8::")),
+       (iproute.RTA_GATEWAY, inet_pton(AF_INET6, "fe80::1")),
+       (iproute.RTA_OIF, _U32(2)),
+       (iproute.RTA_PRIORITY, _U32(1024))])
+
+  diag = _NullSockDiag()
+  diag_msg = sock_diag.InetDiagMsg(fixture(sock_diag.InetDiagMsg))
+  diag_msg.family = AF_INET6
+  sockets = DumpFixture(
+      diag, sock_diag.SOCK_DIAG_BY_FAMILY, diag_msg,
+      [(sock_diag.INET_DIAG_INFO, fixture(sock_diag.TcpInfo)),
+       (sock_diag.INET_DIAG_CONG, b"cubic\x00"),
+       (sock_diag.INET_DIAG_SHUTDOWN, b"\x00"),
+       (sock_diag.INET_DIAG_MARK, _U32(0x10064))])
+
+  x = _NullXfrm()
+  sas = DumpFixture(
+      x, xfrm.XFRM_MSG_NEWSA,
+      xfrm.XfrmUsersaInfo(fixture(xfrm.XfrmUsersaInfo)),
+      [(xfrm.XFRMA_ALG_CRYPT, _CRYPT[0].Pack() + _CRYPT[1]),
+       (xfrm.XFRMA_ALG_AUTH_TRUNC, _AUTH[0].Pack() + _AUTH[1]),
+       (xfrm.XFRMA_MARK, xfrm.ExactMatchMark(7).Pack())])
+
+  for name, sock, msgtype, data in [
+      ("links", ipr, iproute.IfinfoMsg, links),
+      ("routes", ipr, iproute.RTMsg, routes),
+      ("InetDiagMsg+TcpInfo", diag, sock_diag.InetDiagMsg, sockets),
+      ("XfrmUsersaInfo", x, xfrm.XfrmUsersaInfo, sas)]:
+    yield benchmarks.Benchmark(
+        "Parse %d %s" % (_BATCH, name),
+        lambda s=sock, m=msgtype, d=data: s._GetMsgList(m, d, False),
+        5, len(data))
+    # Attributes are decoded when read, so also measure reading all of them.
+    yield benchmarks.Benchmark(
+        "Parse %d %s, decode all" % (_BATCH, name),
+        lambda s=sock, m=msgtype, d=data: [
+            dict(a) for _, a in s._GetMsgList(m, d, False)],
+        5, len(data))
+
+  # What DumpRoutes does: read one attribute of each route.
+  yield benchmarks.Benchmark(
+      "Parse %d routes, read RTA_TABLE" % _BATCH,
+      lambda: [a["RTA_TABLE"] for _, a in ipr._GetMsgList(iproute.RTMsg,
+                                                          routes, False)],
+      5, len(routes))
+
+  # Receive the routes over a real socket. The peak memory shows the receive
+  # buffers allocated, as well as the parsed routes if they are kept.
+  datagrams = SplitDump(routes)
+  nbytes = sum(len(d) for d in datagrams)
+  recv = _ReplayIPRouteRecv(datagrams)
+  recv_into = _ReplayIPRoute(datagrams)
+  yield benchmarks.Benchmark(
+      "DumpRoutes %d routes, recv" % _BATCH,
+      lambda: recv.DumpRoutes(6, 254), 5, nbytes)
+  yield benchmarks.Benchmark(
+      "DumpRoutes %d routes, recv_into" % _BATCH,
+      lambda: recv_into.DumpRoutes(6, 254), 5, nbytes)
+  yield benchmarks.Benchmark(
+      "IterRoutes %d routes, recv" % _BATCH,
+      lambda: _Drain(recv.IterRoutes(6, 254)), 5, nbytes)
+  yield benchmarks.Benchmark(
+      "IterRoutes %d routes, recv_into" % _BATCH,
+      lambda: _Drain(recv_into.IterRoutes(6, 254)), 5, nbytes)
+
+  # Just the attributes of one very long message, without decoding them.
+  nl = _NullNetlink()
+  attrs = b"".join(nl._NlAttrU32(i, i) for i in range(_BATCH))
+  yield benchmarks.Benchmark(
+      "_ParseAttributes, %d attributes" % _BATCH,
+      lambda: nl._ParseAttributes(0, None, attrs, []), 5, len(attrs))
+
+
+def CaptureBenchmarks(filename):
+  """Yields benchmarks that replay each dump in a capture and decode it all."""
+  records = netlink_capture.ReadCapture(filename)
+  for family, portid in sorted(set((r.family, r.portid) for r in records)):
+    if family not in _CAPTURE_FAMILIES:
+      continue
+    cls, msgtypes = _CAPTURE_FAMILIES[family]
+    stream = [r for r in records if (r.family, r.portid) == (family, portid)]
+    sock = cls(stream)
+    for index, record in enumerate(stream):
+      if record.direction != netlink_capture.SEND:
+        continue
+      hdr = netlink.NLMsgHdr.ReadFrom(record.data)[0]
+      if hdr.flags & netlink.NLM_F_DUMP != netlink.NLM_F_DUMP:
+        continue
+      replies = []
+      for reply in stream[index + 1:]:
+        if reply.direction == netlink_capture.SEND:
+          break
+        replies.append(reply.data)
+      # Don't count the NLMSG_DONE.
+      count = sum(1 for data in replies
+                  for _ in netlink.NetlinkSocket._IndexNLMsgs(data)) - 1
+      if count <= 0:
+        # An empty dump, or an error.
+        continue
+      msgtype = msgtypes(netlink.NLMsgHdr.ReadFrom(replies[0])[0].type)
+      if msgtype is None:
+        continue
+      body = record.data[len(netlink.NLMsgHdr):hdr.length]
+      yield benchmarks.Benchmark(
+          "Replay %s type %d #%d, %d messages" % (
+              type(sock).__name__[len("_Capture"):], hdr.type, index, count),
+          lambda s=sock, c=hdr.type, m=msgtype, b=body: [
+              dict(a) for _, a in s.IterDump(c, None, m, b)],
+          5, sum(len(data) for data in replies))
+
+
+def Benchmarks():
+  """Yields the netlink benchmarks."""
+  yield _BuildBenchmark("Build %d AddRoute (v4 + v6)" % _BATCH,
+                        _NullIPRoute(), _AddRoutes)
+  yield _BuildBenchmark("Build %d AddSaInfo" % _BATCH, _NullXfrm(),
+                        _AddSaInfos)
+  yield _BuildBenchmark("Build %d CreateVirtualTunnelInterface" % _BATCH,
+                        _NullIPRoute(), _CreateTunnels)
+  # One large request, e.g., a long list of attributes.
+  yield _BuildBenchmark("Build %d attrs, concatenated" % _BATCH,
+                        _NullIPRoute(), _ConcatAttrs)
+  yield _BuildBenchmark("Build %d attrs, PackBuffer" % _BATCH,
+                        _NullIPRoute(), _AppendAttrs)
+  yield _BuildBenchmark("Build %d-deep nest, concatenated" % _DEPTH,
+                        _NullIPRoute(), _ConcatNested)
+  yield _BuildBenchmark("Build %d-deep nest, in place" % _DEPTH,
+                        _NullIPRoute(), _StartEndNested)
+  yield benchmarks.Benchmark(
+      "_GetConstantName",
+      lambda: netlink.NetlinkSocket._GetConstantName("iproute", 4, "RTA_"),
+      100000)
+  for benchmark in _DumpBenchmarks():
+    yield benchmark
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(add_help=False)
+  parser.add_argument("--capture")
+  args, argv = parser.parse_known_args(sys.argv[1:])
+  sys.exit(benchmarks.Main(argv, CaptureBenchmarks(args.capture)
+                           if args.capture else Benchmarks()))
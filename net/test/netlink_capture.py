@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+#
+# Copyright 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Records netlink traffic to a file, and replays it without a kernel.
+
+A capture holds every request sent and every datagram received on one or more
+netlink sockets. Replaying a capture runs the real parsing code of IPRoute,
+SockDiag, Xfrm, etc. on the recorded replies, so dumps taken on a real device
+can be profiled and benchmarked on any machine:
+
+  # Record a snapshot of this machine's state.
+  $ ./netlink_capture.py /tmp/state.nlcap
+
+  # Benchmark parsing it.
+  $ ./netlink_benchmark.py --capture /tmp/state.nlcap
+
+Or from code:
+
+  writer = netlink_capture.Writer("/tmp/routes.nlcap")
+  netlink_capture.Record(ipr, writer)
+  ipr.DumpRoutes(6, 254)
+  netlink_capture.StopRecording(ipr)
+  writer.close()
+
+  class ReplayIPRoute(netlink_capture.ReplayMixin, iproute.IPRoute):
+    pass
+
+  ipr = ReplayIPRoute(netlink_capture.ReadCapture("/tmp/routes.nlcap"))
+  routes = ipr.DumpRoutes(6, 254)
+"""
+
+import collections
+import errno
+import socket
+import struct
+import threading
+import time
+
+import cstruct
+import netlink
+
+# The first bytes of a capture file. The last byte is the format version.
+MAGIC = b"NLCAP\x00\x00\x01"
+
+# Record directions.
+SEND = 0
+RECV = 1
+
+# Each record is a RecordHeader followed by length bytes of data: one request
+# as passed to send(), or one datagram as received.
+# These aren't constants, they're classes. So, pylint: disable=invalid-name
+RecordHeader = cstruct.Struct(
+    "RecordHeader", "=dBxHII", "timestamp direction family portid length")
+
+# A record read from a capture.
+#   timestamp: A float, the time.time() at which it was sent or received.
+#   direction: SEND or RECV.
+#   family: The netlink family of the socket, e.g., netlink.NETLINK_ROUTE.
+#   portid: The netlink port ID of the socket.
+#   data: A bytes object.
+CaptureRecord = collections.namedtuple(
+    "CaptureRecord", ["timestamp", "direction", "family", "portid", "data"])
+
+# The sequence number and port ID of a netlink header.
+_NLMSG_SEQ_PID = struct.Struct("=II")
+_NLMSG_SEQ = struct.Struct("=I")
+_SEQ_OFFSET = 8
+
+
+class Writer(object):
+  """Writes records to a capture file. Can be shared by several sockets."""
+
+  def __init__(self, filename):
+    self._file = open(filename, "wb")
+    self._file.write(MAGIC)
+    self._lock = threading.Lock()
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+  def Write(self, direction, family, portid, data):
+    header = RecordHeader((time.time(), direction, family, portid, len(data)))
+    with self._lock:
+      self._file.write(header.Pack())
+      self._file.write(data)
+
+
+def ReadCapture(filename, family=None):
+  """Reads a capture file.
+
+  Args:
+    filename: The name of the file.
+    family: If not None, only return records of this netlink family.
+
+  Returns:
+    A list of CaptureRecords, in the order they were written.
+
+  Raises:
+    ValueError: The file is not a capture, or is truncated.
+  """
+  with open(filename, "rb") as f:
+    data = f.read()
+  if not data.startswith(MAGIC):
+    raise ValueError("%s is not a netlink capture" % filename)
+  records = []
+  offset = len(MAGIC)
+  while offset < len(data):
+    if offset + len(RecordHeader) > len(data):
+      raise ValueError("Truncated record header at offset %d" % offset)
+    header, offset = RecordHeader.ReadFrom(data, offset)
+    end = offset + header.length
+    if end > len(data):
+      raise ValueError("Truncated record at offset %d" % offset)
+    if family is None or header.family == family:
+      records.append(CaptureRecord(header.timestamp, header.direction,
+                                   header.family, header.portid,
+                                   data[offset:end]))
+    offset = end
+  return records
+
+
+class _RecordingSocket(object):
+  """Wraps a netlink socket, and writes what is sent and received to a Writer.
+
+  Everything else, e.g., fileno() or setsockopt(), goes to the real socket.
+  """
+
+  def __init__(self, sock, writer):
+    self.sock = sock
+    self._writer = writer
+    self._family = sock.proto
+    self._portid = sock.getsockname()[0]
+
+  def __getattr__(self, name):
+    return getattr(self.sock, name)
+
+  def send(self, data, flags=0):
+    sent = self.sock.send(data, flags)
+    self._writer.Write(SEND, self._family, self._portid, data[:sent])
+    return sent
+
+  def recv(self, bufsize, flags=0):
+    data = self.sock.recv(bufsize, flags)
+    if not flags & socket.MSG_PEEK:
+      self._writer.Write(RECV, self._family, self._portid, data)
+    return data
+
+  def recv_into(self, buf, nbytes=0, flags=0):
+    datalen = self.sock.recv_into(buf, nbytes, flags)
+    if not flags & socket.MSG_PEEK:
+      # With MSG_TRUNC, datalen can be more than was copied.
+      copied = min(datalen, nbytes or len(buf))
+      self._writer.Write(RECV, self._family, self._portid,
+                         memoryview(buf)[:copied])
+    return datalen
+
+
+def Record(nl, writer):
+  """Starts writing everything sent and received on a NetlinkSocket.
+
+  Args:
+    nl: A NetlinkSocket.
+    writer: A Writer. Several sockets can record to the same one.
+  """
+  if isinstance(nl.sock, _RecordingSocket):
+    raise ValueError("Already recording")
+  nl.sock = _RecordingSocket(nl.sock, writer)
+
+
+def StopRecording(nl):
+  """Stops recording a NetlinkSocket. Does not close the Writer."""
+  if isinstance(nl.sock, _RecordingSocket):
+    nl.sock = nl.sock.sock
+
+
+def _RequestKey(data):
+  """Returns a request with the sequence numbers and port IDs zeroed.
+
+  Two requests with the same key ask the kernel for the same thing.
+  """
+  key = bytearray(data)
+  for hdr, body_offset, _ in netlink.NetlinkSocket._IndexNLMsgs(data):
+    _NLMSG_SEQ_PID.pack_into(key, body_offset - len(hdr) + _SEQ_OFFSET, 0, 0)
+  return bytes(key)
+
+
+class ReplaySocket(object):
+  """Answers requests with the replies recorded in a capture.
+
+  Implements the parts of the socket interface that NetlinkSocket uses. Each
+  request that is sent is looked up in the capture, ignoring sequence numbers
+  and port IDs. The datagrams that were received after it are then returned
+  by recv, with their sequence numbers changed to match the request. If the
+  same request was recorded several times, the replays take turns, so the
+  capture can be replayed over and over, e.g., by benchmarks.
+  """
+
+  def __init__(self, records):
+    """Constructor.
+
+    Args:
+      records: A list of CaptureRecords, all from the same socket.
+
+    Raises:
+      ValueError: The records are from more than one socket.
+    """
+    sockets = set((r.family, r.portid) for r in records)
+    if len(sockets) > 1:
+      raise ValueError("Capture has records from %d sockets" % len(sockets))
+    self.proto, self._portid = sockets.pop() if sockets else (0, 0)
+    self._records = records
+    # Request key -> indexes in records of the requests with that key.
+    self._requests = collections.defaultdict(list)
+    for index, record in enumerate(records):
+      if record.direction == SEND:
+        self._requests[_RequestKey(record.data)].append(index)
+    # Where to look next in the list of indexes for each request key.
+    self._turns = collections.Counter()
+    self._replies = collections.deque()
+
+  def close(self):
+    pass
+
+  def fileno(self):
+    return -1
+
+  def getsockname(self):
+    return (self._portid, 0)
+
+  def setsockopt(self, *unused_args):
+    pass
+
+  def setblocking(self, unused_flag):
+    pass
+
+  def send(self, data, unused_flags=0):
+    key = _RequestKey(data)
+    indexes = self._requests.get(key)
+    if not indexes:
+      hdr = netlink.NLMsgHdr.ReadFrom(data)[0]
+      raise ValueError("Request of type %d was not recorded" % hdr.type)
+    index = indexes[self._turns[key] % len(indexes)]
+    self._turns[key] += 1
+
+    # Replies have the sequence number of the request they answer. Renumber
+    # them to match this request.
+    delta = (netlink.NLMsgHdr.ReadFrom(data)[0].seq -
+             netlink.NLMsgHdr.ReadFrom(self._records[index].data)[0].seq)
+    self._replies.clear()
+    for record in self._records[index + 1:]:
+      if record.direction == SEND:
+        break
+      self._replies.append(self._Renumber(record.data, delta))
+    return len(data)
+
+  @staticmethod
+  def _Renumber(data, delta):
+    if not delta:
+      return data
+    data = bytearray(data)
+    for hdr, body_offset, _ in netlink.NetlinkSocket._IndexNLMsgs(data):
+      # Multicast notifications have sequence number 0.
+      if hdr.seq:
+        _NLMSG_SEQ.pack_into(data, body_offset - len(hdr) + _SEQ_OFFSET,
+                             (hdr.seq + delta) & 0xffffffff)
+    return bytes(data)
+
+  def recv(self, bufsize, flags=0):
+    data = self._NextReply(flags)
+    return data[:bufsize]
+
+  def recv_into(self, buf, nbytes=0, flags=0):
+    data = self._NextReply(flags)
+    nbytes = min(len(data), nbytes or len(buf))
+    buf[:nbytes] = data[:nbytes]
+    return len(data) if flags & socket.MSG_TRUNC else nbytes
+
+  def _NextReply(self, flags):
+    if not self._replies:
+      # A real socket would block forever.
+      raise BlockingIOError(errno.EAGAIN, "No more recorded replies")
+    if flags & socket.MSG_PEEK:
+      return self._replies[0]
+    return self._replies.popleft()
+
+
+class ReplayMixin(object):
+  """Makes a NetlinkSocket subclass use a ReplaySocket instead of the kernel.
+
+  e.g.:
+
+    class ReplayIPRoute(netlink_capture.ReplayMixin, iproute.IPRoute):
+      pass
+  """
+
+  def __init__(self, records):
+    # Don't call the superclass constructor: we don't need a netlink socket.
+    self.sock = ReplaySocket(records)
+    self.seq = 0
+    self.pid = 0
+
+
+if __name__ == "__main__":
+  # pylint: disable=g-import-not-at-top
+  import sys
+
+  import iproute
+  import sock_diag
+  import xfrm
+
+  if len(sys.argv) != 2:
+    sys.exit("Usage: %s CAPTURE_FILE" % sys.argv[0])
+  out = Writer(sys.argv[1])
+  ipr = iproute.IPRoute()
+  diag = sock_diag.SockDiag()
+  x = xfrm.Xfrm()
+  for nl in ipr, diag, x:
+    Record(nl, out)
+  ipr.Snapshot(workers=1)
+  diag.DumpAllInetSockets(socket.IPPROTO_TCP, b"")
+  diag.DumpAllInetSockets(socket.IPPROTO_UDP, b"")
+  try:
+    x.DumpSaInfo()
+    x.DumpPolicyInfo()
+  except IOError:
+    # e.g., the kernel doesn't support XFRM, or we're not root.
+    pass
+  out.close()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+#
+# Copyright 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import tempfile
+import unittest
+
+import iproute
+import namespace
+import netlink
+import netlink_capture
+
+
+class ReplayIPRoute(netlink_capture.ReplayMixin, iproute.IPRoute):
+  pass
+
+
+class CaptureTest(namespace.NetworkNamespaceTest):
+
+  TABLE = 2345
+
+  def testRecordAndReplay(self):
+    fd, filename = tempfile.mkstemp(suffix=".nlcap")
+    os.close(fd)
+    self.addCleanup(os.unlink, filename)
+    dests = ["2001:db8:%d::" % i for i in range(3)]
+
+    ipr = iproute.IPRoute()
+    # The replay starts from sequence number 0, so make the recording differ.
+    ipr.GetIfIndex("lo")
+    writer = netlink_capture.Writer(filename)
+    netlink_capture.Record(ipr, writer)
+    try:
+      links = ipr.DumpLinks()
+      with ipr.Batch():
+        for dest in dests:
+          ipr.AddRoute(6, self.TABLE, dest, 48, None, 1)
+      routes = ipr.DumpRoutes(6, self.TABLE)
+      with self.assertRaises(IOError) as context:
+        ipr.AddRoute(6, self.TABLE, dests[0], 48, None, 1)
+      self.assertEqual(errno.EEXIST, context.exception.errno)
+    finally:
+      for dest in dests:
+        ipr.DelRoute(6, self.TABLE, dest, 48, None, 1)
+      netlink_capture.StopRecording(ipr)
+      writer.close()
+      ipr.close()
+
+    records = netlink_capture.ReadCapture(filename)
+    self.assertEqual(netlink_capture.SEND, records[0].direction)
+    self.assertTrue(all(r.family == netlink.NETLINK_ROUTE for r in records))
+    self.assertEqual([], netlink_capture.ReadCapture(filename,
+                                                     netlink.NETLINK_XFRM))
+
+    # Replays get the same results, and can be repeated.
+    replay = ReplayIPRoute(records)
+    for _ in range(2):
+      self.assertEqual([(m, dict(a)) for m, a in links],
+                       [(m, dict(a)) for m, a in replay.DumpLinks()])
+    with replay.Batch():
+      for dest in dests:
+        replay.AddRoute(6, self.TABLE, dest, 48, None, 1)
+    replayed = replay.DumpRoutes(6, self.TABLE)
+    self.assertEqual(3, len(replayed))
+    self.assertEqual([(m, dict(a)) for m, a in routes],
+                     [(m, dict(a)) for m, a in replayed])
+    with self.assertRaises(IOError) as context:
+      replay.AddRoute(6, self.TABLE, dests[0], 48, None, 1)
+    self.assertEqual(errno.EEXIST, context.exception.errno)
+
+    # Requests that weren't recorded fail.
+    with self.assertRaises(ValueError):
+      replay.DumpRules(6)
+
+
+if __name__ == "__main__":
+  unittest.main()
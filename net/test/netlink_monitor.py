@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+#
+# Copyright 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Waits for netlink multicast events on a long-lived socket."""
+
+import errno
+import select
+from socket import *  # pylint: disable=wildcard-import
+import threading
+import time
+
+import netlink
+
+
+class Waiter(object):
+  """Waits for one event that matches a predicate. Returned by Monitor.Expect.
+
+  Attributes:
+    event: The (command, msg, attrs) tuple of the matching event, or None.
+  """
+
+  def __init__(self, monitor, predicate, commands, deadline, sync_seq,
+               recheck):
+    self._monitor = monitor
+    self.predicate = predicate
+    self.commands = commands
+    self.deadline = deadline
+    self.recheck = recheck
+    # Events are only matched once the monitor has seen the ACK with this
+    # sequence number, i.e., once it has read everything that was queued
+    # before Expect was called.
+    self.sync_seq = sync_seq
+    self.event = None
+    self.error = None
+    self.cancelled = False
+    self._done = threading.Event()
+
+  def Finish(self, event=None, error=None):
+    self.event = event
+    self.error = error
+    self._done.set()
+
+  def Cancel(self):
+    """Stops waiting. The event, if it arrives later, is not matched."""
+    self._monitor.Cancel(self)
+
+  def Wait(self):
+    """Waits until a matching event arrives or the deadline passes.
+
+    Returns:
+      The (command, msg, attrs) tuple of the event, or None if the deadline
+      passed first.
+
+    Raises:
+      IOError: The monitor failed, e.g., because its receive buffer overflowed
+        and events were lost, and the waiter has no recheck function.
+      Exception: The predicate, the recheck function or the decoder raised it.
+    """
+    timeout = max(0, self.deadline - time.monotonic())
+    if not self._done.wait(timeout):
+      self.Cancel()
+      # The event might have arrived just before we cancelled.
+      if not self._done.is_set():
+        return None
+    if self.error is not None:
+      raise self.error
+    return self.event
+
+
+class Monitor(object):
+  """Receives netlink multicast events in a background thread.
+
+  All the waits share one socket, which stays subscribed to the groups until
+  the monitor is closed. Each wait is woken as soon as its event is received.
+  To avoid missing an event, expect it before doing whatever causes it, e.g.:
+
+    monitor = netlink_monitor.Monitor(iproute.IPRoute(iproute.RTMGRP_LINK),
+                                      iproute.CommandStruct)
+    waiter = monitor.Expect(lambda cmd, msg, attrs: msg.index == ifindex,
+                            [iproute.RTM_NEWLINK], timeout=1)
+    ...
+    if waiter.Wait() is None:
+      raise AssertionError("Link did not come up")
+  """
+
+  def __init__(self, nl, msgtypes):
+    """Starts monitoring.
+
+    Args:
+      nl: A NetlinkSocket subscribed to the groups to monitor. Only the
+        monitor may use it after this.
+      msgtypes: A function that takes a netlink message type and returns the
+        struct that follows the netlink header, or None to ignore the message.
+    """
+    self.nl = nl
+    self._msgtypes = msgtypes
+    self._portid = nl.sock.getsockname()[0]
+    self._lock = threading.Lock()
+    # Waiters that have not seen their sync ACK yet, and waiters that have.
+    self._syncing = []
+    self._waiters = []
+    self._wakeup, self._wakeup_peer = socketpair(AF_UNIX, SOCK_DGRAM)
+    self._thread = threading.Thread(target=self._Run, daemon=True,
+                                    name="netlink monitor")
+    self._thread.start()
+
+  def close(self):
+    self._wakeup_peer.send(b"\x00")
+    self._thread.join()
+    self._FailAll(IOError(errno.EBADF, "Monitor closed"))
+    self._wakeup.close()
+    self._wakeup_peer.close()
+    self.nl.close()
+
+  def Expect(self, predicate, commands=None, timeout=1.0, recheck=None):
+    """Starts waiting for an event. Call Wait on the result to get it.
+
+    Only events that are received after this call can match.
+
+    Args:
+      predicate: A function that takes the (command, msg, attrs) of an event
+        and returns True if it is the one to wait for. Called on the monitor
+        thread.
+      commands: A list of netlink message types to match, or None for all.
+      timeout: The number of seconds from now that Wait waits until.
+      recheck: A function that takes no arguments, checks the current state,
+        e.g., with a dump, and returns the (command, msg, attrs) of an event
+        that would have had the same effect as the expected one, or None.
+        Called on the monitor thread if events might have been lost, e.g.,
+        because the receive buffer overflowed. If it returns None, the wait
+        continues. If None, the wait fails instead.
+
+    Returns:
+      A Waiter.
+    """
+    deadline = time.monotonic() + timeout
+    if commands is not None:
+      commands = frozenset(commands)
+    with self._lock:
+      # A no-op request whose ACK is queued after everything that has been
+      # received so far.
+      nlmsg = self.nl._FinishNlRequest(
+          netlink.NLMSG_NOOP, b"", netlink.NLM_F_REQUEST | netlink.NLM_F_ACK)
+      waiter = Waiter(self, predicate, commands, deadline, self.nl.seq,
+                      recheck)
+      self._syncing.append(waiter)
+      self.nl._Send(nlmsg)
+    return waiter
+
+  def Wait(self, predicate, commands=None, timeout=1.0, recheck=None):
+    """Waits for an event. See Expect and Waiter.Wait."""
+    return self.Expect(predicate, commands, timeout, recheck).Wait()
+
+  def Cancel(self, waiter):
+    with self._lock:
+      waiter.cancelled = True
+      for waiters in self._syncing, self._waiters:
+        if waiter in waiters:
+          waiters.remove(waiter)
+
+  def _FailAll(self, error):
+    with self._lock:
+      for waiter in self._syncing + self._waiters:
+        waiter.Finish(error=error)
+      self._syncing = []
+      self._waiters = []
+
+  def _Lost(self, error):
+    """Called when events might have been lost. Rechecks or fails each wait."""
+    with self._lock:
+      waiters = self._syncing + self._waiters
+      self._syncing = []
+      self._waiters = []
+    for waiter in waiters:
+      if waiter.cancelled:
+        continue
+      if waiter.recheck is None:
+        waiter.Finish(error=error)
+        continue
+      try:
+        event = waiter.recheck()
+      except Exception as e:  # pylint: disable=broad-except
+        waiter.Finish(error=e)
+        continue
+      if event is not None:
+        waiter.Finish(event)
+        continue
+      # The sync ACK might have been lost too, so stop waiting for it. Any
+      # event received from now on happened after the recheck.
+      with self._lock:
+        if not waiter.cancelled:
+          self._waiters.append(waiter)
+
+  def _Run(self):
+    while True:
+      readable = select.select([self.nl.sock, self._wakeup], [], [])[0]
+      if self._wakeup in readable:
+        return
+      try:
+        data = self.nl._RecvInto()
+        with self._lock:
+          self._Dispatch(data)
+      except Exception as e:  # pylint: disable=broad-except
+        # e.g., ENOBUFS, or a malformed datagram. Events have been lost, so
+        # any of the waits could miss their event. Don't let the thread die.
+        self._Lost(e)
+
+  def _Dispatch(self, data):
+    for hdr, body_offset, body_len in self.nl._IndexNLMsgs(data):
+      if hdr.type == netlink.NLMSG_ERROR:
+        if hdr.pid == self._portid:
+          self._Synced(hdr.seq)
+        continue
+      waiters = [w for w in self._waiters
+                 if w.commands is None or hdr.type in w.commands]
+      if not waiters:
+        continue
+
+      try:
+        msgtype = self._msgtypes(hdr.type)
+        if msgtype is None:
+          continue
+        msg, attrs = self.nl._DecodeNLMsg(data, hdr, body_offset, body_len,
+                                          msgtype)
+      except Exception as e:  # pylint: disable=broad-except
+        # Report bugs in the decoder to the waiters that wanted the message.
+        for waiter in waiters:
+          self._waiters.remove(waiter)
+          waiter.Finish(error=e)
+        continue
+
+      event = (hdr.type, msg, attrs)
+      for waiter in waiters:
+        try:
+          if not waiter.predicate(*event):
+            continue
+        except Exception as e:  # pylint: disable=broad-except
+          # Report bugs in the predicate to the waiter.
+          self._waiters.remove(waiter)
+          waiter.Finish(error=e)
+          continue
+        self._waiters.remove(waiter)
+        waiter.Finish(event)
+
+  def _Synced(self, seq):
+    for waiter in list(self._syncing):
+      if waiter.sync_seq == seq:
+        self._syncing.remove(waiter)
+        self._waiters.append(waiter)
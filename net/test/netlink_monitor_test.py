@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+#
+# Copyright 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import unittest
+
+import iproute
+import namespace
+import netlink
+import netlink_monitor
+
+
+class LossyIPRoute(iproute.IPRoute):
+  """Fails the first receive of a message of type lose, as if it overflowed."""
+
+  lose = None
+
+  def _RecvInto(self):
+    data = super(LossyIPRoute, self)._RecvInto()
+    if netlink.NLMsgHdr.ReadFrom(data)[0].type == self.lose:
+      self.lose = None
+      raise IOError(errno.ENOBUFS, os.strerror(errno.ENOBUFS))
+    return data
+
+
+class MonitorTest(namespace.NetworkNamespaceTest):
+
+  TABLE = 2345
+
+  def testWait(self):
+    monitor = netlink_monitor.Monitor(
+        iproute.IPRoute(iproute.RTMGRP_IPV6_ROUTE), iproute.CommandStruct)
+    ipr = iproute.IPRoute()
+    dests = ["2001:db8:%d::" % i for i in range(3)]
+
+    def IsRoute(dest):
+      def Matches(command, unused_msg, attrs):
+        return (command == iproute.RTM_NEWROUTE and
+                attrs.get("RTA_TABLE") == self.TABLE and
+                attrs.get("RTA_DST") == dest)
+      return Matches
+
+    try:
+      # Events that happened before Expect don't match.
+      ipr.AddRoute(6, self.TABLE, dests[0], 48, None, 1)
+      self.assertIsNone(monitor.Wait(IsRoute(dests[0]), timeout=0.2))
+
+      # Several waiters share the socket, and each gets its own event.
+      waiters = [monitor.Expect(IsRoute(d), [iproute.RTM_NEWROUTE])
+                 for d in reversed(dests[1:])]
+      for d in dests[1:]:
+        ipr.AddRoute(6, self.TABLE, d, 48, None, 1)
+      for waiter, d in zip(waiters, reversed(dests[1:])):
+        command, msg, attrs = waiter.Wait()
+        self.assertEqual(iproute.RTM_NEWROUTE, command)
+        self.assertEqual(48, msg.dst_len)
+        self.assertEqual(d, attrs["RTA_DST"])
+
+      # Errors in the predicate are raised by Wait.
+      waiter = monitor.Expect(lambda *unused_args: 1 // 0)
+      ipr.DelRoute(6, self.TABLE, dests[0], 48, None, 1)
+      self.assertRaises(ZeroDivisionError, waiter.Wait)
+
+      # Closing the monitor fails outstanding waits.
+      waiter = monitor.Expect(IsRoute(dests[0]), timeout=10)
+      monitor.close()
+      self.assertRaisesRegex(IOError, "closed", waiter.Wait)
+    finally:
+      for d in dests:
+        try:
+          ipr.DelRoute(6, self.TABLE, d, 48, None, 1)
+        except IOError:
+          pass
+      ipr.close()
+
+  def testLostEvents(self):
+    monitor = netlink_monitor.Monitor(LossyIPRoute(iproute.RTMGRP_IPV6_ROUTE),
+                                      iproute.CommandStruct)
+    ipr = iproute.IPRoute()
+    # Only used by the monitor thread.
+    checker = iproute.IPRoute()
+    dests = ["2001:db8:%d::" % i for i in range(1, 4)]
+
+    def IsRoute(dest):
+      def Matches(command, unused_msg, attrs):
+        return (command == iproute.RTM_NEWROUTE and
+                attrs.get("RTA_TABLE") == self.TABLE and
+                attrs.get("RTA_DST") == dest)
+      return Matches
+
+    def Recheck(dest):
+      def FindRoute():
+        for msg, attrs in checker.DumpRoutes(6, self.TABLE):
+          if IsRoute(dest)(iproute.RTM_NEWROUTE, msg, attrs):
+            return iproute.RTM_NEWROUTE, msg, attrs
+        return None
+      return FindRoute
+
+    try:
+      found = monitor.Expect(IsRoute(dests[0]), timeout=10,
+                             recheck=Recheck(dests[0]))
+      failed = monitor.Expect(IsRoute(dests[0]), timeout=10)
+      later = monitor.Expect(IsRoute(dests[1]), timeout=10,
+                             recheck=Recheck(dests[1]))
+      broken = monitor.Expect(IsRoute(dests[2]), timeout=10,
+                              recheck=lambda: 1 // 0)
+      # The event is lost. The waits that can recheck the state do so.
+      monitor.nl.lose = iproute.RTM_NEWROUTE
+      ipr.AddRoute(6, self.TABLE, dests[0], 48, None, 1)
+      self.assertEqual(dests[0], found.Wait()[2]["RTA_DST"])
+      with self.assertRaises(IOError) as context:
+        failed.Wait()
+      self.assertEqual(errno.ENOBUFS, context.exception.errno)
+      self.assertRaises(ZeroDivisionError, broken.Wait)
+
+      # The monitor keeps running, and waits that found nothing continue.
+      ipr.AddRoute(6, self.TABLE, dests[1], 48, None, 1)
+      self.assertEqual(dests[1], later.Wait()[2]["RTA_DST"])
+      self.assertTrue(monitor._thread.is_alive())
+    finally:
+      monitor.close()
+      for d in dests[:2]:
+        ipr.DelRoute(6, self.TABLE, d, 48, None, 1)
+      ipr.close()
+      checker.close()
+
+  def testAddAddress(self):
+    ipr = iproute.IPRoute()
+    # Waits for the address to appear, using the socket's monitor.
+    ipr.AddAddress("2001:db8::5", 128, 1)
+    try:
+      monitor = ipr.GetMonitor(iproute.RTMGRP_IPV6_IFADDR)
+      self.assertIs(monitor, ipr.GetMonitor(iproute.RTMGRP_IPV6_IFADDR))
+      self.assertIsNot(monitor, ipr.GetMonitor(iproute.RTMGRP_LINK))
+      self.assertEqual([], monitor._waiters)
+      # If events are lost, the address is found with a dump.
+      waiter = ipr._ExpectAddress("2001:db8::5", 1)
+      self.assertEqual("2001:db8::5", waiter.recheck()[2]["IFA_ADDRESS"])
+      waiter.Cancel()
+      # Failed adds don't leave their waits behind.
+      with self.assertRaises(IOError) as context:
+        ipr.AddAddress("2001:db8::6", 128, 9999)
+      self.assertEqual(errno.ENODEV, context.exception.errno)
+      self.assertEqual([], monitor._syncing + monitor._waiters)
+    finally:
+      ipr.DelAddress("2001:db8::5", 128, 1)
+      ipr.close()
+    # The monitors stop when the socket is closed.
+    self.assertFalse(monitor._thread.is_alive())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -14,14 +14,134 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import errno
+from socket import *  # pylint: disable=wildcard-import
+import struct
+import threading
 import unittest
 
+import async_netlink
+import cstruct
 import iproute
 import netlink
+import namespace
 import sock_diag
 import tcp_metrics
 
 
+# These aren't constants, they're classes. So, pylint: disable=invalid-name
+Counter = cstruct.Struct("Counter", "=I", "value")
+
+
+class CannedDumpSocket(netlink.NetlinkSocket):
+  """Answers every request with the same list of datagrams.
+
+  Uses a Unix datagram socket pair instead of a netlink socket, so the real
+  receive code runs without needing the kernel to generate the replies.
+  """
+
+  def __init__(self, datagrams):
+    # Don't call the superclass constructor: we don't need a netlink socket.
+    self.sock, self.peer = socketpair(AF_UNIX, SOCK_DGRAM)
+    # Fail instead of hanging if we read too far.
+    self.sock.setblocking(False)
+    self.seq = 0
+    self.pid = 0
+    self.datagrams = datagrams
+    self.sent = []
+    self.received = []
+
+  def close(self):
+    self.peer.close()
+    super(CannedDumpSocket, self).close()
+
+  def _Send(self, msg):
+    self.seq += 1
+    self.sent.append(bytes(msg))
+    for datagram in self.datagrams:
+      self.peer.send(datagram)
+
+  def _RecvInto(self):
+    data = super(CannedDumpSocket, self)._RecvInto()
+    self.received.append(bytes(data))
+    return data
+
+  def Pending(self):
+    """Reads and returns the datagrams that have not been received yet."""
+    pending = []
+    while True:
+      try:
+        pending.append(self.sock.recv(65536))
+      except BlockingIOError:
+        return pending
+
+  @staticmethod
+  def Message(msgtype, body=b""):
+    hdr = netlink.NLMsgHdr((len(netlink.NLMsgHdr) + len(body), msgtype,
+                            netlink.NLM_F_MULTI, 0, 0))
+    return hdr.Pack() + body
+
+  @classmethod
+  def Counters(cls, values):
+    return b"".join(cls.Message(16, Counter((v,)).Pack()) for v in values)
+
+
+class CountingDecodeSocket(netlink.NetlinkSocket):
+  """Decodes u32 attributes and records which ones it decoded."""
+
+  NAMES = {1: "ONE", 2: "TWO", 3: "NEST", 4: "IFLA_PAD"}
+
+  def __init__(self):
+    # Don't call the superclass constructor: we don't need a socket.
+    self.sock = None
+    self.decoded = []
+
+  def _DecodeName(self, command, msg, nla_type, nested):
+    return self.NAMES.get(nla_type, nla_type)
+
+  def _Decode(self, command, msg, nla_type, nla_data, nested):
+    name = self._DecodeName(command, msg, nla_type, nested)
+    self.decoded.append(name)
+    if name == "NEST":
+      data = self._ParseAttributes(command, msg, nla_data, nested + [name])
+    else:
+      data = struct.unpack("=I", nla_data)[0]
+    return name, data
+
+
+class SchemaSocket(netlink.NetlinkSocket):
+  """Decodes attributes using an ATTRIBUTES table."""
+
+  NAMES = {1: "A_U8", 2: "A_ADDR", 3: "A_NEST", 4: "A_STRUCT", 5: "A_STR"}
+
+  ATTRIBUTES = {
+      "A_U8": netlink.U8,
+      "A_ADDR": netlink.Address,
+      "A_NEST": netlink.Nested,
+      "A_STRUCT": netlink.Struct(netlink.NLMsgErr),
+      "A_STR": netlink.String,
+  }
+  DEFAULT_DECODER = staticmethod(netlink.Hex)
+
+  def __init__(self):
+    self.sock = None
+
+  def _DecodeName(self, command, msg, nla_type, nested):
+    return self.NAMES.get(nla_type, nla_type)
+
+
+class NoStrictCheckIPRoute(iproute.IPRoute):
+  """Behaves as if the kernel didn't support strict checking."""
+
+  def _SetStrictCheck(self, enable):
+    return False
+
+
+class StrictIPRoute(iproute.IPRoute):
+  STRICT_CHECK = True
+
+
 class NetlinkTest(unittest.TestCase):
 
   def _CheckConstant(self, expected, module, value, prefix):
@@ -37,6 +157,530 @@ class NetlinkTest(unittest.TestCase):
     self._CheckConstant("TCP_METRICS_ATTR_AGE", tcp_metrics, 3,
                         "TCP_METRICS_ATTR_")
 
+  def testConstantNameIndex(self):
+    """Checks that the index returns the same names as scanning the module."""
+
+    def ScanForName(module, value, prefix):
+      constant_prefixes = getattr(module, "CONSTANT_PREFIXES", [])
+      for name in dir(module):
+        if value != getattr(module, name) or not name.isupper():
+          continue
+        longest = [p for p in constant_prefixes if name.startswith(p)][:1]
+        if constant_prefixes and [prefix] != longest:
+          continue
+        if name.startswith(prefix):
+          return name
+      return value
+
+    for module in [iproute, sock_diag, tcp_metrics]:
+      prefixes = getattr(module, "CONSTANT_PREFIXES", []) + [
+          "", "RTM_", "SOCK_", "TCP_METRICS_ATTR_"]
+      for prefix in prefixes:
+        for value in list(range(-1, 40)) + [0xffffffff, "foo"]:
+          self.assertEqual(ScanForName(module, value, prefix),
+                           netlink.NetlinkSocket._GetConstantName(
+                               module.__name__, value, prefix))
+
+  def testIterDump(self):
+    done = CannedDumpSocket.Message(netlink.NLMSG_DONE, b"\x00" * 4)
+    datagrams = [CannedDumpSocket.Counters([0, 1]),
+                 CannedDumpSocket.Counters([2, 3]),
+                 CannedDumpSocket.Counters([4]) + done]
+    s = CannedDumpSocket(datagrams)
+
+    self.assertEqual(list(range(5)),
+                     [m.value for m, _ in s._Dump(16, None, Counter)])
+    self.assertEqual(datagrams, s.received)
+
+    # Messages are decoded as each datagram arrives.
+    s.received = []
+    dump = s.IterDump(16, None, Counter)
+    self.assertEqual(0, next(dump)[0].value)
+    self.assertEqual(datagrams[:1], s.received)
+
+    # Stopping early reads the rest of the dump.
+    self.assertEqual(1, next(dump)[0].value)
+    self.assertEqual(2, next(dump)[0].value)
+    dump.close()
+    self.assertEqual(datagrams, s.received)
+    self.assertEqual([], s.Pending())
+
+    # So does a message that fails to parse.
+    s = CannedDumpSocket([CannedDumpSocket.Counters([0]) +
+                          CannedDumpSocket.Message(16, b"\x00"),
+                          CannedDumpSocket.Counters([1]) + done])
+    self.assertRaises(TypeError, s._Dump, 16, None, Counter)
+    self.assertEqual([], s.Pending())
+
+    # A message that runs past the end of the datagram stops the drain there,
+    # instead of waiting for more datagrams.
+    truncated = CannedDumpSocket.Message(16, b"\x00" * 8)[:-4]
+    s = CannedDumpSocket([CannedDumpSocket.Counters([0]) + truncated, done])
+    self.assertRaises(ValueError, s._Dump, 16, None, Counter)
+    self.assertEqual([done], s.Pending())
+
+    # An error ends the dump.
+    error = netlink.NLMsgErr((-22,)).Pack() + netlink.NLMsgHdr().Pack()
+    s = CannedDumpSocket([CannedDumpSocket.Message(netlink.NLMSG_ERROR, error),
+                          done])
+    self.assertRaises(IOError, s._Dump, 16, None, Counter)
+    self.assertEqual([done], s.Pending())
+
+  def testBatch(self):
+    def Ack(seq, error):
+      hdr = netlink.NLMsgHdr((36, netlink.NLMSG_ERROR, 0, seq, 0))
+      return hdr.Pack() + netlink.NLMsgErr((-error,)).Pack() + hdr.Pack()
+
+    # ACKs are matched by sequence number, and other messages are ignored.
+    s = CannedDumpSocket([Ack(1, 0), CannedDumpSocket.Counters([5]),
+                          Ack(2, errno.EEXIST), Ack(7, errno.ENOENT),
+                          Ack(0, 0)])
+    with self.assertRaises(netlink.BatchError) as context:
+      with s.Batch():
+        for i in range(3):
+          s._SendNlRequest(16, Counter((i,)).Pack(), netlink.NLM_F_REQUEST)
+        # Nothing is sent until the end of the block.
+        self.assertEqual([], s.sent)
+    self.assertEqual(errno.EEXIST, context.exception.errno)
+    self.assertEqual([(2, 16, errno.EEXIST)], context.exception.failures)
+    self.assertEqual([], s.Pending())
+
+    # All the requests went in one datagram, with their own seqs and ACK set.
+    self.assertEqual(1, len(s.sent))
+    index = s._IndexNLMsgs(s.sent[0])
+    self.assertEqual([0, 1, 2], [hdr.seq for hdr, _, _ in index])
+    self.assertEqual([netlink.NLM_F_REQUEST | netlink.NLM_F_ACK] * 3,
+                     [hdr.flags for hdr, _, _ in index])
+
+    # If the block raises, nothing is sent.
+    s.sent = []
+    with self.assertRaises(ValueError):
+      with s.Batch():
+        s._SendNlRequest(16, Counter((1,)).Pack(), netlink.NLM_F_REQUEST)
+        raise ValueError("Oops")
+    self.assertEqual([], s.sent)
+    self.assertIsNone(s._batch)
+    s.close()
+
+  def testAttributeMap(self):
+    s = CountingDecodeSocket()
+    nested = s._NlAttrU32(1, 11) + s._NlAttrU32(2, 12)
+    data = (s._NlAttrU32(1, 1) + s._NlAttrU32(2, 2) + s._NlAttr(3, nested) +
+            s._NlAttrU32(4, 3) + s._NlAttrU32(4, 4) + s._NlAttrU32(9, 9))
+    attrs = s._ParseAttributes(0, None, memoryview(data), [])
+    self.assertIsInstance(attrs, netlink.AttributeMap)
+    self.assertEqual([], s.decoded)
+
+    # Only the values that are read are decoded, and only once.
+    self.assertEqual(["ONE", "TWO", "NEST", "IFLA_PAD", 9], list(attrs))
+    self.assertEqual(5, len(attrs))
+    self.assertIn("TWO", attrs)
+    self.assertNotIn("THREE", attrs)
+    self.assertEqual(2, attrs["TWO"])
+    self.assertEqual(2, attrs.get("TWO"))
+    self.assertIsNone(attrs.get("THREE"))
+    self.assertRaises(KeyError, attrs.__getitem__, "THREE")
+    self.assertEqual(["TWO"], s.decoded)
+
+    # Nested attributes are lazy too.
+    self.assertEqual(12, attrs["NEST"]["TWO"])
+    self.assertEqual(["TWO", "NEST", "TWO"], s.decoded)
+
+    # Allowed duplicates keep the last value, like a dict.
+    expected = {"ONE": 1, "TWO": 2, "NEST": {"ONE": 11, "TWO": 12},
+                "IFLA_PAD": 4, 9: 9}
+    self.assertEqual(expected, attrs)
+    self.assertEqual(attrs, expected)
+    self.assertEqual(repr(expected), repr(attrs))
+
+    duplicate = s._NlAttrU32(1, 1) + s._NlAttrU32(1, 1)
+    self.assertRaises(ValueError, s._ParseAttributes, 0, None, duplicate, [])
+
+  def testAttributeSchema(self):
+    s = SchemaSocket()
+    nested = s._NlAttr(1, b"\x07") + s._NlAttr(9, b"\xab")
+    data = (s._NlAttr(1, b"\x2a") +
+            s._NlAttrIPAddress(2, AF_INET6, "2001:db8::1") +
+            s._NlAttr(3, nested) +
+            s._NlAttr(4, netlink.NLMsgErr((-22,)).Pack()) +
+            s._NlAttrStr(5, "eth0") +
+            s._NlAttr(6, b"\x01\x02"))
+    msg = iproute.RTMsg(family=AF_INET6)
+    attrs = s._ParseAttributes(0, msg, data, [])
+    self.assertEqual({
+        "A_U8": 42,
+        "A_ADDR": "2001:db8::1",
+        "A_NEST": {"A_U8": 7, 9: b"ab"},
+        "A_STRUCT": netlink.NLMsgErr((-22,)),
+        "A_STR": b"eth0",
+        6: b"0102",
+    }, dict(attrs))
+
+    # A decoder raises if the attribute has the wrong length.
+    attrs = s._ParseAttributes(0, msg, s._NlAttr(1, b"\x01\x02"), [])
+    self.assertRaises(struct.error, attrs.__getitem__, "A_U8")
+
+  def testNestedAttributes(self):
+    s = SchemaSocket()
+    buf = s._NlRequestBuffer()
+    outer = s._StartNlAttr(buf, 3)
+    s._AppendNlAttr(buf, 1, b"\x07")
+    inner = s._StartNlAttr(buf, 3)
+    s._AppendNlAttrStr(buf, 5, "eth0")
+    s._EndNlAttr(buf, inner)
+    s._EndNlAttr(buf, outer)
+    # A struct followed by a key that isn't a multiple of 4 bytes long.
+    start = s._StartNlAttr(buf, 4)
+    buf.Append(netlink.NLMsgErr((-22,)))
+    buf.Append(b"abc")
+    s._EndNlAttr(buf, start)
+    s._AppendNlAttrU32(buf, 1, 5)
+
+    inner = s._NlAttr(3, s._NlAttrStr(5, "eth0"))
+    expected = (s._NlAttr(3, s._NlAttr(1, b"\x07") + inner) +
+                s._NlAttr(4, netlink.NLMsgErr((-22,)).Pack() + b"abc") +
+                s._NlAttrU32(1, 5))
+    data = buf.Pack()[len(netlink.NLMsgHdr):]
+    self.assertEqual(expected, data)
+    attrs = s._ParseAttributes(0, None, data, [])
+    self.assertEqual({"A_U8": 7, "A_NEST": {"A_STR": b"eth0"}},
+                     dict(attrs["A_NEST"]))
+
+  def testRecvInto(self):
+    small = CannedDumpSocket.Counters([1])
+    large = CannedDumpSocket.Counters(range(100))
+    s = CannedDumpSocket([small, large, small])
+    s.BUFSIZE = 64
+    s._Send(b"")
+
+    # The buffer is reused as long as the datagrams fit.
+    self.assertEqual(small, bytes(s._RecvInto()))
+    buf = s._recvbuf
+    self.assertEqual(64, len(buf))
+
+    # A larger datagram is not truncated.
+    self.assertEqual(large, bytes(s._RecvInto()))
+    self.assertEqual(4096, len(s._recvbuf))
+    self.assertEqual(small, s._Recv())
+    self.assertEqual([], s.Pending())
+    s.close()
+
+  def testIndexNLMsgs(self):
+    s = CannedDumpSocket([])
+    done = CannedDumpSocket.Message(netlink.NLMSG_DONE, b"\x00" * 4)
+    # Unpadded, so the next message starts 3 bytes later than its length.
+    odd = CannedDumpSocket.Message(17, b"\x01")
+    data = memoryview(CannedDumpSocket.Counters([7, 8]) + odd + b"\x00" * 3 +
+                      done + CannedDumpSocket.Counters([9]))
+    index = s._IndexNLMsgs(data)
+    self.assertEqual([(16, 16, 4), (16, 36, 4), (17, 56, 1),
+                      (netlink.NLMSG_DONE, 76, 4)],
+                     [(h.type, o, l) for h, o, l in index])
+    self.assertEqual(8, s._DecodeNLMsg(data, *index[1], Counter)[0].value)
+
+    # Attributes are parsed in place.
+    attrs = s._NlAttrU32(1, 5) + s._NlAttr(2, b"abc") + s._NlAttrU32(3, 6)
+    data = b"\xff" * 8 + attrs + b"\xff" * 8
+    self.assertEqual(s._ParseAttributes(0, None, attrs, []),
+                     s._ParseAttributes(0, None, data, [], 8, 8 + len(attrs)))
+
+    bad = CannedDumpSocket.Message(16, Counter((1,)).Pack())[:-1]
+    self.assertRaises(ValueError, s._IndexNLMsgs, bad)
+    bad = netlink.NLMsgHdr((0, 16, 0, 0, 0)).Pack()
+    self.assertRaises(ValueError, s._IndexNLMsgs, bad)
+
+  def testStrictCheckOnOtherSockets(self):
+    # e.g., benchmarks that replay datagrams over a Unix socket pair.
+    ipr = iproute.IPRoute()
+    ipr.sock.close()
+    ipr.sock, peer = socketpair(AF_UNIX, SOCK_DGRAM)
+    self.addCleanup(peer.close)
+    self.addCleanup(ipr.close)
+    self.assertFalse(ipr._SetStrictCheck(True))
+    with ipr._StrictCheck() as supported:
+      self.assertFalse(supported)
+
+
+class AsyncNetlinkTest(namespace.NetworkNamespaceTest):
+
+  TABLE = 2345
+
+  def testConcurrentRequests(self):
+    blocking = iproute.IPRoute()
+    expected_links = blocking.DumpLinks()
+    expected_addrs = blocking.DumpAddresses(6)
+    blocking.close()
+
+    def Names(links):
+      return sorted(attrs["IFLA_IFNAME"] for _, attrs in links)
+
+    async def Run():
+      ipr = async_netlink.AsyncNetlink(iproute.IPRoute())
+      diag = async_netlink.AsyncNetlink(sock_diag.SockDiag())
+      diag_req = sock_diag.InetDiagReqV2((AF_INET6, IPPROTO_TCP, 0, 0xffffffff,
+                                          diag.nl._EmptyInetDiagSockId()))
+      dests = ["2001:db8:%d::" % i for i in range(10)]
+
+      # Requests and dumps on two sockets, all outstanding at once.
+      results = await asyncio.gather(
+          ipr.Dump(iproute.RTM_GETLINK, iproute.IfinfoMsg(), iproute.IfinfoMsg),
+          ipr.Dump(iproute.RTM_GETADDR, iproute.IfAddrMsg(family=AF_INET6),
+                   iproute.IfAddrMsg),
+          diag.Dump(sock_diag.SOCK_DIAG_BY_FAMILY, diag_req,
+                    sock_diag.InetDiagMsg),
+          *[ipr.Call(ipr.nl.AddRoute, 6, self.TABLE, d, 48, None, 1)
+            for d in dests])
+      links, addrs = results[:2]
+      self.assertEqual(Names(expected_links), Names(links))
+      self.assertEqual(len(expected_addrs), len(addrs))
+
+      rtmsg = iproute.RTMsg(family=AF_INET6)
+      routes = [r for _, r in await ipr.Dump(iproute.RTM_GETROUTE, rtmsg,
+                                             iproute.RTMsg)
+                if r["RTA_TABLE"] == self.TABLE]
+      self.assertEqual(len(dests), len(routes))
+
+      # Stopping a dump early doesn't affect the next one.
+      dump = ipr.IterDump(iproute.RTM_GETROUTE, rtmsg, iproute.RTMsg)
+      await dump.__anext__()
+      await dump.aclose()
+      self.assertEqual(Names(links), Names(await ipr.Dump(
+          iproute.RTM_GETLINK, iproute.IfinfoMsg(), iproute.IfinfoMsg)))
+
+      # Errors are reported to the right caller.
+      with self.assertRaises(IOError) as context:
+        await ipr.Call(ipr.nl.AddRoute, 6, self.TABLE, dests[0], 48, None, 1)
+      self.assertEqual(errno.EEXIST, context.exception.errno)
+      await asyncio.gather(*[ipr.Call(ipr.nl.DelRoute, 6, self.TABLE, d, 48,
+                                      None, 1) for d in dests])
+      ipr.close()
+      diag.close()
+
+    asyncio.run(asyncio.wait_for(Run(), 10))
+
+  def testMalformedReply(self):
+    class TruncatingIPRoute(iproute.IPRoute):
+      def _RecvInto(self):
+        data = super(TruncatingIPRoute, self)._RecvInto()
+        return data[:len(netlink.NLMsgHdr)]
+
+    async def Run():
+      ipr = async_netlink.AsyncNetlink(TruncatingIPRoute())
+      # The ACK can't be parsed. The call fails instead of waiting forever.
+      with self.assertRaises(ValueError):
+        await ipr.Call(ipr.nl.DelRoute, 6, self.TABLE, "2001:db8::", 48,
+                       None, 1)
+      ipr.close()
+
+    asyncio.run(asyncio.wait_for(Run(), 10))
+
+
+class ThreadSafeTest(namespace.NetworkNamespaceTest):
+
+  TABLE = 2345
+
+  def testConcurrentRequests(self):
+    ipr = iproute.IPRoute()
+    ipr.MakeThreadSafe()
+    names = sorted(attrs["IFLA_IFNAME"] for _, attrs in ipr.DumpLinks())
+    lo = ipr.GetIfIndex("lo")
+    errors = []
+
+    def Run(i):
+      try:
+        dests = ["2001:db8:%d:%d::" % (i, j) for j in range(5)]
+        for _ in range(10):
+          self.assertEqual(names, sorted(attrs["IFLA_IFNAME"]
+                                         for _, attrs in ipr.DumpLinks()))
+          self.assertEqual(lo, ipr.GetIfIndex("lo"))
+          with ipr.Batch():
+            for dest in dests:
+              ipr.AddRoute(6, self.TABLE, dest, 64, None, lo)
+          with self.assertRaises(IOError) as context:
+            ipr.AddRoute(6, self.TABLE, dests[0], 64, None, lo)
+          self.assertEqual(errno.EEXIST, context.exception.errno)
+          for dest in dests:
+            ipr.DelRoute(6, self.TABLE, dest, 64, None, lo)
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(e)
+
+    threads = [threading.Thread(target=Run, args=(i,)) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(30)
+      self.assertFalse(thread.is_alive())
+    ipr.close()
+    self.assertEqual([], errors)
+
+  def testSuspendedDump(self):
+    ipr = iproute.IPRoute()
+    ipr.MakeThreadSafe()
+    self.addCleanup(ipr.close)
+    links = ipr.IterDump(iproute.RTM_GETLINK, iproute.IfinfoMsg(),
+                         iproute.IfinfoMsg)
+    first = next(links)
+    # Other threads can dump while this one is part way through a dump.
+    results = []
+    thread = threading.Thread(target=lambda: results.append(ipr.DumpLinks()))
+    thread.start()
+    thread.join(10)
+    self.assertFalse(thread.is_alive())
+    self.assertEqual([first] + list(links), results[0])
+
+  def testTimeout(self):
+    ipr = iproute.IPRoute()
+    ipr.MakeThreadSafe()
+    self.addCleanup(ipr.close)
+    ipr._dispatcher.TIMEOUT = 0.1
+    # A request that gets no reply.
+    ipr._Send(ipr._FinishNlRequest(netlink.NLMSG_NOOP, b"",
+                                   netlink.NLM_F_REQUEST))
+    with self.assertRaises(IOError) as context:
+      ipr._RecvInto()
+    self.assertEqual(errno.ETIMEDOUT, context.exception.errno)
+
+
+class StatsTest(namespace.NetworkNamespaceTest):
+
+  TABLE = 2345
+
+  def testStats(self):
+    self.assertIsNone(netlink.NetlinkSocket.stats)
+    stats = netlink.EnableStats()
+    self.addCleanup(netlink.DisableStats)
+    ipr = iproute.IPRoute()
+    links = ipr.DumpLinks()
+    with ipr.Batch():
+      for i in range(3):
+        ipr.AddRoute(6, self.TABLE, "2001:db8:%d::" % i, 48, None, 1)
+    for i in range(3):
+      ipr.DelRoute(6, self.TABLE, "2001:db8:%d::" % i, 48, None, 1)
+    ipr.close()
+
+    counters = stats.counters
+    self.assertEqual(1, counters[("RTM_GETLINK", "requests")])
+    self.assertEqual(len(links), counters[("RTM_NEWLINK", "messages_parsed")])
+    self.assertEqual(len(links),
+                     counters[("RTM_NEWLINK", "messages_received")])
+    self.assertEqual(3, counters[("RTM_NEWROUTE", "requests")])
+    self.assertEqual(3, counters[("RTM_DELROUTE", "requests")])
+    self.assertEqual(6, counters[("NLMSG_ERROR", "messages_received")])
+    self.assertEqual(1, stats.timers[("RTM_GETLINK", "dump_duration")].count)
+    self.assertEqual(3, stats.timers[("RTM_NEWROUTE", "ack_latency")].count)
+    self.assertEqual(3, stats.timers[("RTM_DELROUTE", "ack_latency")].count)
+    self.assertIn("RTM_GETLINK", stats.Summary())
+
+    netlink.DisableStats()
+    self.assertEqual("", netlink.Stats().Summary())
+
+  def testLatencyHistogram(self):
+    histogram = netlink.LatencyHistogram()
+    for microseconds in [1, 2, 3, 100, 1000]:
+      histogram.Add(microseconds / 1e6)
+    self.assertEqual(5, histogram.count)
+    self.assertEqual(0.001, histogram.max)
+    # 3us is in the bucket [2, 4).
+    self.assertEqual(4e-6, histogram.Percentile(0.5))
+    self.assertEqual(0.001, histogram.Percentile(1))
+
+
+class FilteredDumpTest(namespace.NetworkNamespaceTest):
+
+  TABLE = 2345
+
+  def testFilteredDumps(self):
+    ipr = iproute.IPRoute()
+    self.assertFalse(ipr.strict_check)
+    nonstrict = NoStrictCheckIPRoute()
+    ipr.AddRoute(6, self.TABLE, "2001:db8:1::", 48, None, 1)
+    ipr.AddRoute(4, self.TABLE, "192.0.2.0", 24, None, 1)
+    try:
+      # Both ways of filtering give the same results.
+      for version, table, kwargs in [
+          (6, self.TABLE, {}),
+          (4, self.TABLE, {}),
+          (6, self.TABLE + 1, {}),
+          (6, 0, {}),
+          (6, 0, {"oif": 1}),
+          (6, None, {"oif": 1}),
+          (4, None, {"protocol": iproute.RTPROT_STATIC}),
+          (6, 255, {"route_type": iproute.RTN_UNICAST}),
+          (6, self.TABLE, {"oif": 1, "protocol": iproute.RTPROT_BOOT})]:
+        self.assertEqual(
+            [(m, dict(a)) for m, a in nonstrict.DumpRoutes(version, table,
+                                                           **kwargs)],
+            [(m, dict(a)) for m, a in ipr.DumpRoutes(version, table,
+                                                     **kwargs)])
+      self.assertEqual(1, len(ipr.DumpRoutes(6, self.TABLE)))
+      # Table 0 is not all tables.
+      self.assertEqual([], ipr.DumpRoutes(6, 0))
+      self.assertEqual(len(ipr.DumpAllRoutes(6)),
+                       len(ipr.DumpRoutes(6, None)))
+      for version in 4, 6:
+        for ifindex in 0, 1, 9999:
+          self.assertEqual(nonstrict.DumpAddresses(version, ifindex),
+                           ipr.DumpAddresses(version, ifindex))
+          self.assertEqual(nonstrict.DumpNeighbours(version, ifindex),
+                           ipr.DumpNeighbours(version, ifindex))
+      self.assertEqual([], ipr.DumpAddresses(6, 9999))
+
+      if not ipr._SetStrictCheck(False):
+        self.skipTest("Kernel does not support NETLINK_GET_STRICT_CHK")
+      # Filtered dumps don't leave strict checking on.
+      self.assertEqual(0, ipr.sock.getsockopt(netlink.SOL_NETLINK,
+                                              netlink.NETLINK_GET_STRICT_CHK))
+
+      # Route lookups work on sockets that are always checked strictly.
+      strict = StrictIPRoute()
+      self.addCleanup(strict.close)
+      self.assertTrue(strict.strict_check)
+      self.assertEqual(
+          ipr.GetRoutes("::1", 0, None, None)[0][0],
+          strict.GetRoutes("::1", 0, None, None)[0][0])
+      self.assertEqual(ipr.DumpRoutes(6, self.TABLE),
+                       strict.DumpRoutes(6, self.TABLE))
+
+      # The kernel only sent the matching routes.
+      stats = netlink.EnableStats()
+      self.addCleanup(netlink.DisableStats)
+      ipr.DumpRoutes(6, self.TABLE)
+      self.assertEqual(1, stats.counters[("RTM_NEWROUTE", "messages_received")])
+    finally:
+      ipr.DelRoute(6, self.TABLE, "2001:db8:1::", 48, None, 1)
+      ipr.DelRoute(4, self.TABLE, "192.0.2.0", 24, None, 1)
+      ipr.close()
+      nonstrict.close()
+
+
+class SnapshotTest(namespace.NetworkNamespaceTest):
+
+  TABLE = 2345
+
+  def testSnapshot(self):
+    ipr = iproute.IPRoute()
+    ipr.AddRoute(6, self.TABLE, "2001:db8:0:1::", 64, None, 1)
+    try:
+      state = ipr.Snapshot()
+    finally:
+      ipr.DelRoute(6, self.TABLE, "2001:db8:0:1::", 64, None, 1)
+
+    self.assertEqual(sorted(m.index for m, _ in ipr.DumpLinks()),
+                     sorted(m.index for m, _ in state.links))
+    self.assertEqual("lo", state.Link(1)[1]["IFLA_IFNAME"].decode())
+    self.assertIsNone(state.Link(0))
+    self.assertIn("127.0.0.1",
+                  [attrs["IFA_ADDRESS"] for _, attrs in state.Addresses(1)])
+    self.assertEqual(len(ipr.DumpRules(4)) + len(ipr.DumpRules(6)),
+                     len(state.rules))
+
+    routes = state.Routes(self.TABLE)
+    self.assertEqual(1, len(routes))
+    self.assertEqual(routes, state.RoutesTo("2001:db8:0:1:0::/64"))
+    self.assertEqual([], state.RoutesTo("2001:db8:0:1::/65"))
+    self.assertEqual(1, routes[0][1]["RTA_OIF"])
+    ipr.close()
+
 
 if __name__ == "__main__":
   unittest.main()
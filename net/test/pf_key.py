@@ -139,18 +139,30 @@ SadbXNatTType = cstruct.Struct("SadbXNatTType", "=B3x", "type")
 SadbXNatTPort = cstruct.Struct("SadbXNatTPort", "!H2x", "port")
 
 
+# Maps prefixes to dicts from constant values to names. See _GetConstantName.
+_constant_names = {}
+
+
 def _GetConstantName(value, prefix):
   """Translates a number to a constant of the same value in this file."""
-  thismodule = sys.modules[__name__]
-  # Match shorter constant names first. This allows us to match SADB_DUMP and
-  # instead of, say, SADB_EXT_LIFETIME_HARD if we pass in a prefix of "SADB_"
-  # and a value of 3, and match SADB_EXT_LIFETIME_HARD just by specifying
-  # a longer prefix.
-  for name in sorted(dir(thismodule), key=len):
-    if (name.startswith(prefix) and
-        name.isupper() and getattr(thismodule, name) == value):
-      return name
-  return value
+  if prefix not in _constant_names:
+    thismodule = sys.modules[__name__]
+    names = {}
+    # Match shorter constant names first. This allows us to match SADB_DUMP and
+    # instead of, say, SADB_EXT_LIFETIME_HARD if we pass in a prefix of "SADB_"
+    # and a value of 3, and match SADB_EXT_LIFETIME_HARD just by specifying
+    # a longer prefix.
+    for name in sorted(dir(thismodule), key=len):
+      if name.startswith(prefix) and name.isupper():
+        try:
+          names.setdefault(getattr(thismodule, name), name)
+        except TypeError:
+          pass
+    _constant_names[prefix] = names
+  try:
+    return _constant_names[prefix].get(value, value)
+  except TypeError:
+    return value
 
 
 def _GetMultiConstantName(value, prefixes):
@@ -184,7 +196,8 @@ def ParseExtension(exttype, data):
     struct_type = SadbXNatTPort
 
   if struct_type:
-    ext, attrs = cstruct.Read(data, struct_type)
+    ext, offset = struct_type.ReadFrom(data)
+    attrs = data[offset:]
   else:
     ext, attrs = data, b""
 
@@ -220,17 +233,22 @@ class PfKey(object):
     msg.seq = self.seq
     msg.pid = os.getpid()
     msg.len = (len(SadbMsg) + len(extensions)) // 8
-    self.sock.send(msg.Pack() + extensions)
+    buf = cstruct.PackBuffer()
+    buf.Append(msg)
+    buf.Append(extensions)
+    self.sock.send(buf.View())
     # print("SEND: " + self.DecodeSadbMsg(msg))
     return self.Recv()
 
   def PackPfKeyExtensions(self, extlist):
-    extensions = b""
+    extensions = cstruct.PackBuffer()
     for exttype, extstruct, attrs in extlist:
-      extdata = extstruct.Pack()
-      ext = SadbExt(((len(extdata) + len(SadbExt) + len(attrs)) // 8, exttype))
-      extensions += ext.Pack() + extdata + attrs
-    return extensions
+      ext = SadbExt(((len(extstruct) + len(SadbExt) + len(attrs)) // 8,
+                     exttype))
+      extensions.Append(ext)
+      extensions.Append(extstruct)
+      extensions.Append(attrs)
+    return extensions.Pack()
 
   def MakeSadbMsg(self, msgtype, satype):
     # errno is 0. seq, pid and len are filled in by SendAndRecv().
@@ -298,10 +316,12 @@ class PfKey(object):
   def ParseExtensions(data):
     """Parses the extensions in a SADB message."""
     extensions = []
-    while data:
-      ext, data = cstruct.Read(data, SadbExt)
+    offset = 0
+    while offset < len(data):
+      ext, offset = SadbExt.ReadFrom(data, offset)
       datalen = PfKey.ExtensionsLength(ext, SadbExt)
-      extdata, data = data[:datalen], data[datalen:]
+      extdata = data[offset:offset + datalen]
+      offset += datalen
       extensions.append(ParseExtension(ext.exttype, extdata))
     return extensions
 
@@ -311,9 +331,9 @@ class PfKey(object):
     msg = self.MakeSadbMsg(SADB_DUMP, SADB_TYPE_UNSPEC)
     received = self.SendAndRecv(msg, b"")
     while received:
-      msg, data = cstruct.Read(received, SadbMsg)
+      msg, offset = SadbMsg.ReadFrom(received)
       extlen = self.ExtensionsLength(msg, SadbMsg)
-      extensions, data = data[:extlen], data[extlen:]
+      extensions = received[offset:offset + extlen]
       dump.append((msg, self.ParseExtensions(extensions)))
       if msg.seq == 0:  # End of dump.
         break
@@ -73,7 +73,7 @@ INET_DIAG_BC_DEV_COND = 9
 INET_DIAG_BC_MARK_COND = 10
 
 CONSTANT_PREFIXES = netlink.MakeConstantPrefixes([
-    "INET_DIAG_", "INET_DIAG_REQ_", "INET_DIAG_BC_"])
+    "INET_DIAG_", "INET_DIAG_REQ_", "INET_DIAG_BC_", "SOCK_"])
 
 # Data structure formats.
 # These aren't constants, they're classes. So, pylint: disable=invalid-name
@@ -110,57 +110,60 @@ TCP_TIME_WAIT = 6
 ALL_NON_TIME_WAIT = 0xffffffff & ~(1 << TCP_TIME_WAIT)
 
 
+def _DecodeSockaddrs(sock, command, msg, name, data, nested):
+  """Decodes INET_DIAG_LOCALS and INET_DIAG_PEERS."""
+  # pylint: disable=unused-argument
+  addrs = []
+  # The SCTP diag code always appears to copy sizeof(sockaddr_storage)
+  # bytes, but does so from a union sctp_addr which is at most as long
+  # as a sockaddr_in6.
+  for addr in cstruct.StructArray(csocket.SockaddrStorage, data):
+    if addr.family == AF_INET:
+      addr = csocket.SockaddrIn(addr.Pack())
+    elif addr.family == AF_INET6:
+      addr = csocket.SockaddrIn6(addr.Pack())
+    addrs.append(addr)
+  return addrs
+
+
 class SockDiag(netlink.NetlinkSocket):
 
   NL_DEBUG = []
 
+  ATTRIBUTES = {
+      "INET_DIAG_SHUTDOWN": netlink.U8,
+      "INET_DIAG_TOS": netlink.U8,
+      "INET_DIAG_TCLASS": netlink.U8,
+      "INET_DIAG_SKV6ONLY": netlink.U8,
+      "INET_DIAG_CONG": netlink.String,
+      "INET_DIAG_MEMINFO": netlink.Struct(InetDiagMeminfo),
+      # TODO: Catch the exception and try something else if it's not TCP.
+      "INET_DIAG_INFO": netlink.Struct(TcpInfo),
+      "INET_DIAG_SKMEMINFO": netlink.Struct(SkMeminfo),
+      "INET_DIAG_MARK": netlink.U32,
+      "INET_DIAG_REQ_BYTECODE": netlink.Method("DecodeBytecode"),
+      "INET_DIAG_LOCALS": _DecodeSockaddrs,
+      "INET_DIAG_PEERS": _DecodeSockaddrs,
+  }
+
   def __init__(self):
     super(SockDiag, self).__init__(netlink.NETLINK_SOCK_DIAG)
 
-  def _Decode(self, command, msg, nla_type, nla_data, nested):
-    """Decodes netlink attributes to Python types."""
+  def _DecodeName(self, command, msg, nla_type, nested):
     if msg.family == AF_INET or msg.family == AF_INET6:
       if isinstance(msg, InetDiagReqV2):
         prefix = "INET_DIAG_REQ_"
       else:
         prefix = "INET_DIAG_"
-      name = self._GetConstantName(__name__, nla_type, prefix)
+      return self._GetConstantName(__name__, nla_type, prefix)
     else:
       # Don't know what this is. Leave it as an integer.
-      name = nla_type
-
-    if name in ["INET_DIAG_SHUTDOWN", "INET_DIAG_TOS", "INET_DIAG_TCLASS",
-                "INET_DIAG_SKV6ONLY"]:
-      data = ord(nla_data)
-    elif name == "INET_DIAG_CONG":
-      data = nla_data.strip(b"\x00")
-    elif name == "INET_DIAG_MEMINFO":
-      data = InetDiagMeminfo(nla_data)
-    elif name == "INET_DIAG_INFO":
-      # TODO: Catch the exception and try something else if it's not TCP.
-      data = TcpInfo(nla_data)
-    elif name == "INET_DIAG_SKMEMINFO":
-      data = SkMeminfo(nla_data)
-    elif name == "INET_DIAG_MARK":
-      data = struct.unpack("=I", nla_data)[0]
-    elif name == "INET_DIAG_REQ_BYTECODE":
-      data = self.DecodeBytecode(nla_data)
-    elif name in ["INET_DIAG_LOCALS", "INET_DIAG_PEERS"]:
-      data = []
-      while len(nla_data):
-        # The SCTP diag code always appears to copy sizeof(sockaddr_storage)
-        # bytes, but does so from a union sctp_addr which is at most as long
-        # as a sockaddr_in6.
-        addr, nla_data = cstruct.Read(nla_data, csocket.SockaddrStorage)
-        if addr.family == AF_INET:
-          addr = csocket.SockaddrIn(addr.Pack())
-        elif addr.family == AF_INET6:
-          addr = csocket.SockaddrIn6(addr.Pack())
-        data.append(addr)
-    else:
-      data = nla_data
+      return nla_type
 
-    return name, data
+  def _CommandName(self, command):
+    if command < SOCK_DIAG_BY_FAMILY:
+      return super(SockDiag, self)._CommandName(command)
+    return str(self._GetConstantName(__name__, command, "SOCK_"))
 
   def MaybeDebugCommand(self, command, unused_flags, data):
     name = self._GetConstantName(__name__, command, "SOCK_")
@@ -266,35 +269,35 @@ class SockDiag(netlink.NetlinkSocket):
   @staticmethod
   def DecodeBytecode(bytecode):
     instructions = []
+    offset = 0
     try:
-      while bytecode:
-        op, rest = cstruct.Read(bytecode, InetDiagBcOp)
+      while offset < len(bytecode):
+        op, offset = InetDiagBcOp.ReadFrom(bytecode, offset)
 
         if op.code in [INET_DIAG_BC_NOP, INET_DIAG_BC_JMP, INET_DIAG_BC_AUTO]:
           arg = None
         elif op.code in [INET_DIAG_BC_S_GE, INET_DIAG_BC_S_LE,
                          INET_DIAG_BC_D_GE, INET_DIAG_BC_D_LE]:
-          op, rest = cstruct.Read(rest, InetDiagBcOp)
+          op, offset = InetDiagBcOp.ReadFrom(bytecode, offset)
           arg = op.no
         elif op.code in [INET_DIAG_BC_S_COND, INET_DIAG_BC_D_COND]:
-          cond, rest = cstruct.Read(rest, InetDiagHostcond)
+          cond, offset = InetDiagHostcond.ReadFrom(bytecode, offset)
           if cond.family == 0:
             arg = (None, cond.prefix_len, cond.port)
           else:
             addrlen = 4 if cond.family == AF_INET else 16
-            addr, rest = rest[:addrlen], rest[addrlen:]
+            addr = bytecode[offset:offset + addrlen]
+            offset += addrlen
             addr = inet_ntop(cond.family, addr)
             arg = (addr, cond.prefix_len, cond.port)
         elif op.code == INET_DIAG_BC_DEV_COND:
-          attrlen = struct.calcsize("=I")
-          attr, rest = rest[:attrlen], rest[attrlen:]
-          arg = struct.unpack("=I", attr)
+          arg = struct.unpack_from("=I", bytecode, offset)
+          offset += struct.calcsize("=I")
         elif op.code == INET_DIAG_BC_MARK_COND:
-          arg, rest = cstruct.Read(rest, InetDiagMarkcond)
+          arg, offset = InetDiagMarkcond.ReadFrom(bytecode, offset)
         else:
           raise ValueError("Unknown opcode %d" % op.code)
         instructions.append((op, arg))
-        bytecode = rest
 
       return instructions
     except (TypeError, ValueError):
@@ -307,20 +310,32 @@ class SockDiag(netlink.NetlinkSocket):
     out = self._Dump(SOCK_DIAG_BY_FAMILY, diag_req, InetDiagMsg, bytecode)
     return out
 
-  def DumpAllInetSockets(self, protocol, bytecode, sock_id=None, ext=0,
+  def IterAllInetSockets(self, protocol, bytecode, sock_id=None, ext=0,
                          states=ALL_NON_TIME_WAIT):
-    """Dumps IPv4 or IPv6 sockets matching the specified parameters."""
+    """Iterates over IPv4 or IPv6 sockets matching the specified parameters.
+
+    The IPv6 dump is only requested once the IPv4 dump has been consumed.
+    """
     # DumpSockets(AF_UNSPEC) does not result in dumping all inet sockets, it
     # results in ENOENT.
     if sock_id is None:
       sock_id = self._EmptyInetDiagSockId()
 
-    sockets = []
+    if bytecode:
+      bytecode = self._NlAttr(INET_DIAG_REQ_BYTECODE, bytecode)
+
     for family in [AF_INET, AF_INET6]:
       diag_req = InetDiagReqV2((family, protocol, ext, states, sock_id))
-      sockets += self.Dump(diag_req, bytecode)
+      # If the caller stops early, closing this generator also closes (and
+      # drains) the dump in progress.
+      yield from self.IterDump(SOCK_DIAG_BY_FAMILY, diag_req, InetDiagMsg,
+                               bytecode)
 
-    return sockets
+  def DumpAllInetSockets(self, protocol, bytecode, sock_id=None, ext=0,
+                         states=ALL_NON_TIME_WAIT):
+    """Dumps IPv4 or IPv6 sockets matching the specified parameters."""
+    return list(self.IterAllInetSockets(protocol, bytecode, sock_id, ext,
+                                        states))
 
   @staticmethod
   def GetRawAddress(family, addr):
@@ -17,9 +17,7 @@
 """Generic netlink interface to TCP metrics."""
 
 from socket import *  # pylint: disable=wildcard-import
-import struct
 
-import binascii
 import cstruct
 import genetlink
 import net_test
@@ -56,33 +54,27 @@ class TcpMetrics(genetlink.GenericNetlink):
 
   NL_DEBUG = ["ALL"]
 
+  ATTRIBUTES = {
+      "TCP_METRICS_ATTR_ADDR_IPV4": netlink.AddressIn(AF_INET),
+      "TCP_METRICS_ATTR_SADDR_IPV4": netlink.AddressIn(AF_INET),
+      "TCP_METRICS_ATTR_ADDR_IPV6": netlink.AddressIn(AF_INET6),
+      "TCP_METRICS_ATTR_SADDR_IPV6": netlink.AddressIn(AF_INET6),
+      "TCP_METRICS_ATTR_AGE": netlink.U64,
+      "TCP_METRICS_ATTR_TW_TSVAL": netlink.U32,
+      "TCP_METRICS_ATTR_TW_TS_STAMP": netlink.U32,
+      "TCP_METRICS_ATTR_FOPEN_MSS": netlink.U16,
+      "TCP_METRICS_ATTR_FOPEN_COOKIE": netlink.Raw,
+  }
+  DEFAULT_DECODER = staticmethod(netlink.Hex)
+
   def __init__(self):
     super(TcpMetrics, self).__init__()
     # Generic netlink family IDs are dynamically assigned. Find ours.
     ctrl = genetlink.GenericNetlinkControl()
     self.family = ctrl.GetFamily(TCP_METRICS_GENL_NAME)
 
-  def _Decode(self, command, msg, nla_type, nla_data, nested):
-    """Decodes TCP metrics netlink attributes to human-readable format."""
-
-    name = self._GetConstantName(__name__, nla_type, "TCP_METRICS_ATTR_")
-
-    if name in ["TCP_METRICS_ATTR_ADDR_IPV4", "TCP_METRICS_ATTR_SADDR_IPV4"]:
-      data = inet_ntop(AF_INET, nla_data)
-    elif name in ["TCP_METRICS_ATTR_ADDR_IPV6", "TCP_METRICS_ATTR_SADDR_IPV6"]:
-      data = inet_ntop(AF_INET6, nla_data)
-    elif name in ["TCP_METRICS_ATTR_AGE"]:
-      data = struct.unpack("=Q", nla_data)[0]
-    elif name in ["TCP_METRICS_ATTR_TW_TSVAL", "TCP_METRICS_ATTR_TW_TS_STAMP"]:
-      data = struct.unpack("=I", nla_data)[0]
-    elif name == "TCP_METRICS_ATTR_FOPEN_MSS":
-      data = struct.unpack("=H", nla_data)[0]
-    elif name == "TCP_METRICS_ATTR_FOPEN_COOKIE":
-      data = nla_data
-    else:
-      data = binascii.hexlify(nla_data)
-
-    return name, data
+  def _DecodeName(self, command, msg, nla_type, nested):
+    return self._GetConstantName(__name__, nla_type, "TCP_METRICS_ATTR_")
 
   def MaybeDebugCommand(self, command, unused_flags, data):
     if "ALL" not in self.NL_DEBUG and command not in self.NL_DEBUG:
@@ -338,12 +338,28 @@ class Xfrm(netlink.NetlinkSocket):
 
   DEBUG = False
 
+  ATTRIBUTES = {
+      "XFRMA_ALG_CRYPT": netlink.Struct(XfrmAlgo),
+      "XFRMA_ALG_AUTH": netlink.Struct(XfrmAlgo),
+      "XFRMA_ALG_AUTH_TRUNC": netlink.Struct(XfrmAlgoAuth),
+      "XFRMA_ENCAP": netlink.Struct(XfrmEncapTmpl),
+      "XFRMA_MARK": netlink.Struct(XfrmMark),
+      "XFRMA_OUTPUT_MARK": netlink.U32,
+      "XFRMA_TMPL": netlink.Struct(XfrmUserTmpl),
+      "XFRMA_IF_ID": netlink.U32,
+  }
+
   def __init__(self):
     super(Xfrm, self).__init__(netlink.NETLINK_XFRM)
 
   def _GetConstantName(self, value, prefix):
     return super(Xfrm, self)._GetConstantName(__name__, value, prefix)
 
+  def _CommandName(self, command):
+    if command < XFRM_MSG_NEWSA:
+      return super(Xfrm, self)._CommandName(command)
+    return str(self._GetConstantName(command, "XFRM_MSG_"))
+
   def MaybeDebugCommand(self, command, flags, data):
     if "ALL" not in self.NL_DEBUG and "XFRM" not in self.NL_DEBUG:
       return
@@ -368,28 +384,8 @@ class Xfrm(netlink.NetlinkSocket):
     else:
       print("%s" % cmdname)
 
-  def _Decode(self, command, unused_msg, nla_type, nla_data, nested):
-    """Decodes netlink attributes to Python types."""
-    name = self._GetConstantName(nla_type, "XFRMA_")
-
-    if name in ["XFRMA_ALG_CRYPT", "XFRMA_ALG_AUTH"]:
-      data = cstruct.Read(nla_data, XfrmAlgo)[0]
-    elif name == "XFRMA_ALG_AUTH_TRUNC":
-      data = cstruct.Read(nla_data, XfrmAlgoAuth)[0]
-    elif name == "XFRMA_ENCAP":
-      data = cstruct.Read(nla_data, XfrmEncapTmpl)[0]
-    elif name == "XFRMA_MARK":
-      data = cstruct.Read(nla_data, XfrmMark)[0]
-    elif name == "XFRMA_OUTPUT_MARK":
-      data = struct.unpack("=I", nla_data)[0]
-    elif name == "XFRMA_TMPL":
-      data = cstruct.Read(nla_data, XfrmUserTmpl)[0]
-    elif name == "XFRMA_IF_ID":
-      data = struct.unpack("=I", nla_data)[0]
-    else:
-      data = nla_data
-
-    return name, data
+  def _DecodeName(self, command, unused_msg, nla_type, nested):
+    return self._GetConstantName(nla_type, "XFRMA_")
 
   def _UpdatePolicyInfo(self, msg, policy, tmpl, mark, xfrm_if_id):
     """Send a policy to the Security Policy Database"""
@@ -459,7 +455,8 @@ class Xfrm(netlink.NetlinkSocket):
       flags: a list of flags for the expected handling; if no flags are
           provided, an ACK response is assumed.
     """
-    msg = req.Pack()
+    msg = self._NlRequestBuffer()
+    msg.Append(req)
     if nlattrs is None:
       nlattrs = []
     for attr_type, attr_msg in nlattrs:
@@ -487,7 +484,7 @@ class Xfrm(netlink.NetlinkSocket):
       #    XfrmAttrOutputMark = cstruct.Struct("=I", mark)
       if hasattr(attr_msg, "Pack"):
         attr_msg = attr_msg.Pack()
-      msg += self._NlAttr(attr_type, attr_msg)
+      self._AppendNlAttr(msg, attr_type, attr_msg)
     return self._SendNlRequest(msg_type, msg, flags)
 
   def AddSaInfo(self, src, dst, spi, mode, reqid, encryption, auth_trunc, aead,
@@ -516,29 +513,6 @@ class Xfrm(netlink.NetlinkSocket):
     xfrm_id = XfrmId((PaddedAddress(dst), spi, proto))
     family = AF_INET6 if ":" in dst else AF_INET
 
-    nlattrs = b""
-    if encryption is not None:
-      enc, key = encryption
-      nlattrs += self._NlAttr(XFRMA_ALG_CRYPT, enc.Pack() + key)
-
-    if auth_trunc is not None:
-      auth, key = auth_trunc
-      nlattrs += self._NlAttr(XFRMA_ALG_AUTH_TRUNC, auth.Pack() + key)
-
-    if aead is not None:
-      aead_alg, key = aead
-      nlattrs += self._NlAttr(XFRMA_ALG_AEAD, aead_alg.Pack() + key)
-
-    # if a user provides either mark or mask, then we send the mark attribute
-    if mark is not None:
-      nlattrs += self._NlAttr(XFRMA_MARK, mark.Pack())
-    if encap is not None:
-      nlattrs += self._NlAttr(XFRMA_ENCAP, encap.Pack())
-    if output_mark is not None:
-      nlattrs += self._NlAttrU32(XFRMA_OUTPUT_MARK, output_mark)
-    if xfrm_if_id is not None:
-      nlattrs += self._NlAttrU32(XFRMA_IF_ID, xfrm_if_id)
-
     # The kernel ignores these on input, so make them empty.
     cur = XfrmLifetimeCur()
     stats = XfrmStats()
@@ -564,7 +538,30 @@ class Xfrm(netlink.NetlinkSocket):
 
     sa = XfrmUsersaInfo((selector, xfrm_id, PaddedAddress(src), NO_LIFETIME_CFG,
                          cur, stats, seq, reqid, family, mode, replay, flags))
-    msg = sa.Pack() + nlattrs
+    msg = self._NlRequestBuffer()
+    msg.Append(sa)
+
+    # The algorithm attributes are a struct followed by the key.
+    for attr_type, alg in [(XFRMA_ALG_CRYPT, encryption),
+                           (XFRMA_ALG_AUTH_TRUNC, auth_trunc),
+                           (XFRMA_ALG_AEAD, aead)]:
+      if alg is not None:
+        algo, key = alg
+        start = self._StartNlAttr(msg, attr_type)
+        msg.Append(algo)
+        msg.Append(key)
+        self._EndNlAttr(msg, start)
+
+    # if a user provides either mark or mask, then we send the mark attribute
+    if mark is not None:
+      self._AppendNlAttr(msg, XFRMA_MARK, mark.Pack())
+    if encap is not None:
+      self._AppendNlAttr(msg, XFRMA_ENCAP, encap.Pack())
+    if output_mark is not None:
+      self._AppendNlAttrU32(msg, XFRMA_OUTPUT_MARK, output_mark)
+    if xfrm_if_id is not None:
+      self._AppendNlAttrU32(msg, XFRMA_IF_ID, xfrm_if_id)
+
     flags = netlink.NLM_F_REQUEST | netlink.NLM_F_ACK
     nl_msg_type = XFRM_MSG_UPDSA if is_update else XFRM_MSG_NEWSA
     self._SendNlRequest(nl_msg_type, msg, flags)
@@ -614,23 +611,33 @@ class Xfrm(netlink.NetlinkSocket):
     self._SendNlRequest(XFRM_MSG_ALLOCSPI, msg, flags)
     # Read the response message.
     data = self._Recv()
-    nl_hdr, data = cstruct.Read(data, netlink.NLMsgHdr)
+    nl_hdr, offset = netlink.NLMsgHdr.ReadFrom(data)
     if nl_hdr.type == XFRM_MSG_NEWSA:
-      return XfrmUsersaInfo(data)
+      return XfrmUsersaInfo.ReadFrom(data, offset)[0]
     if nl_hdr.type == netlink.NLMSG_ERROR:
-      error = -netlink.NLMsgErr(data).error
+      error = -netlink.NLMsgErr.ReadFrom(data, offset)[0].error
       raise IOError(error, os.strerror(error))
     raise ValueError("Unexpected netlink message type: %d" % nl_hdr.type)
 
+  def IterSaInfo(self):
+    return self.IterDump(XFRM_MSG_GETSA, None, XfrmUsersaInfo)
+
   def DumpSaInfo(self):
-    return self._Dump(XFRM_MSG_GETSA, None, XfrmUsersaInfo)
+    return list(self.IterSaInfo())
 
   def DumpPolicyInfo(self):
     return self._Dump(XFRM_MSG_GETPOLICY, None, XfrmUserpolicyInfo)
 
   def FindSaInfo(self, spi):
-    sainfo = [sa for sa, attrs in self.DumpSaInfo() if sa.id.spi == spi]
-    return sainfo[0] if sainfo else None
+    sainfo = self.IterSaInfo()
+    try:
+      for sa, _ in sainfo:
+        if sa.id.spi == spi:
+          return sa
+      return None
+    finally:
+      # Reads the rest of the dump if we found the SA early.
+      sainfo.close()
 
   def FlushPolicyInfo(self):
     """Send a Netlink Request to Flush all records from the SPD"""